@@ -1,15 +1,35 @@
 import argparse
-import ftplib
 import io
 import os
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Set, Tuple
 
 from src import DirectoryParser, FileCloudController
 from src.directory_parser import RemoteExtraction
-from src.utils import bcolors, timerdecorator
+from src.file_cloud_controller import MergePolicy, VerifyMode
+from src.ftp_stream import ZipMode
+from src.folder_cache import FolderCache
+from src.metadata_cache import MetadataSetCache
+from src.metrics import metrics
+from src.session_cache import SessionCache
+from src.upload_offset_cache import UploadOffsetCache
+from src.utils import bcolors, show_timings, timerdecorator
+
+# Seconds lambda_handler reuses a FileCloud client or FTP pool in warm invocations.
+# A FileCloud session that expires sooner is logged in again by the request layer
+# and stale FTP connections are replaced by the pool
+WARM_TTL = 15 * 60
+
+# Key -> (created, client) of the clients kept between warm invocations
+_warm_clients: Dict[Tuple, Tuple[float, object]] = {}
 
 
 def parse_opt():
+    from src.upload_queue import QueueRole
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--remote", nargs="?", const=True, default=False)
     parser.add_argument("--ftp_server", type=str, default="")
@@ -17,6 +37,63 @@ def parse_opt():
     parser.add_argument("--ftp_passwd", type=str, default="")
     parser.add_argument("--zip_path", type=str, default="")
     parser.add_argument("--contract", type=str, default="")
+    parser.add_argument("--upload_workers", type=int, default=4)
+    parser.add_argument("--ftp_pool_size", type=int, default=4)
+    parser.add_argument("--index", type=str, default="")
+    parser.add_argument("--full_rescan", nargs="?", const=True, default=False)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--metadata_cache", type=str, default="")
+    parser.add_argument("--folder_cache", type=str, default="")
+    # JSON file FileCloud session cookies are reused from until they expire
+    parser.add_argument("--session_cache", type=str, default="")
+    parser.add_argument(
+        "--verify",
+        type=str,
+        default=VerifyMode.OFF.value,
+        choices=[mode.value for mode in VerifyMode],
+    )
+    parser.add_argument("--verify_sample_rate", type=float, default=0.05)
+    # How KVP rows of one file with the same metadata set are merged
+    parser.add_argument(
+        "--merge_policy",
+        type=str,
+        default=MergePolicy.LAST.value,
+        choices=[policy.value for policy in MergePolicy],
+    )
+    # Bytes per upload request, 0 uploads every file in one request
+    parser.add_argument("--chunk_size", type=int, default=0)
+    # JSON file the offsets of failed chunked uploads are resumed from in later runs
+    parser.add_argument("--offset_cache", type=str, default="")
+    # Upload with the asyncio client, upload_workers uploads in flight
+    parser.add_argument("--async_upload", nargs="?", const=True, default=False)
+    # FileCloud requests per second, 0 for no limit
+    parser.add_argument("--rate_limit", type=float, default=0)
+    parser.add_argument("--max_retries", type=int, default=3)
+    # SQLite file of the durable upload queue, uploads directly when empty
+    parser.add_argument("--queue", type=str, default="")
+    parser.add_argument(
+        "--queue_role",
+        type=str,
+        default=QueueRole.ALL.value,
+        choices=[role.value for role in QueueRole],
+    )
+    # Keep polling the FTP server (--remote) and upload zips as they complete
+    parser.add_argument("--watch", nargs="?", const=True, default=False)
+    parser.add_argument("--poll_interval", type=float, default=5.0)
+    parser.add_argument("--max_poll_interval", type=float, default=300.0)
+    # Times a zip that fails to be read or uploaded is retried until it changes
+    parser.add_argument("--watch_attempts", type=int, default=5)
+    parser.add_argument(
+        "--zip_mode",
+        type=str,
+        default=ZipMode.MEMORY.value,
+        choices=[mode.value for mode in ZipMode],
+    )
+    # Write per-stage metrics to this path, Prometheus text if it ends with .prom
+    # and a JSON report otherwise
+    parser.add_argument("--metrics", type=str, default="")
+    # Print how long every timed function call took
+    parser.add_argument("--timings", nargs="?", const=True, default=False)
 
     return parser.parse_args()
 
@@ -25,18 +102,38 @@ def parse_opt():
 def main(opt):
     # Log in to Filecloud
     server_url = "http://40.78.9.249"
-    fc_service = FileCloudController(server_url, "test", "Pointwest!2345678")
-    fc_service.login()
-    fc_service.admin_login()
+    fc_service = FileCloudController(
+        server_url,
+        "test",
+        "Pointwest!2345678",
+        metadata_cache=MetadataSetCache(path=opt.metadata_cache or None),
+        folder_cache=FolderCache(path=opt.folder_cache or None),
+        session_cache=SessionCache(path=opt.session_cache or None),
+        offset_cache=UploadOffsetCache(path=opt.offset_cache or None),
+        verify_mode=VerifyMode(opt.verify),
+        verify_sample_rate=opt.verify_sample_rate,
+        merge_policy=MergePolicy(opt.merge_policy),
+        chunk_size=opt.chunk_size or None,
+        rate_limit=opt.rate_limit or None,
+        max_retries=opt.max_retries,
+    )
+    fc_service.ensure_login()
 
     # Check directory for output zipfiles or directly go to zip location
     # Then extracts KVP and PDF files of zipfile/s
     print(bcolors.OKCYAN + f"Checking Directory:" + bcolors.ENDC, end=" ")
     print(bcolors.UNDERLINE + opt.ftp_server + bcolors.ENDC)
+    index = None
+    if opt.index:
+        from src.directory_index import DirectoryIndex
+
+        index = DirectoryIndex(opt.index, opt.full_rescan)
     file_parser = DirectoryParser(
         src_path=opt.ftp_server,
         zip_path=opt.zip_path,
         contract=opt.contract,
+        index=index,
+        workers=opt.workers,
     )
 
     if opt.remote:
@@ -49,24 +146,32 @@ def main(opt):
             opt.ftp_server,
             opt.ftp_user,
             opt.ftp_passwd,
+            zip_mode=ZipMode(opt.zip_mode),
+            pool_size=opt.ftp_pool_size,
         )
 
-    # Walks through directory
-    kvp = file_parser.process_dir()
-    print(kvp)
+    if opt.queue:
+        return run_queue(opt, fc_service, file_parser)
 
-    print(bcolors.OKCYAN + "Uploading to Filecloud...." + bcolors.ENDC)
-    if kvp:
-        for job in kvp:
-            for element in kvp[job]:
-                print(element)
-                filename = element
-                file_data = kvp[job][element]["PDF File"]
-                file_kvp = (
-                    kvp[job][element]["KVP"] if "KVP" in kvp[job][element] else None
-                )
+    if opt.watch:
+        if not opt.remote:
+            print(bcolors.FAIL + "--watch needs --remote" + bcolors.ENDC)
+            return
+        return run_watch(opt, fc_service, file_parser)
+
+    # Walks through directory. Jobs are uploaded as soon as they are parsed, while
+    # the next zips are still being fetched
+    upload_report = upload_records(opt, fc_service, file_parser.iter_records())
+    upload_report["extraction_failures"] = dict(file_parser.extraction_failures)
+    print_extraction_failures(upload_report["extraction_failures"])
 
-                fc_service.upload_file(filename, file_data, file_kvp)
+    # Zips are only marked processed once every file in them is uploaded
+    for job in finished_batches(upload_report, file_parser.zip_paths):
+        file_parser.mark_processed(job)
+    upload_report["kvp_join"] = file_parser.join_report()
+    print_kvp_join(upload_report["kvp_join"])
+
+    return upload_report
 
     """ 
     test writing file stored in object
@@ -79,26 +184,307 @@ def main(opt):
     """
 
 
-# Needed to connect to new FTP server
-class MyFTP_TLS(ftplib.FTP_TLS):
-    """Explicit FTPS, with shared TLS session"""
+def upload_records(opt, fc_service: FileCloudController, records) -> Dict:
+    """Uploads the tasks in records and prints the upload and request stats"""
+    print(bcolors.OKCYAN + "Uploading to Filecloud...." + bcolors.ENDC)
+    if opt.async_upload:
+        # asyncio and aiohttp are only imported when used
+        import asyncio
+
+        upload_report = asyncio.run(
+            upload_async(fc_service, records, max_in_flight=opt.upload_workers)
+        )
+    else:
+        from src.upload_pipeline import UploadPipeline
 
-    def ntransfercmd(self, cmd, rest=None):
-        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
-        if self._prot_p:
-            conn = self.context.wrap_socket(
-                conn, server_hostname=self.host, session=self.sock.session
-            )  # this is the fix
-        return conn, size
+        pipeline = UploadPipeline(fc_service, max_workers=opt.upload_workers)
+        upload_report = pipeline.run(records)
+        upload_report["verification"] = fc_service.verification_results()
+    print_upload_stats(upload_report["stats"])
+    print_verification(upload_report["verification"])
+    upload_report["requests"] = fc_service.request_stats()
+    print_request_stats(upload_report["requests"])
+    return upload_report
+
+
+def failed_batches(upload_report: Dict) -> Set[str]:
+    failed = {
+        result["job"] for result in upload_report["results"] if not result["uploaded"]
+    }
+    return failed | set(upload_report.get("extraction_failures", {}))
+
+
+def finished_batches(upload_report: Dict, extracted: Iterable[str]) -> Set[str]:
+    """Batches whose zip was read and whose files all uploaded, including batches
+    that had nothing to upload. A zip that could not be read is not in here
+
+    Parameters
+    ----------
+        upload_report
+            Report of upload_records, with extraction_failures
+        extracted
+            Batches whose zip was opened, DirectoryParser.zip_paths
+    """
+    batches = {result["job"] for result in upload_report["results"]}
+    return (batches | set(extracted)) - failed_batches(upload_report)
+
+
+def run_watch(opt, fc_service: FileCloudController, file_parser: DirectoryParser):
+    """Polls the Output folders on the FTP server and uploads every zip once it is
+    complete, until interrupted. Zips that failed to be read or uploaded are
+    retried with a growing delay, up to --watch_attempts times"""
+    from src.remote_watcher import RemoteWatcher
+
+    watcher = RemoteWatcher(
+        file_parser.extraction_strat,
+        contract=opt.contract,
+        index=file_parser.index,
+        min_interval=opt.poll_interval,
+        max_interval=opt.max_poll_interval,
+        max_attempts=opt.watch_attempts,
+    )
+    try:
+        for zip_entries in watcher.watch():
+            upload_report = upload_records(
+                opt, fc_service, file_parser.iter_records(zip_entries)
+            )
+            upload_report["extraction_failures"] = dict(file_parser.extraction_failures)
+            print_extraction_failures(upload_report["extraction_failures"])
+            uploaded_jobs = finished_batches(upload_report, file_parser.zip_paths)
+            for batch_name, zip_entry in file_parser.zip_entries.items():
+                if batch_name in uploaded_jobs:
+                    file_parser.mark_processed(batch_name)
+                else:
+                    watcher.release(zip_entry)
+            print_kvp_join(file_parser.join_report())
+            file_parser.zip_entries.clear()
+            file_parser.zip_paths.clear()
+            file_parser.extraction_failures.clear()
+            file_parser.unmatched_rows.clear()
+            file_parser.orphan_pdfs.clear()
+    except KeyboardInterrupt:
+        print(bcolors.WARNING + "Watcher stopped" + bcolors.ENDC)
+
+
+def run_queue(opt, fc_service: FileCloudController, file_parser: DirectoryParser):
+    """Extracts the zips into the upload queue, uploads from it, or both, depending
+    on --queue_role. With both, uploads start as soon as the first batch is queued.
+    Tasks that fail stay in the queue for the next run"""
+    from src.upload_pipeline import QueueConsumer
+    from src.upload_queue import QueueRole, UploadQueue
+
+    queue = UploadQueue(opt.queue)
+    role = QueueRole(opt.queue_role)
+    upload_report = {}
+    # Set once every zip is queued, a consumer waits for it before it stops
+    producing = threading.Event()
+    if role == QueueRole.CONSUME:
+        producing.set()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if role != QueueRole.PRODUCE:
+            # Tasks leased by a run that crashed are handed out again once their
+            # lease expires, other consumers may still be working on the rest
+            print(bcolors.OKCYAN + "Uploading to Filecloud...." + bcolors.ENDC)
+            consumer = QueueConsumer(
+                queue,
+                fc_service,
+                file_parser.extraction_strat,
+                max_workers=opt.upload_workers,
+            )
+            uploading = executor.submit(consumer.run, True, producing)
+
+        try:
+            if role != QueueRole.CONSUME:
+                added = file_parser.enqueue(queue)
+                producing.set()
+                print(
+                    bcolors.OKCYAN
+                    + f"Queued {sum(added.values())} files"
+                    + bcolors.ENDC
+                )
+                # The queue is durable, so zips whose tasks were queued count as
+                # processed
+                for batch_name, count in added.items():
+                    if count:
+                        file_parser.mark_processed(batch_name)
+            if role != QueueRole.PRODUCE:
+                upload_report = uploading.result()
+        except BaseException:
+            # The consumer returns the tasks it leased to the queue once its
+            # workers finished their uploads
+            if role != QueueRole.PRODUCE:
+                consumer.stop()
+            raise
+        finally:
+            producing.set()
+
+    if role != QueueRole.PRODUCE:
+        print_upload_stats(upload_report["stats"])
+        upload_report["verification"] = fc_service.verification_results()
+        print_verification(upload_report["verification"])
+        upload_report["requests"] = fc_service.request_stats()
+        print_request_stats(upload_report["requests"])
+
+    upload_report["queue"] = queue.counts()
+    print(bcolors.OKCYAN + f"Upload queue: {upload_report['queue']}" + bcolors.ENDC)
+    queue.close()
+    return upload_report
+
+
+async def upload_async(fc_service: FileCloudController, tasks, max_in_flight: int):
+    """Uploads tasks with an AsyncFileCloudController using the settings and caches
+    of fc_service"""
+    from src.async_file_cloud_controller import AsyncFileCloudController
+    from src.upload_pipeline import upload_stats
+
+    async with AsyncFileCloudController(
+        fc_service.server_url,
+        fc_service.user,
+        fc_service.passwd,
+        limit=max_in_flight,
+        metadata_cache=fc_service.metadata_cache,
+        folder_cache=fc_service.folder_cache,
+        offset_cache=fc_service.offset_cache,
+        verify_mode=fc_service.verify_mode,
+        verify_sample_rate=fc_service.verify_sample_rate,
+        merge_policy=fc_service.merge_policy,
+        chunk_size=fc_service.chunk_size,
+    ) as async_service:
+        # Pace and count requests together with the synchronous client, and reuse
+        # the sessions it logged in
+        async_service.request_layer = fc_service.request_layer
+        async_service.use_cookies(
+            fc_service.session.cookies.get_dict(),
+            fc_service.admin_session.cookies.get_dict(),
+        )
+        tic = time.perf_counter()
+        results = await async_service.upload_tasks(tasks, max_in_flight=max_in_flight)
+        stats = upload_stats(results, time.perf_counter() - tic, max_in_flight)
+        verification = await async_service.verification_results()
+
+    return {"results": results, "stats": stats, "verification": verification}
+
+
+def print_upload_stats(stats):
+    color = bcolors.OKGREEN if not stats["failed"] else bcolors.WARNING
+    print(
+        color
+        + f"Uploaded {stats['uploaded']}/{stats['total']} files "
+        + f"({stats['bytes'] / 1_000_000:0.2f} MB) in {stats['seconds']:0.2f}s "
+        + f"with {stats['workers']} workers: "
+        + f"{stats['files_per_second']:0.2f} files/s, "
+        + f"{stats['bytes_per_second'] / 1_000_000:0.2f} MB/s"
+        + bcolors.ENDC
+    )
+
+
+def print_verification(results):
+    if not results:
+        return
+    mismatched = [result for result in results if not result["verified"]]
+    color = bcolors.OKGREEN if not mismatched else bcolors.WARNING
+    print(
+        color
+        + f"Verified metadata of {len(results)} files, "
+        + f"{len(mismatched)} did not match"
+        + bcolors.ENDC
+    )
+    for result in mismatched:
+        print(
+            bcolors.WARNING
+            + f"{result['fullpath']} ({result['set']}): "
+            + (result["error"] or f"missing {', '.join(result['missing'])}")
+            + bcolors.ENDC
+        )
+
+
+def print_request_stats(stats):
+    for endpoint, counters in sorted(stats.items()):
+        color = bcolors.OKGREEN if not counters["errors"] else bcolors.WARNING
+        print(
+            color
+            + f"{endpoint}: {counters['calls']} calls, {counters['errors']} errors, "
+            + f"{counters['retries']} retries, {counters['relogins']} relogins, "
+            + f"mean {counters['mean_seconds']:0.3f}s, "
+            + f"max {counters['max_seconds']:0.3f}s"
+            + bcolors.ENDC
+        )
+
+
+def print_extraction_failures(failures):
+    for batch_name, error in sorted(failures.items()):
+        print(bcolors.FAIL + f"{batch_name} was not extracted: {error}" + bcolors.ENDC)
+
+
+def print_kvp_join(report):
+    for batch_name, join in sorted(report.items()):
+        print(
+            bcolors.WARNING
+            + f"{batch_name}: {sum(join['unmatched_rows'].values())} KVP rows "
+            + f"without a Searchable PDF, {len(join['orphan_pdfs'])} Searchable PDFs "
+            + "without KVP rows"
+            + bcolors.ENDC
+        )
+
+
+def warm_client(key: Tuple, create: Callable[[], object], ttl: float = WARM_TTL):
+    """Client cached under key by an earlier invocation in this process, or a new
+    one from create when there is none or it is older than ttl
+
+    Parameters
+    ----------
+        key
+            Everything the client was created with, e.g. server and user
+        create
+            Creates and logs in a new client
+        ttl
+            Seconds a client is reused for
+    """
+    now = time.monotonic()
+    cached = _warm_clients.get(key)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+    if cached and hasattr(cached[1], "close"):
+        cached[1].close()
+
+    client = create()
+    _warm_clients[key] = (now, client)
+    return client
+
+
+def new_fc_service(server_url: str, user: str, passwd: str, **kwargs):
+    fc_service = FileCloudController(server_url, user, passwd, **kwargs)
+    fc_service.ensure_login()
+    return fc_service
 
 
 @timerdecorator
 def lambda_handler(event):
     print(bcolors.OKCYAN + f"Checking Directory:" + bcolors.ENDC, end=" ")
     server_url = "http://40.78.9.249"
-    fc_service = FileCloudController(server_url, "test", "Pointwest!2345678")
-    fc_service.login()
-    fc_service.admin_login()
+    fc_options = {
+        "verify_mode": VerifyMode(event.get("verify", VerifyMode.OFF.value)),
+        "merge_policy": MergePolicy(event.get("merge_policy", MergePolicy.LAST.value)),
+        "chunk_size": event.get("chunk_size"),
+        "rate_limit": event.get("rate_limit"),
+        "max_retries": event.get("max_retries", 3),
+    }
+    # Cold starts reuse the cookies of other invocations from this file, e.g. on a
+    # shared mount
+    session_cache = event.get("session_cache")
+    fc_service = warm_client(
+        ("filecloud", server_url, "test", session_cache, *fc_options.values()),
+        lambda: new_fc_service(
+            server_url,
+            "test",
+            "Pointwest!2345678",
+            session_cache=SessionCache(path=session_cache),
+            **fc_options,
+        ),
+    )
+    # Counters of earlier invocations are not part of this one's report
+    fc_service.request_layer.reset_stats()
 
     contract = event["repository_path"].split("/")[0]
     job = event["job_code"]
@@ -108,30 +494,53 @@ def lambda_handler(event):
         job=event["job_code"],
     )
 
-    file_parser.extraction_strat = RemoteExtraction(
-        event["host"], event["username"], event["password"]
+    ftp_options = {
+        "zip_mode": ZipMode(event.get("zip_mode", ZipMode.RANGE.value)),
+        "pool_size": event.get("ftp_pool_size", 4),
+    }
+    ftp_login = (event["host"], event["username"], event["password"])
+    file_parser.extraction_strat = warm_client(
+        ("ftp", *ftp_login, *ftp_options.values()),
+        lambda: RemoteExtraction(*ftp_login, **ftp_options),
     )
-    kvp = file_parser.process_job()
-    if kvp:
-        kvp_job = kvp[job]
-        for element in kvp_job:
-            print(element)
-            if element == "FAILED":
-                for file in kvp[job][element]:
-                    filename = f"({job}) {file.name}"
-                    fc_service.upload_file(filename, file, kvp=None, is_failed=True)
-                    print(file)
-                    print(file.name)
-            else:
-                filename = element
-                file_data = kvp_job[element]["PDF File"]
-                file_kvp = (
-                    kvp_job[element]["KVP"] if "KVP" in kvp_job[element] else None
-                )
+    if event.get("metrics"):
+        metrics.reset()
+        metrics.enable()
+    try:
+        kvp = file_parser.process_job()
+        if kvp:
+            from src.upload_pipeline import UploadPipeline
 
-                fc_service.upload_file(filename, file_data, file_kvp)
+            pipeline = UploadPipeline(
+                fc_service, max_workers=event.get("upload_workers", 4)
+            )
+            upload_report = pipeline.run_kvp({job: kvp[job]})
+            upload_report["extraction_failures"] = dict(file_parser.extraction_failures)
+            print_extraction_failures(upload_report["extraction_failures"])
+            print_upload_stats(upload_report["stats"])
+            upload_report["verification"] = fc_service.verification_results()
+            print_verification(upload_report["verification"])
+            upload_report["requests"] = fc_service.request_stats()
+            print_request_stats(upload_report["requests"])
+            if metrics.enabled:
+                upload_report["metrics"] = metrics.report()
+            return upload_report
+    finally:
+        # A warm container runs the next invocation with the same metrics, which
+        # may not ask for them
+        metrics.disable()
+        metrics.reset()
 
 
 if __name__ == "__main__":
     opt = parse_opt()
-    main(opt)
+    if opt.timings:
+        show_timings()
+    if opt.metrics:
+        metrics.enable()
+    try:
+        main(opt)
+    finally:
+        if opt.metrics:
+            metrics.write(opt.metrics)
+            print(bcolors.OKCYAN + f"Metrics written to {opt.metrics}" + bcolors.ENDC)
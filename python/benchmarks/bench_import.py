@@ -0,0 +1,67 @@
+"""Measures the cold start import time of the entry points, in fresh interpreters
+
+python -m benchmarks.bench_import --module app --repeat 5 --top 10
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", type=str, nargs="+", default=["app", "src"])
+    parser.add_argument("--repeat", type=int, default=5)
+    # Number of slowest modules listed, by cumulative import time
+    parser.add_argument("--top", type=int, default=10)
+    return parser.parse_args()
+
+
+def import_times(module: str) -> List[Tuple[str, int]]:
+    """(module, cumulative microseconds) of every module imported by a fresh
+    interpreter importing module, from python -X importtime"""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times.append((name.strip(), int(cumulative)))
+    return times
+
+
+def bench(module: str, repeat: int) -> Tuple[float, Dict[str, int]]:
+    """Median import time of module in ms, and the median cumulative time of every
+    module it imports. Modules the interpreter imports at startup are left out"""
+    startup = {name for name, _ in import_times("sys")}
+    runs = [dict(import_times(module)) for _ in range(repeat)]
+    medians = {
+        name: int(statistics.median(run.get(name, 0) for run in runs))
+        for name in runs[-1]
+        if name not in startup
+    }
+    return medians.get(module, 0) / 1000, medians
+
+
+def main(opt):
+    for module in opt.module:
+        total, medians = bench(module, opt.repeat)
+        print(f"import {module}: {total:0.1f}ms median of {opt.repeat}")
+        slowest = sorted(
+            ((name, us) for name, us in medians.items() if name != module),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+        for name, us in slowest[: opt.top]:
+            print(f"{us / 1000:>10.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -0,0 +1,75 @@
+"""Compares KVPSpreadsheet with the pd.ExcelFile path it replaced
+
+The pandas path needs pandas and openpyxl, which are not dependencies of the
+uploader. They are pinned with the other benchmark dependencies in
+requirements-dev.txt:
+
+    pip install -r requirements-dev.txt
+    python -m benchmarks.bench_kvp_reader --documents 5000
+"""
+
+import argparse
+import io
+import time
+
+from benchmarks.generators import make_kvp_workbook
+from src.kvp_reader import KVPSpreadsheet
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=5000)
+    parser.add_argument("--templates", type=int, default=4)
+    parser.add_argument("--fields", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def read_streaming(data: bytes) -> int:
+    excel = KVPSpreadsheet(io.BytesIO(data))
+    return sum(len(records) for _, records in excel.kvp_records())
+
+
+def read_pandas(data: bytes) -> int:
+    """The parsing DirectoryParser._parse_dataframe did with pandas"""
+    import pandas as pd
+
+    excel = pd.ExcelFile(io.BytesIO(data))
+    total = 0
+    for sheet_name in excel.sheet_names[1:]:
+        df = excel.parse(sheet_name)
+        if df.empty:
+            continue
+        kvp_df = pd.concat([df.iloc[:, :3], df.iloc[:, 6::2]], axis=1)
+        total += len(kvp_df.to_dict("records"))
+    return total
+
+
+def bench(name, func, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        records = func(data)
+        timings.append(time.perf_counter() - tic)
+    best = min(timings)
+    print(f"{name:>10}: {best:0.4f}s best of {repeat}, {records} records")
+    return best
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    data = make_kvp_workbook(
+        documents=opt.documents, templates=opt.templates, fields=opt.fields
+    )
+    print(f"Workbook: {opt.documents} rows, {len(data) / 1_000_000:0.2f} MB")
+
+    streaming = bench("kvp_reader", read_streaming, data, opt.repeat)
+    try:
+        # pd.ExcelFile reads .xlsx files with openpyxl
+        import openpyxl  # noqa: F401
+        import pandas  # noqa: F401
+    except ImportError:
+        print("pandas or openpyxl is not installed, skipping the pd.ExcelFile path")
+    else:
+        legacy = bench("pandas", read_pandas, data, opt.repeat)
+        print(f"speedup: {legacy / streaming:0.1f}x")
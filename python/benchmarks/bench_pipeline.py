@@ -0,0 +1,246 @@
+"""Runs the whole walk, extract, parse and upload pipeline against a generated
+contract, a FakeFileCloud and optionally a FakeFTP, reporting every stage
+
+    python -m benchmarks.bench_pipeline --size medium --latency 0.02
+    python -m benchmarks.bench_pipeline --size small --ftp --zip_mode range
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks.fake_filecloud import FakeFileCloud
+from benchmarks.fake_ftp import FakeFTP
+from benchmarks.generators import write_contract
+from src import DirectoryParser, FileCloudController
+from src.directory_parser import RemoteExtraction
+from src.ftp_stream import ZipMode
+from src.metrics import metrics
+from src.upload_pipeline import UploadPipeline, tasks_from_kvp
+
+# jobs, batches per job, documents per batch, PDF size in KB
+SIZES = {
+    "small": (2, 2, 50, 4),
+    "medium": (4, 4, 250, 16),
+    "large": (8, 8, 1000, 64),
+}
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=str, default="small", choices=list(SIZES))
+    # Override single dimensions of --size
+    parser.add_argument("--jobs", type=int, default=0)
+    parser.add_argument("--batches", type=int, default=0)
+    parser.add_argument("--documents", type=int, default=0)
+    parser.add_argument("--pdf_kb", type=int, default=0)
+    # Seconds every FileCloud request waits, plus up to jitter seconds
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--upload_workers", type=int, default=4)
+    # Fetch the zips from a FakeFTP with RemoteExtraction instead of the disk
+    parser.add_argument("--ftp", nargs="?", const=True, default=False)
+    parser.add_argument(
+        "--zip_mode",
+        type=str,
+        default=ZipMode.MEMORY.value,
+        choices=[mode.value for mode in ZipMode],
+    )
+    # Also write the report, with the counters and histograms of src.metrics, as
+    # JSON to this path
+    parser.add_argument("--json", type=str, default="")
+    # Keep the output of the pipeline itself
+    parser.add_argument("--verbose", nargs="?", const=True, default=False)
+    return parser.parse_args()
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far. ru_maxrss is in KB on Linux
+    and in bytes on macOS"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def percentile(timings: List[float], q: int) -> float:
+    if len(timings) < 2:
+        return timings[0] if timings else 0.0
+    return statistics.quantiles(timings, n=100, method="inclusive")[q - 1]
+
+
+def stage_report(items: int, nbytes: int, elapsed: float, timings: List[float]) -> Dict:
+    """Throughput and latency percentiles of one stage
+
+    Parameters
+    ----------
+        items
+            Units the stage handled, e.g. zips or KVP rows
+        nbytes
+            Bytes the stage read or sent
+        elapsed
+            Wall time of the whole stage in seconds
+        timings
+            Seconds spent on each unit
+    """
+    return {
+        "items": items,
+        "seconds": round(elapsed, 4),
+        "items_per_s": round(items / elapsed, 1) if elapsed else 0.0,
+        "mb_per_s": round(nbytes / elapsed / 1e6, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(timings, 50) * 1000, 2),
+        "p90_ms": round(percentile(timings, 90) * 1000, 2),
+        "p99_ms": round(percentile(timings, 99) * 1000, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_pipeline(file_parser: DirectoryParser, fc_service, upload_workers: int):
+    """Times every stage of DirectoryParser.process_dir and UploadPipeline.run
+    separately"""
+    stages = {}
+
+    tic = time.perf_counter()
+    zip_files = file_parser._find_zip_files() or []
+    elapsed = time.perf_counter() - tic
+    stages["walk"] = stage_report(len(zip_files), 0, elapsed, [elapsed])
+
+    excel_files = []
+    timings = []
+    tic = time.perf_counter()
+    for zip_file, batch_name in zip_files:
+        _tic = time.perf_counter()
+        excel_files.extend(file_parser._extract_from_zip(zip_file, batch_name))
+        timings.append(time.perf_counter() - _tic)
+    zip_bytes = sum(entry.size or 0 for entry in file_parser.zip_entries.values())
+    stages["extract"] = stage_report(
+        len(zip_files), zip_bytes, time.perf_counter() - tic, timings
+    )
+
+    timings = []
+    tic = time.perf_counter()
+    for excel, job in excel_files:
+        _tic = time.perf_counter()
+        file_parser._parse_dataframe(excel, job)
+        timings.append(time.perf_counter() - _tic)
+    rows = sum(
+        len(document.kvp)
+        for job in file_parser.kvp_per_file.values()
+        for document in job.documents.values()
+        if document.kvp
+    )
+    stages["parse"] = stage_report(rows, 0, time.perf_counter() - tic, timings)
+
+    pipeline = UploadPipeline(fc_service, max_workers=upload_workers)
+    tic = time.perf_counter()
+    report = pipeline.run(tasks_from_kvp(file_parser.kvp_per_file))
+    results = report["results"]
+    stages["upload"] = stage_report(
+        len(results),
+        sum(result["bytes"] for result in results),
+        time.perf_counter() - tic,
+        [result["seconds"] for result in results],
+    )
+    stages["upload"]["failed"] = sum(not result["uploaded"] for result in results)
+
+    return stages
+
+
+def print_report(stages: Dict):
+    columns = ["items", "seconds", "items_per_s", "mb_per_s", "p50_ms", "p90_ms"]
+    columns += ["p99_ms", "peak_rss_mb"]
+    print(f"{'stage':>8}" + "".join(f"{column:>13}" for column in columns))
+    for stage, report in stages.items():
+        print(f"{stage:>8}" + "".join(f"{report[column]:>13}" for column in columns))
+
+
+def main(opt):
+    jobs, batches, documents, pdf_kb = SIZES[opt.size]
+    jobs = opt.jobs or jobs
+    batches = opt.batches or batches
+    documents = opt.documents or documents
+    pdf_kb = opt.pdf_kb or pdf_kb
+    # pipeline output is only kept with --verbose
+    quiet = (
+        contextlib.nullcontext()
+        if opt.verbose
+        else contextlib.redirect_stdout(io.StringIO())
+    )
+    if not opt.verbose:
+        # pyftpdlib only sets up its own logging when its logger has no handler
+        logging.getLogger("pyftpdlib").addHandler(logging.NullHandler())
+        logging.getLogger("pyftpdlib").setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as root, FakeFileCloud(
+        latency=opt.latency, jitter=opt.jitter
+    ) as fake_fc, contextlib.ExitStack() as stack:
+        zip_paths = write_contract(
+            root,
+            jobs=jobs,
+            batches=batches,
+            documents=documents,
+            pdf_size=pdf_kb * 1024,
+            output_folder="Output" if opt.ftp else "output",
+        )
+        print(
+            f"{len(zip_paths)} zips of {documents} documents, "
+            + f"{sum(os.path.getsize(path) for path in zip_paths) / 1e6:0.1f}MB"
+        )
+
+        fc_service = FileCloudController(fake_fc.url, "test", "bench")
+        with quiet:
+            fc_service.login()
+            fc_service.admin_login()
+            if opt.ftp:
+                fake_ftp = stack.enter_context(FakeFTP(root))
+                file_parser = DirectoryParser(src_path=root, contract="Contract")
+                file_parser.extraction_strat = RemoteExtraction(
+                    fake_ftp.host,
+                    fake_ftp.user,
+                    fake_ftp.passwd,
+                    zip_mode=ZipMode(opt.zip_mode),
+                    port=fake_ftp.port,
+                )
+            else:
+                file_parser = DirectoryParser(src_path=root, contract="Contract")
+            metrics.enable()
+            stages = run_pipeline(file_parser, fc_service, opt.upload_workers)
+            metrics.disable()
+
+    print_report(stages)
+    report = {
+        "config": {
+            "jobs": jobs,
+            "batches": batches,
+            "documents": documents,
+            "pdf_kb": pdf_kb,
+            "latency": opt.latency,
+            "jitter": opt.jitter,
+            "upload_workers": opt.upload_workers,
+            "ftp": bool(opt.ftp),
+            "zip_mode": opt.zip_mode,
+        },
+        "stages": stages,
+        # Spans are left out, there is one per file
+        "metrics": {
+            key: value
+            for key, value in metrics.report().items()
+            if key in ("counters", "histograms")
+        },
+    }
+    if opt.json:
+        with open(opt.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -0,0 +1,77 @@
+"""Compares ZipManifest with the member scans _extract_from_zip used to do
+
+python -m benchmarks.bench_zip_manifest --documents 50000
+"""
+
+import argparse
+import io
+import re
+import time
+import zipfile
+
+from benchmarks.generators import make_job_zip
+from src.config import (
+    BATCH_SPREADSHEET_NAME,
+    SUB_SEARCHABLE_REGEX,
+    SUFFIX_REMOVE_SEARCHABLE,
+)
+from src.zip_manifest import ZipManifest
+
+EXCEL_REGEX = r"^.+\/.+\.xlsx$"
+SEARCHABLE_PDF_REGEX = r"Searchable PDF"
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=50000)
+    parser.add_argument("--other_members", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser.parse_args()
+
+
+def classify_regex(output_zip: zipfile.ZipFile) -> int:
+    """The scans _extract_from_zip did before ZipManifest"""
+    zip_list = output_zip.namelist()
+    excel_files = [file for file in zip_list if re.search(EXCEL_REGEX, str(file))]
+    spreadsheets = [
+        file for file in excel_files if re.match(BATCH_SPREADSHEET_NAME, file)
+    ]
+    searchable_pdfs = {}
+    for file in [
+        file for file in zip_list if re.search(SEARCHABLE_PDF_REGEX, str(file))
+    ]:
+        _filename = re.sub(SUB_SEARCHABLE_REGEX, "", file)
+        _filename = file.split("/")[-1]
+        searchable_pdfs[_filename.removesuffix(SUFFIX_REMOVE_SEARCHABLE)] = file
+    return len(spreadsheets) + len(searchable_pdfs)
+
+
+def classify_manifest(output_zip: zipfile.ZipFile) -> int:
+    manifest = ZipManifest.from_zip(output_zip)
+    return len(manifest.spreadsheets) + len(manifest.searchable_pdfs)
+
+
+def bench(name, func, output_zip, repeat):
+    timings = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        members = func(output_zip)
+        timings.append(time.perf_counter() - tic)
+    best = min(timings)
+    print(f"{name:>10}: {best * 1000:0.2f}ms best of {repeat}, {members} members")
+    return best
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    data = make_job_zip(
+        documents=opt.documents,
+        other_members=opt.other_members,
+        workbook_documents=10,
+    )
+    output_zip = zipfile.ZipFile(io.BytesIO(data))
+    print(f"Zip: {len(output_zip.namelist())} members")
+
+    legacy = bench("regex", classify_regex, output_zip, opt.repeat)
+    manifest = bench("manifest", classify_manifest, output_zip, opt.repeat)
+    print(f"speedup: {legacy / manifest:0.1f}x")
@@ -0,0 +1,382 @@
+"""In-process stand-in for the FileCloud server, for benchmarks and local runs
+
+Implements the /core/* and /admin/* endpoints FileCloudController and
+AsyncFileCloudController call, keeping folders, files and metadata in memory.
+Every request waits `latency` seconds (plus up to `jitter`) before it is answered.
+
+    python -m benchmarks.fake_filecloud --port 8080 --latency 0.02
+"""
+
+import argparse
+import email.parser
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qsl, urlsplit
+from xml.sax.saxutils import escape
+
+# Fields FileCloud returns for every attribute of a metadata set, in order. The
+# controller reads the first two
+ATTRIBUTE_FIELDS = [
+    "attributeid",
+    "name",
+    "description",
+    "type",
+    "required",
+    "disabled",
+    "defaultvalue",
+]
+
+
+def _command(command: str, result: int = 1, message: str = "") -> str:
+    return (
+        "<commands><command>"
+        f"<type>{command}</type><result>{result}</result>"
+        f"<message>{escape(message)}</message>"
+        "</command></commands>"
+    )
+
+
+class FakeFileCloudState:
+    """Folders, files and metadata held by a FakeFileCloud"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.folders = set()
+        # Full path -> bytes received so far
+        self.files: Dict[str, int] = {}
+        # Metadata set name -> {"id", "attributes"}
+        self.metadata_sets: Dict[str, Dict] = {}
+        # Full path -> attribute id -> value
+        self.metadata_values: Dict[str, Dict[str, str]] = {}
+        # Full path -> ids of the metadata sets added to the file
+        self.file_sets: Dict[str, set] = {}
+        self.requests: Dict[str, int] = {}
+        self.sessions = set()
+        # Sessions ended by expire_sessions, requests made with them are refused
+        self.expired = set()
+
+    def count(self, endpoint: str):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def expire_sessions(self):
+        """Ends every session logged in so far, like a server restart"""
+        with self.lock:
+            self.expired |= self.sessions
+            self.sessions.clear()
+
+
+class FakeFileCloudHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, with Nagle every keep-alive
+    # response would wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+    server: "FakeFileCloudServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _form(self) -> Dict[str, str]:
+        """Query string and urlencoded or multipart form fields. Uploaded files are
+        returned as (filename, bytes) under their field name"""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = self._read_chunked()
+        else:
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length else b""
+        fields = dict(parse_qsl(urlsplit(self.path).query, keep_blank_values=True))
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser().parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body
+            )
+            for part in message.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                data = part.get_payload(decode=True)
+                filename = part.get_filename()
+                fields[name] = (filename, data) if filename else data.decode()
+        elif body:
+            fields.update(parse_qsl(body.decode(), keep_blank_values=True))
+        return fields
+
+    def _read_chunked(self) -> bytes:
+        """Body sent with chunked transfer encoding, as aiohttp streams file objects"""
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if not size:
+                # Trailers end with an empty line
+                while self.rfile.readline().strip():
+                    pass
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _send(self, text: str, status: int = 200, cookie: str | None = None):
+        data = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if cookie:
+            self.send_header("Set-Cookie", f"X-FILECLOUD={cookie}; path=/")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        endpoint = urlsplit(self.path).path
+        fields = self._form()
+        state = self.server.state
+        state.count(endpoint)
+        if self.server.latency or self.server.jitter:
+            time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+
+        handler = getattr(self, "_" + endpoint.strip("/").replace("/", "_"), None)
+        if handler is None:
+            self._send(_command(endpoint, 0, "Unknown endpoint"), status=404)
+            return
+        if "login" not in endpoint and self._cookie() in state.expired:
+            self._send(_command(endpoint, 0, "Session expired"))
+            return
+        handler(state, fields)
+
+    def _cookie(self) -> str | None:
+        for cookie in self.headers.get("Cookie", "").split(";"):
+            name, _, value = cookie.strip().partition("=")
+            if name == "X-FILECLOUD":
+                return value
+        return None
+
+    def _login(self, state: FakeFileCloudState, fields: Dict, user_field: str):
+        session = uuid.uuid4().hex
+        with state.lock:
+            state.sessions.add(session)
+        ok = fields.get(user_field) == self.server.user
+        body = json.dumps({"command": [{"result": int(ok), "message": ""}]})
+        self._send(body, cookie=session)
+
+    def _core_loginguest(self, state, fields):
+        self._login(state, fields, "userid")
+
+    def _admin_adminlogin(self, state, fields):
+        self._login(state, fields, "adminuser")
+
+    def _admin_getuser(self, state, fields):
+        username = escape(fields.get("username", ""))
+        self._send(f"<users><user><username>{username}</username></user></users>")
+
+    def _core_createfolder(self, state, fields):
+        path = f"{fields.get('path', '').rstrip('/')}/{fields.get('name', '')}"
+        with state.lock:
+            exists = path in state.folders
+            state.folders.add(path)
+        self._send(_command("createfolder", int(not exists)))
+
+    def _core_getfilelist(self, state, fields):
+        with state.lock:
+            paths = sorted(state.files)
+        entries = "".join(
+            f"<entry><path>{escape(path)}</path></entry>" for path in paths
+        )
+        self._send(f"<entries>{entries}</entries>")
+
+    def _core_upload(self, state, fields):
+        filename, data = fields.get("file", ("upload", b""))
+        fullpath = f"{fields.get('path', '').rstrip('/')}/{filename}"
+        offset = int(fields.get("offset", 0) or 0)
+        with state.lock:
+            # Chunks are written at their offset, so a chunk sent twice is written
+            # over itself
+            state.files[fullpath] = offset + len(data)
+        self._send("OK")
+
+    def _core_fileinfo(self, state, fields):
+        with state.lock:
+            size = state.files.get(fields.get("file"))
+        if size is None:
+            self._send(_command("fileinfo", 0, "File not found"))
+            return
+        self._send(
+            f"<entries><entry><path>{escape(fields['file'])}</path>"
+            f"<size>{size}</size></entry></entries>"
+        )
+
+    def _metadata_set_xml(self, name: str, metadata_set: Dict) -> str:
+        attributes = []
+        for index, attribute in enumerate(metadata_set["attributes"]):
+            values = [attribute["id"], attribute["name"], "", "1", "0", "0", ""]
+            attributes.extend(
+                f"<attribute{index}_{field}>{escape(value)}</attribute{index}_{field}>"
+                for field, value in zip(ATTRIBUTE_FIELDS, values)
+            )
+        return (
+            f"<metadataset><id>{metadata_set['id']}</id><name>{escape(name)}</name>"
+            + "".join(attributes)
+            + f"<attributes_total>{len(metadata_set['attributes'])}</attributes_total>"
+            + "</metadataset>"
+        )
+
+    def _core_getavailablemetadatasets(self, state, fields):
+        with state.lock:
+            sets = list(state.metadata_sets.items())
+        self._send(
+            "<metadatasets>"
+            + "".join(self._metadata_set_xml(name, value) for name, value in sets)
+            + "</metadatasets>"
+        )
+
+    def _core_getdefaultmetadatavalues(self, state, fields):
+        with state.lock:
+            sets = [
+                (name, value)
+                for name, value in state.metadata_sets.items()
+                if value["id"] == fields.get("setid")
+            ]
+        # Same fields as getavailablemetadatasets, under <metadatasetvalue>
+        body = "".join(
+            self._metadata_set_xml(name, value).replace(
+                "metadataset>", "metadatasetvalue>"
+            )
+            for name, value in sets
+        )
+        self._send(f"<metadatavalues>{body}</metadatavalues>")
+
+    def _admin_addmetadataset(self, state, fields):
+        total = int(fields.get("attributes_total", 0))
+        attributes = [
+            {"id": uuid.uuid4().hex[:24], "name": fields.get(f"attribute{index}_name")}
+            for index in range(total)
+        ]
+        with state.lock:
+            exists = fields["name"] in state.metadata_sets
+            if not exists:
+                state.metadata_sets[fields["name"]] = {
+                    "id": uuid.uuid4().hex[:24],
+                    "attributes": attributes,
+                }
+        self._send(_command("addmetadataset", int(not exists)))
+
+    def _core_addsettofileobject(self, state, fields):
+        with state.lock:
+            known = fields.get("fullpath") in state.files
+            if known:
+                state.file_sets.setdefault(fields["fullpath"], set()).add(
+                    fields.get("setid")
+                )
+        self._send(_command("addsettofileobject", int(known)))
+
+    def _core_saveattributevalues(self, state, fields):
+        total = int(fields.get("attributes_total", 0))
+        values = {
+            fields.get(f"attribute{index}_attributeid"): fields.get(
+                f"attribute{index}_value", ""
+            )
+            for index in range(total)
+        }
+        with state.lock:
+            known = fields.get("fullpath") in state.files
+            if known:
+                state.metadata_values.setdefault(fields["fullpath"], {}).update(values)
+        self._send(_command("saveattributevalues", int(known)))
+
+    def _core_getmetadatavalues(self, state, fields):
+        with state.lock:
+            values = dict(state.metadata_values.get(fields.get("fullpath"), {}))
+            setids = sorted(state.file_sets.get(fields.get("fullpath"), ()))
+        body = "".join(
+            f"<metadatasetvalue><setid>{escape(setid)}</setid></metadatasetvalue>"
+            for setid in setids
+        ) + "".join(
+            f"<attribute><attributeid>{escape(str(key))}</attributeid>"
+            f"<value>{escape(str(value))}</value></attribute>"
+            for key, value in values.items()
+        )
+        self._send(f"<metadatavalues>{body}</metadatavalues>")
+
+
+class FakeFileCloudServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, user: str, latency: float, jitter: float):
+        super().__init__(address, FakeFileCloudHandler)
+        self.user = user
+        self.latency = latency
+        self.jitter = jitter
+        self.state = FakeFileCloudState()
+
+
+class FakeFileCloud:
+    """Runs a FakeFileCloudServer in a background thread
+
+    Parameters
+    ----------
+        user
+            User name logins succeed with, any password is accepted
+        latency
+            Seconds every request waits before it is answered
+        jitter
+            Up to this many seconds are added to latency at random
+        port
+            Port to listen on, 0 picks a free one
+    """
+
+    def __init__(
+        self,
+        user: str = "test",
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.server = FakeFileCloudServer((host, port), user, latency, jitter)
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def state(self) -> FakeFileCloudState:
+        return self.server.state
+
+    def start(self) -> "FakeFileCloud":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "FakeFileCloud":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--user", type=str, default="test")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    fake = FakeFileCloud(opt.user, opt.latency, opt.jitter, port=opt.port)
+    print(f"Fake FileCloud listening on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.server.server_close()
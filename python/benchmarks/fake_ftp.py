@@ -0,0 +1,132 @@
+"""In-process FTP server serving a local directory, for benchmarking RemoteExtraction
+
+Needs pyftpdlib, see requirements-dev.txt. With a certfile the server speaks
+explicit FTPS like the production server (this also needs pyOpenSSL), without one
+FTPConnectionPool falls back to plain FTP.
+
+    python -m benchmarks.fake_ftp --root /tmp/bench --port 2121
+"""
+
+import argparse
+import os
+import threading
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    DummyAuthorizer = FTPHandler = ThreadedFTPServer = None
+
+
+class ProductionFTPMixin:
+    """Behaves like the production server where pyftpdlib differs from it: `CWD ~`
+    goes to the home folder, which FTPConnectionPool sends after logging in, and
+    NLST of a file answers with its full path, which get_zip_output retrieves"""
+
+    def ftp_CWD(self, path):
+        if os.path.basename(path) == "~":
+            path = os.path.dirname(path)
+        return super().ftp_CWD(path)
+
+    def ftp_NLST(self, path):
+        if not self.fs.isfile(path):
+            return super().ftp_NLST(path)
+        data = self.fs.fs2ftp(path) + "\r\n"
+        self.push_dtp_data(data.encode(self.encoding, self.unicode_errors), cmd="NLST")
+        return path
+
+
+class FakeFTP:
+    """Runs a pyftpdlib server for root in a background thread
+
+    Parameters
+    ----------
+        root
+            Directory served as the home of user
+        user
+            FTP username
+        passwd
+            FTP password
+        port
+            Port to listen on, 0 picks a free one
+        certfile
+            PEM file with the certificate and key, enables explicit FTPS
+    """
+
+    def __init__(
+        self,
+        root: str,
+        user: str = "bench",
+        passwd: str = "bench",
+        host: str = "127.0.0.1",
+        port: int = 0,
+        certfile: str | None = None,
+    ):
+        if ThreadedFTPServer is None:
+            raise ImportError("pyftpdlib is needed for the FTP benchmarks")
+        self.user = user
+        self.passwd = passwd
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(user, passwd, root, perm="elr")
+
+        if certfile:
+            from pyftpdlib.handlers import TLS_FTPHandler
+
+            handler = type("BenchFTPSHandler", (ProductionFTPMixin, TLS_FTPHandler), {})
+            handler.certfile = certfile
+            handler.tls_control_required = True
+            handler.tls_data_required = True
+        else:
+            handler = type("BenchFTPHandler", (ProductionFTPMixin, FTPHandler), {})
+        handler.authorizer = authorizer
+        handler.banner = "benchmark ftp"
+        self.server = ThreadedFTPServer((host, port), handler)
+        self._thread: threading.Thread | None = None
+
+    @property
+    def host(self) -> str:
+        return self.server.address[0]
+
+    @property
+    def port(self) -> int:
+        return self.server.address[1]
+
+    def start(self) -> "FakeFTP":
+        self._thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"timeout": 0.5, "handle_exit": False},
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.close_all()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def __enter__(self) -> "FakeFTP":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, required=True)
+    parser.add_argument("--port", type=int, default=2121)
+    parser.add_argument("--user", type=str, default="bench")
+    parser.add_argument("--passwd", type=str, default="bench")
+    parser.add_argument("--certfile", type=str, default="")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    fake = FakeFTP(
+        opt.root, opt.user, opt.passwd, port=opt.port, certfile=opt.certfile or None
+    )
+    print(f"Fake FTP serving {opt.root} on {fake.host}:{fake.port}")
+    fake.server.serve_forever()
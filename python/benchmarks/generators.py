@@ -0,0 +1,225 @@
+"""Synthetic inputs for the benchmarks, written with the standard library only"""
+
+import io
+import os
+import random
+import zipfile
+from typing import Dict, List
+from xml.sax.saxutils import escape
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>
+{sheets}
+</Types>"""
+ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>{sheets}</sheets>
+</workbook>"""
+WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+{sheets}
+<Relationship Id="rIdStrings" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" Target="sharedStrings.xml"/>
+</Relationships>"""
+
+TEMPLATE_HEADERS = ["Template", "Page", "File name", "Batch", "Document", "Status"]
+SUMMARY_HEADERS = ["Document Type", "Page number", "File name"]
+
+
+def _column(index: int) -> str:
+    name = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(65 + remainder) + name
+    return name
+
+
+class _SharedStrings:
+    def __init__(self):
+        self.strings: Dict[str, int] = {}
+
+    def __call__(self, value: str) -> int:
+        return self.strings.setdefault(value, len(self.strings))
+
+    def xml(self) -> str:
+        items = "".join(f"<si><t>{escape(value)}</t></si>" for value in self.strings)
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            f'count="{len(self.strings)}" uniqueCount="{len(self.strings)}">'
+            f"{items}</sst>"
+        )
+
+
+def _sheet_xml(rows: List[List], shared: _SharedStrings) -> str:
+    xml_rows = []
+    for row_number, row in enumerate(rows, start=1):
+        cells = []
+        for index, value in enumerate(row):
+            ref = f"{_column(index)}{row_number}"
+            if value is None:
+                continue
+            if isinstance(value, str):
+                cells.append(f'<c r="{ref}" t="s"><v>{shared(value)}</v></c>')
+            else:
+                cells.append(f'<c r="{ref}"><v>{value}</v></c>')
+        xml_rows.append(f'<row r="{row_number}">{"".join(cells)}</row>')
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        f'<sheetData>{"".join(xml_rows)}</sheetData></worksheet>'
+    )
+
+
+def pdf_filename(batch: str, index: int) -> str:
+    return f"{batch}.{index:09}.output"
+
+
+def make_kvp_workbook(
+    batch: str = "Batch 000000000000-A-0000000000",
+    documents: int = 1000,
+    templates: int = 4,
+    fields: int = 10,
+) -> bytes:
+    """Builds a Batch KVP Spreadsheet.xlsx: a summary sheet followed by one sheet
+    per template, with one row per document page and `fields` key value pairs"""
+    shared = _SharedStrings()
+    summary = [SUMMARY_HEADERS]
+    template_rows: Dict[str, List[List]] = {}
+    for template in range(templates):
+        headers = list(TEMPLATE_HEADERS)
+        for field in range(fields):
+            headers.extend([f"Field {template}-{field}", "Confidence"])
+        template_rows[f"Template {template}"] = [headers]
+
+    for document in range(documents):
+        template = f"Template {document % templates}"
+        filename = pdf_filename(batch, document)
+        page = document // templates + 1
+        summary.append([template, page, filename])
+        row = [template, page, filename, batch, f"Document {document}", "Done"]
+        for field in range(fields):
+            row.extend([f"value {document}-{field}", 0.95])
+        template_rows[template].append(row)
+
+    sheets = [("Summary", summary)] + list(template_rows.items())
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as xlsx:
+        sheet_xml = [_sheet_xml(rows, shared) for _, rows in sheets]
+        xlsx.writestr(
+            "[Content_Types].xml",
+            CONTENT_TYPES.format(
+                sheets="".join(
+                    f'<Override PartName="/xl/worksheets/sheet{index}.xml" '
+                    'ContentType="application/vnd.openxmlformats-officedocument.'
+                    'spreadsheetml.worksheet+xml"/>'
+                    for index in range(1, len(sheets) + 1)
+                )
+            ),
+        )
+        xlsx.writestr("_rels/.rels", ROOT_RELS)
+        xlsx.writestr(
+            "xl/workbook.xml",
+            WORKBOOK.format(
+                sheets="".join(
+                    f'<sheet name="{escape(name)}" sheetId="{index}" r:id="rId{index}"/>'
+                    for index, (name, _) in enumerate(sheets, start=1)
+                )
+            ),
+        )
+        xlsx.writestr(
+            "xl/_rels/workbook.xml.rels",
+            WORKBOOK_RELS.format(
+                sheets="".join(
+                    f'<Relationship Id="rId{index}" '
+                    'Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+                    f'relationships/worksheet" Target="worksheets/sheet{index}.xml"/>'
+                    for index in range(1, len(sheets) + 1)
+                )
+            ),
+        )
+        for index, xml in enumerate(sheet_xml, start=1):
+            xlsx.writestr(f"xl/worksheets/sheet{index}.xml", xml)
+        xlsx.writestr("xl/sharedStrings.xml", shared.xml())
+
+    return buffer.getvalue()
+
+
+def make_job_zip(
+    batch: str = "Batch 000000000000-A-0000000000",
+    documents: int = 1000,
+    other_members: int = 0,
+    workbook_documents: int | None = None,
+    pdf_data: bytes = b"%PDF-1.4\n%%EOF\n",
+) -> bytes:
+    """Builds a job zip laid out like the Skriba output: the Batch KVP Spreadsheet,
+    one Searchable PDF per document and `other_members` unrelated files. The
+    spreadsheet holds workbook_documents rows, all documents when None"""
+    if workbook_documents is None:
+        workbook_documents = documents
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as job_zip:
+        job_zip.writestr(
+            f"{batch}/KVP Excel File/{batch} Batch KVP Spreadsheet.xlsx",
+            make_kvp_workbook(batch, documents=workbook_documents),
+        )
+        for document in range(documents):
+            job_zip.writestr(
+                f"{batch}/Searchable PDF/"
+                f"{pdf_filename(batch, document)} - Searchable PDF.pdf",
+                pdf_data,
+            )
+        for index in range(other_members):
+            job_zip.writestr(f"{batch}/Images/{pdf_filename(batch, index)}.tif", b"")
+
+    return buffer.getvalue()
+
+
+def pdf_bytes(size: int, seed: int = 0) -> bytes:
+    """Incompressible stand-in for a Searchable PDF of about size bytes"""
+    header = b"%PDF-1.4\n"
+    trailer = b"\n%%EOF\n"
+    filler = random.Random(seed).randbytes(max(size - len(header) - len(trailer), 0))
+    return header + filler + trailer
+
+
+def write_contract(
+    root: str,
+    contract: str = "Contract",
+    jobs: int = 2,
+    batches: int = 2,
+    documents: int = 100,
+    pdf_size: int = 4096,
+    output_folder: str = "output",
+) -> List[str]:
+    """Writes <root>/<contract>/Job <n>/<output_folder>/Batch <n>.zip job zips, the
+    layout DirectoryParser walks. LocalExtraction looks for "output" folders and
+    RemoteExtraction for "Output" ones
+
+    Returns
+    -------
+        List[str]
+            Paths of the zips written
+    """
+    pdf_data = pdf_bytes(pdf_size)
+    paths = []
+    for job in range(jobs):
+        folder = os.path.join(root, contract, f"Job {job:04}", output_folder)
+        os.makedirs(folder, exist_ok=True)
+        for batch in range(batches):
+            batch_name = f"Batch {job:04}-{batch:04}"
+            path = os.path.join(folder, f"{batch_name}.zip")
+            with open(path, "wb") as f:
+                f.write(make_job_zip(batch_name, documents, pdf_data=pdf_data))
+            paths.append(path)
+
+    return paths
@@ -0,0 +1,672 @@
+import asyncio
+import io
+import json
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Tuple
+
+from .file_cloud_controller import (
+    FileCloudBase,
+    group_metadata_sets,
+    text_succeeded,
+)
+from .metrics import metrics
+from .request_layer import RETRYABLE_STATUSES
+from .utils import bcolors
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:  # Only needed for the asyncio client
+    aiohttp = None
+
+
+class AsyncFileCloudController(FileCloudBase):
+    """asyncio version of FileCloudController, built on aiohttp.
+
+    Both sessions share one connector, so connections are kept alive and reused by
+    every request and the number of open connections is capped by `limit`. Cookies
+    are kept by the sessions' cookie jars. Use it as an async context manager, or
+    call open() and close() inside a running event loop.
+
+    Takes the same keyword arguments as FileCloudController, plus
+
+    Parameters
+    ----------
+        limit
+            Maximum number of simultaneous connections to the server
+        keepalive_timeout
+            Seconds an idle connection is kept open
+    """
+
+    def __init__(
+        self,
+        server_url,
+        user,
+        passwd,
+        limit: int = 100,
+        keepalive_timeout: float = 30.0,
+        **kwargs,
+    ):
+        if aiohttp is None:
+            raise ImportError("AsyncFileCloudController requires aiohttp")
+        super().__init__(server_url, user, passwd, **kwargs)
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.session: "aiohttp.ClientSession | None" = None
+        self.admin_session: "aiohttp.ClientSession | None" = None
+        self._connector: "aiohttp.TCPConnector | None" = None
+        self._folder_locks: Dict[str, asyncio.Lock] = {}
+        self._metadata_locks: Dict[str, asyncio.Lock] = {}
+        self._verifications: List[asyncio.Task] = []
+        # Logins per session kind, see _relogin
+        self._login_lock = asyncio.Lock()
+        self._login_generations: Dict[str, int] = {}
+
+    async def open(self):
+        self._connector = aiohttp.TCPConnector(
+            limit=self.limit, keepalive_timeout=self.keepalive_timeout
+        )
+        # The default cookie jar drops the cookies of servers addressed by IP
+        self.session = aiohttp.ClientSession(
+            connector=self._connector,
+            connector_owner=False,
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+        )
+        self.admin_session = aiohttp.ClientSession(
+            connector=self._connector,
+            connector_owner=False,
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+        )
+
+    def use_cookies(self, cookies: Dict[str, str], admin_cookies: Dict[str, str]):
+        """Starts both sessions with the cookies of sessions that already logged in,
+        e.g. those of a FileCloudController, instead of logging in again. A session
+        the server ended still logs in again on its first request"""
+        url = URL(self.server_url)
+        self.session.cookie_jar.update_cookies(cookies, response_url=url)
+        self.admin_session.cookie_jar.update_cookies(admin_cookies, response_url=url)
+
+    async def close(self):
+        for session in (self.session, self.admin_session):
+            if session is not None:
+                await session.close()
+        if self._connector is not None:
+            await self._connector.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _request(
+        self,
+        session: "aiohttp.ClientSession",
+        endpoint: str,
+        relogin: bool = True,
+        idempotent: bool | None = None,
+        **kwargs,
+    ) -> Tuple[int, str]:
+        """Posts to an endpoint and returns the status and text of the response.
+
+        Goes through the rate limiter, backoff and counters of request_layer like
+        FileCloudController._post, and only retries idempotent requests like it.
+        Multipart bodies are consumed when sent, so a FormData is not sent again.
+        Pass a function or coroutine function returning a new FormData as data
+        instead to have it built again for every attempt
+        """
+        layer = self.request_layer
+        stats = layer.stats(endpoint)
+        data = kwargs.pop("data", None)
+        resendable = not isinstance(data, aiohttp.FormData)
+        if idempotent is None:
+            idempotent = layer.idempotent(endpoint)
+        max_retries = layer.max_retries if idempotent and resendable else 0
+        relogged = not relogin
+        generation = self._login_generations.get(self._session_kind(session), 0)
+
+        attempt = 0
+        while True:
+            if layer.bucket:
+                await asyncio.sleep(layer.bucket.reserve())
+            body = data() if callable(data) else data
+            if asyncio.iscoroutine(body):
+                body = await body
+            tic = time.perf_counter()
+            try:
+                async with session.post(
+                    self.server_url + endpoint, data=body, **kwargs
+                ) as response:
+                    status, text = response.status, await response.text()
+                    retry_after = response.headers.get("Retry-After")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                stats.record(time.perf_counter() - tic, error=True)
+                layer.observe(endpoint, time.perf_counter() - tic, type(e).__name__)
+                if attempt >= max_retries:
+                    raise
+                reason, retry_after = type(e).__name__, None
+            else:
+                stats.record(time.perf_counter() - tic, error=status >= 400)
+                layer.observe(endpoint, time.perf_counter() - tic, status)
+                if not relogged and layer.session_expired(status, text):
+                    relogged = True
+                    stats.count("relogins")
+                    await self._relogin(session, generation)
+                    if resendable:
+                        continue
+                    return status, text
+                if status not in RETRYABLE_STATUSES or attempt >= max_retries:
+                    return status, text
+                reason = f"HTTP {status}"
+
+            attempt += 1
+            await asyncio.sleep(
+                layer.count_retry(endpoint, attempt, reason, retry_after)
+            )
+
+    async def _request_checked(
+        self,
+        session: "aiohttp.ClientSession",
+        endpoint: str,
+        succeeded: Callable[[str], bool],
+        applied: Callable[[], Awaitable[bool]],
+        **kwargs,
+    ) -> Tuple[bool, str | None]:
+        """Posts a request that is not idempotent and returns whether it took effect
+        and the text of the last response, see RequestLayer.post_checked"""
+        layer = self.request_layer
+        if isinstance(kwargs.get("data"), aiohttp.FormData):
+            max_retries = 0
+        else:
+            max_retries = layer.max_retries
+
+        attempt = 0
+        while True:
+            try:
+                status, text = await self._request(
+                    session, endpoint, idempotent=False, **kwargs
+                )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                text, error, reason = None, e, type(e).__name__
+            else:
+                if succeeded(text):
+                    return True, text
+                if status not in RETRYABLE_STATUSES:
+                    return False, text
+                error, reason = None, f"HTTP {status}"
+
+            if await applied():
+                print(
+                    bcolors.WARNING
+                    + f"{endpoint} failed ({reason}) but went through"
+                    + bcolors.ENDC
+                )
+                return True, text
+            if attempt >= max_retries:
+                if error is not None:
+                    raise error
+                return False, text
+
+            attempt += 1
+            await asyncio.sleep(layer.count_retry(endpoint, attempt, reason))
+
+    def _session_kind(self, session: "aiohttp.ClientSession") -> str:
+        return "admin" if session is self.admin_session else "core"
+
+    async def _relogin(self, session: "aiohttp.ClientSession", generation: int):
+        """Logs session in again after a request sent when it had logged in
+        generation times found it expired. Requests that expired together log in
+        once between them"""
+        kind = self._session_kind(session)
+        async with self._login_lock:
+            if self._login_generations.get(kind, 0) != generation:
+                return
+            if kind == "admin":
+                await self.admin_login()
+            else:
+                await self.login()
+
+    def _logged_in(self, session: "aiohttp.ClientSession"):
+        print(bcolors.OKCYAN + f"Login Succeeded!" + bcolors.ENDC)
+        kind = self._session_kind(session)
+        self._login_generations[kind] = self._login_generations.get(kind, 0) + 1
+
+    async def _post(self, session: "aiohttp.ClientSession", endpoint: str, **kwargs):
+        """Posts to an endpoint and returns the response text"""
+        return (await self._request(session, endpoint, **kwargs))[1]
+
+    @staticmethod
+    def _login_succeeded(text: str) -> bool:
+        try:
+            login_call = json.loads(text)
+        except json.JSONDecodeError:
+            return text_succeeded(text)
+        if login_call["command"][0]["result"] == 1:
+            return True
+        raise ValueError(login_call["command"][0]["message"])
+
+    async def admin_login(self):
+        """Connects to File Cloud server as admin"""
+        print(
+            bcolors.OKCYAN + f"Logging into FileCloud Server (admin)..." + bcolors.ENDC
+        )
+        text = await self._post(
+            self.admin_session,
+            "/admin/adminlogin",
+            relogin=False,
+            data={"adminuser": self.user, "adminpassword": self.passwd},
+            headers={"Accept": "application/json"},
+        )
+        if self._login_succeeded(text):
+            self._logged_in(self.admin_session)
+        else:
+            print(bcolors.FAIL + f"Login Failed" + bcolors.ENDC)
+
+    async def login(self):
+        """Connects to File Cloud server"""
+        print(
+            bcolors.OKCYAN + f"Logging into FileCloud Server (core)..." + bcolors.ENDC,
+        )
+        text = await self._post(
+            self.session,
+            "/core/loginguest",
+            relogin=False,
+            data={"userid": self.user, "password": self.passwd},
+            headers={"Accept": "application/json", "User-agent": "Mozilla/5.0"},
+        )
+        if self._login_succeeded(text):
+            self._logged_in(self.session)
+        else:
+            print(bcolors.FAIL + f"Login Failed" + bcolors.ENDC)
+
+    async def ensure_folder(self, folder_name: str) -> str:
+        """Creates a Skriba folder unless it is already known to exist. Concurrent
+        calls for the same folder send createfolder only once
+
+        Returns
+        -------
+            str
+                Filecloud path of the folder
+        """
+        filecloud_path = f"{self.skriba_path}/{folder_name}"
+        lock = self._folder_locks.setdefault(filecloud_path, asyncio.Lock())
+        async with lock:
+            if filecloud_path in self.folder_cache:
+                return filecloud_path
+            status, text = await self._request(
+                self.session,
+                "/core/createfolder",
+                params=self._create_folder_params(self.skriba_path, folder_name),
+            )
+            print(text)
+            if status < 400:
+                self.folder_cache.add(filecloud_path)
+
+        return filecloud_path
+
+    async def prepare_folders(self, folder_names) -> List[str]:
+        """Creates every folder of a job up front so uploads do not have to"""
+        return await asyncio.gather(
+            *(self.ensure_folder(name) for name in dict.fromkeys(folder_names))
+        )
+
+    async def _create_metadata(self, path, metadata_name, kvp: Dict) -> bool:
+        """Creates a metadata set, see FileCloudController._create_metadata"""
+
+        async def applied() -> bool:
+            return bool(await self._get_available_metadata(path, metadata_name))
+
+        created, text = await self._request_checked(
+            self.admin_session,
+            "/admin/addmetadataset",
+            succeeded=text_succeeded,
+            applied=applied,
+            data=self._create_metadata_data(metadata_name, kvp),
+        )
+        if text is not None:
+            print(text)
+        return created
+
+    async def _get_available_metadata(self, path, metadata_set) -> Dict:
+        text = await self._post(
+            self.session,
+            "/core/getavailablemetadatasets",
+            params={"fullpath": path},
+        )
+        return self._parse_available_metadata(text, metadata_set)
+
+    async def _get_metadata_set(
+        self, path: str, metadata_set_name: str, kvp: Dict
+    ) -> Dict:
+        """Gets the ids of a metadata set from the cache, or from FileCloud, creating
+        the set first if it does not exist yet. One lookup runs per set name"""
+        available_metadata = self.metadata_cache.get(metadata_set_name)
+        if available_metadata is not None:
+            return available_metadata
+
+        lock = self._metadata_locks.setdefault(metadata_set_name, asyncio.Lock())
+        async with lock:
+            available_metadata = self.metadata_cache.get(metadata_set_name)
+            if available_metadata is not None:
+                return available_metadata
+
+            available_metadata = await self._get_available_metadata(
+                path, metadata_set_name
+            )
+            if not available_metadata:
+                await self._create_metadata(path, metadata_set_name, kvp)
+                available_metadata = await self._get_available_metadata(
+                    path, metadata_set_name
+                )
+            if available_metadata:
+                self.metadata_cache.put(metadata_set_name, available_metadata)
+
+        return available_metadata
+
+    async def _verify_metadata(self, metadata_set_name: str, data: Dict) -> Dict:
+        """Reads the metadata of a file back and lists the attribute values that
+        are not found in the response"""
+        result = {
+            "fullpath": data["fullpath"],
+            "set": metadata_set_name,
+            "verified": False,
+            "missing": [],
+            "error": None,
+        }
+        try:
+            text = await self._read_metadata_values(data["fullpath"])
+            result["missing"] = self._missing_values(data, text)
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            return result
+
+        result["verified"] = not result["missing"]
+        return result
+
+    async def _read_metadata_values(self, fullpath: str) -> str:
+        return await self._post(
+            self.session, "/core/getmetadatavalues", data={"fullpath": fullpath}
+        )
+
+    async def _remote_size(self, fullpath: str) -> int | None:
+        """Size of a file in FileCloud, None if it is not there"""
+        text = await self._post(
+            self.session, "/core/fileinfo", params={"file": fullpath}
+        )
+        return self._parse_file_size(text)
+
+    async def _uploaded(self, fullpath: str, file_data, start: int) -> bool:
+        """See FileCloudController._uploaded"""
+        size = await self._remote_size(fullpath)
+        if size is None:
+            return False
+
+        def end() -> int:
+            position = file_data.tell()
+            end = file_data.seek(0, io.SEEK_END)
+            file_data.seek(position)
+            return end
+
+        try:
+            return size == await asyncio.to_thread(end) - start
+        except (AttributeError, OSError, ValueError):
+            return False
+
+    async def verification_results(self) -> List[Dict]:
+        """Waits for the scheduled read-back checks and returns their results"""
+        results = await asyncio.gather(*self._verifications)
+        self._verifications = []
+        return list(results)
+
+    async def _add_metadata(self, path: str, filename: str, kvp) -> Dict:
+        """Adds Metadata to a file, see FileCloudController._add_metadata"""
+        metadata_set_name = self._metadata_set_name(kvp)
+        result = {
+            "fullpath": path + "/" + filename,
+            "set": metadata_set_name,
+            "applied": False,
+            "attempts": 0,
+            "responses": None,
+        }
+        for attempt in range(2):
+            result["attempts"] = attempt + 1
+            available_metadata = await self._get_metadata_set(
+                path, metadata_set_name, kvp
+            )
+            data = self._metadata_params(path + "/" + filename, kvp, available_metadata)
+
+            async def set_added() -> bool:
+                text = await self._read_metadata_values(data["fullpath"])
+                return self._has_set(text, data["setid"])
+
+            async def values_saved() -> bool:
+                text = await self._read_metadata_values(data["fullpath"])
+                return not self._missing_values(data, text)
+
+            addset_applied, addset_text = await self._request_checked(
+                self.session,
+                "/core/addsettofileobject",
+                succeeded=text_succeeded,
+                applied=set_added,
+                params=self._set_metadata_params(data["fullpath"], data["setid"]),
+            )
+            saveattribute_applied, saveattribute_text = await self._request_checked(
+                self.session,
+                "/core/saveattributevalues",
+                succeeded=text_succeeded,
+                applied=values_saved,
+                data={key: str(value) for key, value in data.items()},
+            )
+            if addset_applied and saveattribute_applied:
+                result["applied"] = True
+                if self._should_verify(data["fullpath"]):
+                    self._verifications.append(
+                        asyncio.create_task(
+                            self._verify_metadata(metadata_set_name, data)
+                        )
+                    )
+                return result
+
+            result["responses"] = [addset_text, saveattribute_text]
+            # The cached ids may be stale, look the set up again once
+            self.metadata_cache.invalidate(metadata_set_name)
+
+        return result
+
+    @staticmethod
+    def _chunk_form(filename: str, chunk) -> "aiohttp.FormData":
+        """Multipart body of an upload of chunk, bytes or a file object. The
+        filename is sent as is, aiohttp would percent-encode it by default"""
+        form = aiohttp.FormData(quote_fields=False)
+        form.add_field("file", chunk, filename=filename)
+        return form
+
+    async def _upload_chunked(self, path: str, filename: str, file_data) -> bool:
+        """Chunked upload, see FileCloudController._upload_chunked. Chunks are read
+        in a worker thread so decompressing them does not block the event loop"""
+        key = f"{path}/{filename}"
+        offset = self.offset_cache.get(key)
+        if offset and await self._remote_size(key) != offset:
+            self._stale_offset(key, filename)
+            offset = 0
+        if offset:
+            await asyncio.to_thread(file_data.seek, offset)
+
+        chunk = await asyncio.to_thread(file_data.read, self.chunk_size)
+        while True:
+            next_chunk = await asyncio.to_thread(file_data.read, self.chunk_size)
+            complete = not next_chunk
+            params = self._create_upload_api_params(path, filename, offset, complete)
+            try:
+                if complete:
+
+                    async def applied() -> bool:
+                        return await self._remote_size(key) == offset + len(chunk)
+
+                    done, text = await self._request_checked(
+                        self.session,
+                        "/core/upload",
+                        succeeded=lambda text: text == "OK",
+                        applied=applied,
+                        params=params,
+                        data=lambda: self._chunk_form(filename, chunk),
+                    )
+                else:
+                    text = await self._post(
+                        self.session,
+                        "/core/upload",
+                        idempotent=True,
+                        params=params,
+                        data=lambda: self._chunk_form(filename, chunk),
+                    )
+                    done = text == "OK"
+                error = None if done else text
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = f"{type(e).__name__}: {e}"
+            if error is not None:
+                print(
+                    bcolors.WARNING
+                    + f"Chunk at byte {offset} of {filename} failed: {error}"
+                    + bcolors.ENDC
+                )
+                self.offset_cache.put(key, offset)
+                return False
+
+            offset += len(chunk)
+            if complete:
+                break
+            chunk = next_chunk
+
+        self.offset_cache.discard(key)
+        return True
+
+    async def upload_file(
+        self,
+        filename,
+        file_data,
+        kvp: List[Dict] | None,
+        is_failed: bool = False,
+    ) -> bool:
+        """Upload file to Filecloud and add metadata based on KVP, see
+        FileCloudController.upload_file"""
+        folder_name = self.folder_name(file_data, is_failed)
+
+        filecloud_path = await self.ensure_folder(folder_name)
+
+        # The member is inflated while it is sent, its reads are timed on their own
+        file_data = metrics.reader(file_data, "zip_inflate")
+
+        if self.chunk_size:
+            uploaded = await self._upload_chunked(filecloud_path, filename, file_data)
+        else:
+            fullpath = f"{filecloud_path}/{filename}"
+            start = file_data.tell()
+
+            async def form() -> "aiohttp.FormData":
+                # Seeking a remote zip member may read from the FTP server. aiohttp
+                # reads file objects in a worker thread while streaming them
+                await asyncio.to_thread(file_data.seek, start)
+                return self._chunk_form(filename, file_data)
+
+            uploaded, text = await self._request_checked(
+                self.session,
+                "/core/upload",
+                succeeded=lambda text: text == "OK",
+                applied=lambda: self._uploaded(fullpath, file_data, start),
+                params=self._create_upload_api_params(filecloud_path, filename),
+                data=form,
+            )
+            if not uploaded and text is not None:
+                print(text)
+
+        if not uploaded:
+            print(
+                bcolors.FAIL
+                + f"Something went wrong with uploading {filename}"
+                + bcolors.ENDC
+            )
+            self.folder_cache.discard(filecloud_path)
+            return False
+
+        print(
+            bcolors.OKGREEN
+            + f"Successfuly uploaded {filename} to Filecloud at {filecloud_path}"
+            + bcolors.ENDC
+        )
+        # Rows of the same set are merged first, so the sets saved concurrently are
+        # independent of each other
+        metadata_sets = group_metadata_sets(kvp or [], self.merge_policy)
+        for metadata_result in await asyncio.gather(
+            *(
+                self._add_metadata(filecloud_path, filename, _kvp)
+                for _kvp in metadata_sets.values()
+            )
+        ):
+            if not metadata_result["applied"]:
+                print(
+                    bcolors.FAIL
+                    + f"Could not add {metadata_result['set']} to {filename}"
+                    + bcolors.ENDC
+                )
+        return True
+
+    async def upload_tasks(self, tasks: Iterable[Dict], max_in_flight: int = 100):
+        """Uploads tasks (see upload_pipeline.tasks_from_kvp) with at most
+        max_in_flight uploads running at once. tasks is consumed lazily, in a worker
+        thread since producing a task may mean downloading and parsing a zip
+
+        Returns
+        -------
+            List[Dict]
+                job, filename, uploaded, bytes, seconds and error of every task, in
+                the order of tasks
+        """
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def upload(task: Dict) -> Dict:
+            result = {
+                "job": task["job"],
+                "filename": task["filename"],
+                "uploaded": False,
+                "bytes": 0,
+                "seconds": 0.0,
+                "error": None,
+            }
+            tic = time.perf_counter()
+            try:
+                with metrics.context(
+                    job=task["job"], filename=task["filename"]
+                ), metrics.span("upload"):
+                    result["uploaded"] = await self.upload_file(
+                        task["filename"],
+                        task["file_data"],
+                        task["kvp"],
+                        is_failed=task["is_failed"],
+                    )
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+            finally:
+                semaphore.release()
+            result["seconds"] = time.perf_counter() - tic
+            try:
+                result["bytes"] = task["file_data"].tell()
+            except (AttributeError, OSError, ValueError):
+                pass
+            return result
+
+        uploads = []
+        iterator = iter(tasks)
+        while True:
+            await semaphore.acquire()
+            task = await asyncio.to_thread(next, iterator, None)
+            if task is None:
+                semaphore.release()
+                break
+            # Folders of a job are created before its first upload is started
+            await self.ensure_folder(
+                self.folder_name(task["file_data"], task["is_failed"])
+            )
+            uploads.append(asyncio.create_task(upload(task)))
+
+        return list(await asyncio.gather(*uploads))
@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List
+
+from .ftp_walker import WalkEntry
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    contract TEXT NOT NULL,
+    path TEXT NOT NULL,
+    modify TEXT,
+    PRIMARY KEY (contract, path)
+);
+CREATE TABLE IF NOT EXISTS zips (
+    contract TEXT NOT NULL,
+    path TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    modify TEXT,
+    processed INTEGER NOT NULL DEFAULT 0,
+    processed_at REAL,
+    PRIMARY KEY (contract, path)
+);
+CREATE INDEX IF NOT EXISTS zips_dir ON zips (contract, dir);
+"""
+
+
+def _parent(path: str) -> str:
+    return path[: max(path.rfind("/"), path.rfind(os.sep), 0)]
+
+
+class DirectoryIndex:
+    """On-disk index of the job zips found below each contract.
+
+    The index remembers the modify time of every directory that was listed and the
+    size, modify time and processed state of every zip. Creating or removing an
+    entry updates the modify time of the directory holding it, but not of the
+    directories above, so on a rescan only leaf directories (job folders without
+    subfolders) whose modify time is unchanged are skipped and their zips taken
+    from the index. Zips rewritten in place keep their folder's modify time, use
+    full_rescan to relist everything.
+
+    Zips are handed back for processing only while they are new, changed or not
+    yet marked processed, so a zip is never uploaded twice.
+
+    Parameters
+    ----------
+        db_path
+            Path of the SQLite database file
+        full_rescan
+            Ignore directory modify times and list every directory
+    """
+
+    def __init__(self, db_path: str, full_rescan: bool = False):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self.full_rescan = full_rescan
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def cached_files(
+        self,
+        contract: str,
+        dir_entry: WalkEntry,
+    ) -> List[WalkEntry] | None:
+        """Zips in dir_entry if it is a leaf directory that did not change since it
+        was last listed, None if it has to be listed"""
+        if self.full_rescan or not dir_entry.modify:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT modify FROM dirs WHERE contract = ? AND path = ?",
+                (contract, dir_entry.path),
+            ).fetchone()
+            if not row or row[0] != dir_entry.modify:
+                return None
+            prefix = dir_entry.path.rstrip("/") + "/"
+            subdir = self._conn.execute(
+                "SELECT 1 FROM dirs WHERE contract = ? AND path >= ? AND path < ? "
+                "LIMIT 1",
+                (contract, prefix, prefix + "\uffff"),
+            ).fetchone()
+            if subdir:
+                return None
+            rows = self._conn.execute(
+                "SELECT path, name, size, modify FROM zips "
+                "WHERE contract = ? AND path >= ? AND path < ? ORDER BY path",
+                (contract, prefix, prefix + "\uffff"),
+            ).fetchall()
+
+        return [
+            WalkEntry(path, name, "file", size, modify)
+            for path, name, size, modify in rows
+        ]
+
+    def record_walk(
+        self,
+        contract: str,
+        files: Iterable[WalkEntry],
+        listed_dirs: Iterable[WalkEntry],
+    ):
+        """Stores the result of a walk. Zips that disappeared from a listed directory
+        are dropped, zips whose size or modify time changed are processed again"""
+        files = list(files)
+        listed_dirs = list(listed_dirs)
+        with self._lock, self._conn:
+            for dir_entry in listed_dirs:
+                present = [
+                    entry.path
+                    for entry in files
+                    if _parent(entry.path) == dir_entry.path
+                ]
+                self._conn.execute(
+                    f"DELETE FROM zips WHERE contract = ? AND dir = ? "
+                    f"AND path NOT IN ({','.join('?' * len(present))})",
+                    (contract, dir_entry.path, *present),
+                )
+                self._conn.execute(
+                    "INSERT INTO dirs (contract, path, modify) VALUES (?, ?, ?) "
+                    "ON CONFLICT (contract, path) "
+                    "DO UPDATE SET modify = excluded.modify",
+                    (contract, dir_entry.path, dir_entry.modify),
+                )
+
+            self._conn.executemany(
+                "INSERT INTO zips (contract, path, dir, name, size, modify) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (contract, path) DO UPDATE SET "
+                "size = excluded.size, modify = excluded.modify, "
+                "processed = CASE WHEN zips.size IS excluded.size "
+                "AND zips.modify IS excluded.modify THEN zips.processed ELSE 0 END",
+                [
+                    (
+                        contract,
+                        entry.path,
+                        _parent(entry.path),
+                        entry.name,
+                        entry.size,
+                        entry.modify,
+                    )
+                    for entry in files
+                ],
+            )
+
+    def pending(self, contract: str, files: Iterable[WalkEntry]) -> List[WalkEntry]:
+        """Files that are not yet marked processed, in the order given"""
+        with self._lock:
+            processed = {
+                path
+                for (path,) in self._conn.execute(
+                    "SELECT path FROM zips WHERE contract = ? AND processed = 1",
+                    (contract,),
+                )
+            }
+
+        return [entry for entry in files if entry.path not in processed]
+
+    def mark_processed(self, contract: str, entry: WalkEntry):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO zips "
+                "(contract, path, dir, name, size, modify, processed, processed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (contract, path) DO UPDATE SET processed = 1, "
+                "processed_at = excluded.processed_at",
+                (
+                    contract,
+                    entry.path,
+                    _parent(entry.path),
+                    entry.name,
+                    entry.size,
+                    entry.modify,
+                    time.time(),
+                ),
+            )
+
+    def close(self):
+        self._conn.close()
@@ -3,14 +3,29 @@ import io
 import os
 import platform
 import re
+import tempfile
+import time
 import zipfile
 from abc import ABC, abstractmethod
-from typing import Dict, List, Tuple
-
-import pandas as pd
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Tuple
 
 from .config import *
+from .ftp_pool import FTPConnectionPool
+from .ftp_stream import FTPRangeFile, ZipMode
+from .ftp_walker import FTPWalker, WalkEntry
+from .kvp_reader import KVPSpreadsheet
+from .metrics import metrics
+from .records import Document, Job
+from .upload_pipeline import tasks_from_kvp
 from .utils import bcolors, timerdecorator
+from .zip_manifest import ZipManifest, group_by_filename
+
+if TYPE_CHECKING:
+    # Both import sqlite3, which a run that keeps no index or queue does not need
+    from .directory_index import DirectoryIndex
+    from .upload_queue import UploadQueue
 
 system = platform.system()
 MOCK_FTP = (
@@ -20,22 +35,12 @@ MOCK_FTP = (
 )
 
 
-# Needed to connect to new FTP server
-class MyFTP_TLS(ftplib.FTP_TLS):
-    """Explicit FTPS, with shared TLS session"""
-
-    def ntransfercmd(self, cmd, rest=None):
-        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
-        if self._prot_p:
-            conn = self.context.wrap_socket(
-                conn, server_hostname=self.host, session=self.sock.session
-            )  # this is the fix
-        return conn, size
-
-
 class ExtractionStrategy(ABC):
     """Strategy for extracting zipfile from FTP server"""
 
+    # Number of zips DirectoryParser may fetch at the same time
+    parallel_downloads = 1
+
     @abstractmethod
     def _get_output_folders(
         self,
@@ -56,68 +61,86 @@ class ExtractionStrategy(ABC):
     def get_zip_files(self, output_dir: str) -> List[str]:
         pass
 
+    @abstractmethod
+    def scan_zip_entries(
+        self,
+        output_dir: str,
+        cached: Callable[[WalkEntry], List[WalkEntry] | None] | None = None,
+    ) -> Tuple[List[WalkEntry], List[WalkEntry]]:
+        """Zip files below output_dir, and the directories listed to find them.
+        Directories for which cached returns a list are not listed, the returned
+        files are used instead"""
+        pass
 
-class RemoteExtraction(ExtractionStrategy):
-    def __init__(self, server, user, passwd):
-        try:
-            self.ftp = MyFTP_TLS()
-            """
-            self.ftp.connect(os.environ["FTP_SERVER"], port=21)
-            self.ftp.login(user=os.environ["FTP_USER"], passwd=os.environ["FTP_PASS"])
-            """
-            # self.ftp.set_debuglevel(2)
-            self.ftp.connect(server, port=21)
-            self.ftp.login(user=user, passwd=passwd)
-            self.ftp.prot_p()
-            self.ftp.cwd("~")
-
-            self.ftp.encoding = "utf-8"
-        except ftplib.error_perm as e:
-            self.ftp = ftplib.FTP()
-            """
-            self.ftp.connect(os.environ["FTP_SERVER"], port=21)
-            self.ftp.login(user=os.environ["FTP_USER"], passwd=os.environ["FTP_PASS"])
-            """
-            # self.ftp.set_debuglevel(2)
-            self.ftp.connect(server, port=21)
-            self.ftp.login(user=user, passwd=passwd)
-            self.ftp.cwd("~")
+    def get_zip_entries(self, output_dir: str) -> List[WalkEntry]:
+        """Zip files below output_dir, with their size and modify time"""
+        return self.scan_zip_entries(output_dir)[0]
 
-            self.ftp.encoding = "utf-8"
+
+class RemoteExtraction(ExtractionStrategy):
+    def __init__(
+        self,
+        server,
+        user,
+        passwd,
+        zip_mode: ZipMode = ZipMode.MEMORY,
+        spool_max_size: int = 64 * 1024 * 1024,
+        pool_size: int = 4,
+        port: int = 21,
+    ):
+        """
+        Parameters
+        ----------
+            zip_mode
+                MEMORY downloads whole zips into memory, SPOOL into a temporary file
+                that keeps at most spool_max_size bytes in memory, RANGE only fetches
+                the parts of the zip that are read
+            spool_max_size
+                In-memory cap of the spooled temporary file in SPOOL mode
+            pool_size
+                Number of FTP connections used to list and download in parallel
+            port
+                FTP server port
+        """
+        self.zip_mode = ZipMode(zip_mode)
+        self.spool_max_size = spool_max_size
+        self.parallel_downloads = pool_size
+        self.pool = FTPConnectionPool(server, user, passwd, size=pool_size, port=port)
+        self.walker = FTPWalker(self.pool)
+        # Entries seen while walking, so their type does not have to be guessed
+        self._entries: Dict[str, WalkEntry] = {}
+        # Logs in the first connection right away so bad credentials fail early
+        self.pool.run(lambda ftp: ftp.pwd())
+
+    def close(self):
+        """Closes the idle FTP connections"""
+        self.pool.close()
+
+    def _nlst(self, *args) -> List[str]:
+        return self.pool.run(lambda ftp: ftp.nlst(*args))
+
+    def _retrieve(self, path: str, stream):
+        def retr(ftp):
+            # A retried transfer starts over
+            stream.seek(0)
+            stream.truncate()
+            ftp.retrbinary(f"RETR {path}", stream.write)
+
+        with metrics.span("ftp_retr", mode=self.zip_mode.value):
+            self.pool.run(retr)
+        metrics.count("ftp_retr_bytes_total", stream.tell(), mode=self.zip_mode.value)
 
     def _get_output_folders(
         self,
         folder: str,
         source_dir: str | None = None,
     ) -> List[str]:
-        dir_regex = r"^[\(a-zA-Z0-9-_\s)+\/]+$"
-        skip_regex = [
-            r"Input",
-            r"Catalogued",
-            r"Invalid",
-            r"Failed",
-            "For Processing",
-        ]
-        output_regex = r"\/Output"
-        entries = []
-        output_dirs = []
-
         # _folder = f"/{folder}" if not folder.startswith("/") else folder
         print(folder)
-        if folder:
-            entries.extend(self.ftp.nlst(folder))
-        else:
-            entries.extend(self.ftp.nlst())
-
-        for entry in entries:
-            if any([re.search(regex, entry) for regex in skip_regex]):
-                continue
-            if re.search(dir_regex, entry):
-                if re.search(output_regex, entry):
-                    return self.ftp.nlst(entry)
-                output_dirs.extend(self._get_output_folders(entry))
+        entries = self.walker.find_output_folders(folder)
+        self._entries.update((entry.path, entry) for entry in entries)
 
-        return output_dirs
+        return [entry.path for entry in entries]
 
     def _get_failed(
         self,
@@ -134,46 +157,68 @@ class RemoteExtraction(ExtractionStrategy):
         failed_path = f"{contract}/{FAILED_FOLDER}/{job}"
         invalid_path = f"{contract}/{INVALID_FOLDER}/{job}"
 
-        entries.extend(self.ftp.nlst(failed_path))
-        entries.extend(self.ftp.nlst(invalid_path))
+        entries.extend(self._nlst(failed_path))
+        entries.extend(self._nlst(invalid_path))
 
         # Loops through each vehicle folder per failed job folder
-        for _vehicle_folder in entries:
-            for file in self.ftp.nlst(_vehicle_folder):
-                tree = file.split("/")
-                ftp_stream = io.BytesIO()
-                # with open(f"{tree[-1]}", "rb+") as ftp_stream:
-                self.ftp.retrbinary(f"RETR {file}", ftp_stream.write)
-                ftp_stream.name = tree[-1]
-                failed.append(ftp_stream)
+        with ThreadPoolExecutor(max_workers=self.parallel_downloads) as executor:
+            files = []
+            for vehicle_files in executor.map(self._nlst, entries):
+                files.extend(vehicle_files)
+            failed.extend(executor.map(self._get_failed_file, files))
 
         return failed
 
+    def _get_failed_file(self, file: str) -> io.BytesIO:
+        tree = file.split("/")
+        ftp_stream = io.BytesIO()
+        # with open(f"{tree[-1]}", "rb+") as ftp_stream:
+        self._retrieve(file, ftp_stream)
+        ftp_stream.name = tree[-1]
+        return ftp_stream
+
     def get_zip_output(self, file_path: str) -> zipfile.ZipFile | None:
-        """Extracts bytes from FTP server and convert into io Bytes so zipfile lib can read
-        zip file"""
+        """Extracts bytes from FTP server and convert into a file object so zipfile lib
+        can read zip file. How much of the zip is held in memory depends on zip_mode"""
 
         print("inside get_zip_output")
         print(file_path)
-        zip_path = self.ftp.nlst(file_path)
+        zip_path = self._nlst(file_path)
         print(zip_path)
-        ftp_stream = io.BytesIO()
         if zip_path:
-            print(f"retrieving {zip_path[0]} from ftp")
-            self.ftp.retrbinary(f"RETR {zip_path[0]}", ftp_stream.write)
+            print(f"retrieving {zip_path[0]} from ftp ({self.zip_mode.value})")
+            if self.zip_mode == ZipMode.RANGE:
+                ftp_stream = FTPRangeFile(self.pool, zip_path[0])
+            else:
+                if self.zip_mode == ZipMode.SPOOL:
+                    ftp_stream = tempfile.SpooledTemporaryFile(
+                        max_size=self.spool_max_size
+                    )
+                else:
+                    ftp_stream = io.BytesIO()
+                self._retrieve(zip_path[0], ftp_stream)
             output_zip = zipfile.ZipFile(ftp_stream)
 
             return output_zip
 
-    def get_zip_files(self, output_dir):
-        zip_files = []
-        for entry in self.ftp.nlst(output_dir):
-            if entry.endswith("zip"):
-                zip_files.extend([entry])
-            else:
-                zip_files.extend(self.get_zip_files(entry))
+    def scan_zip_entries(
+        self,
+        output_dir: str,
+        cached: Callable[[WalkEntry], List[WalkEntry] | None] | None = None,
+    ) -> Tuple[List[WalkEntry], List[WalkEntry]]:
+        root = self._entries.get(output_dir)
+        if root and not root.is_dir:
+            return ([root] if root.name.endswith("zip") else []), []
+
+        return self.walker.walk(
+            output_dir,
+            predicate=lambda entry: entry.name.endswith("zip"),
+            cached=cached,
+            root=root,
+        )
 
-        return zip_files
+    def get_zip_files(self, output_dir):
+        return [entry.path for entry in self.get_zip_entries(output_dir)]
 
 
 class LocalExtraction(ExtractionStrategy):
@@ -239,28 +284,79 @@ class LocalExtraction(ExtractionStrategy):
         return output_zip
 
     def get_zip_files(self, output_dir):
-        zip_files = []
-        for entry in os.scandir(output_dir):
-            if entry.is_dir():
-                zip_files.extend(self.get_zip_files(entry.path))
-            if entry.is_file() and entry.path.endswith("zip"):
-                zip_files.extend([entry.path])
+        return [entry.path for entry in self.get_zip_entries(output_dir)]
+
+    @staticmethod
+    def _walk_entry(path: str, name: str, stat: os.stat_result, is_dir: bool):
+        return WalkEntry(
+            path=path,
+            name=name,
+            type="dir" if is_dir else "file",
+            size=stat.st_size,
+            modify=time.strftime("%Y%m%d%H%M%S", time.gmtime(stat.st_mtime)),
+        )
 
-        return zip_files
+    def scan_zip_entries(
+        self,
+        output_dir: str,
+        cached: Callable[[WalkEntry], List[WalkEntry] | None] | None = None,
+    ) -> Tuple[List[WalkEntry], List[WalkEntry]]:
+        zip_files = []
+        listed_dirs = []
+        root = self._walk_entry(
+            output_dir,
+            os.path.basename(output_dir),
+            os.stat(output_dir),
+            os.path.isdir(output_dir),
+        )
+        if not root.is_dir:
+            return ([root] if root.name.endswith("zip") else []), listed_dirs
+        _zip_files = cached(root) if cached else None
+        if _zip_files is not None:
+            return _zip_files, listed_dirs
+
+        frontier = [root]
+        while frontier:
+            dir_entry = frontier.pop(0)
+            listed_dirs.append(dir_entry)
+            for entry in os.scandir(dir_entry.path):
+                walk_entry = self._walk_entry(
+                    entry.path, entry.name, entry.stat(), entry.is_dir()
+                )
+                if entry.is_dir():
+                    _zip_files = cached(walk_entry) if cached else None
+                    if _zip_files is None:
+                        frontier.append(walk_entry)
+                    else:
+                        zip_files.extend(_zip_files)
+                if entry.is_file() and entry.path.endswith("zip"):
+                    zip_files.append(walk_entry)
+
+        return zip_files, listed_dirs
 
 
 class DirectoryParser:
-    excel_regex = r"^.+\/.+\.xlsx$"
-    searchable_pdf_regex = r"Searchable PDF"
-    kvp_per_file = {}
-
     def __init__(
         self,
         src_path: str = "",
         zip_path: str = "",
         contract: str = "",
         job: str = "",
+        index: "DirectoryIndex | None" = None,
+        workers: int = 1,
     ):
+        """
+        Parameters
+        ----------
+            index
+                Index of already walked directories and processed zips. When given,
+                process_dir only lists changed leaf directories below the Output
+                folders and only extracts new or modified zips. The directories
+                from the contract down to the Output folders are listed every time
+            workers
+                Number of processes process_dir parses the Batch Spreadsheets with.
+                The zips are still fetched and opened in this process
+        """
         if zip_path == "" and src_path == "":
             print(
                 bcolors.WARNING
@@ -276,6 +372,21 @@ class DirectoryParser:
 
         self.contract = contract
         self.job = job
+        self.index = index
+        self.workers = workers
+        self.zip_entries: Dict[str, WalkEntry] = {}
+        # Batch name -> everything extracted from its zip
+        self.kvp_per_file: Dict[str, Job] = {}
+        # Batch name -> path of its zip, as given to the extraction strategy
+        self.zip_paths: Dict[str, str] = {}
+        # Batch name -> why its zip could not be read. Only batches that are not in
+        # here have a zip_paths entry
+        self.extraction_failures: Dict[str, str] = {}
+        self.zip_manifests: Dict[str, ZipManifest] = {}
+        # Batch name -> KVP rows whose File name is not in the zip, by File name
+        self.unmatched_rows: Dict[str, Dict[str, List[Dict]]] = {}
+        # Batch name -> filenames of the Searchable PDFs without KVP rows
+        self.orphan_pdfs: Dict[str, List[str]] = {}
         self._extraction_strat = LocalExtraction()
 
     @property
@@ -291,7 +402,7 @@ class DirectoryParser:
         self,
         zip_file_path: str,
         batch_name: str,
-    ) -> List[Tuple[pd.ExcelFile, str] | None]:
+    ) -> List[Tuple[KVPSpreadsheet, str] | None]:
         """Extracts useful files from zipfiles. Specifically the searchable pdf file
         uploaded by Skriba and their respective excel files containing their key value pair
 
@@ -306,50 +417,61 @@ class DirectoryParser:
 
         Returns
         -------
-        List[pd.ExcelFile | None]
+        List[KVPSpreadsheet | None]
             List of extracted excel files containing KVP from zip
         """
-        self.kvp_per_file[batch_name] = {}
-        excel_datas = []
+        output_zip = self._open_zip(zip_file_path, batch_name)
+        if not output_zip:
+            return []
+        try:
+            # KVPSpreadsheet reads the sheets one at a time, there are always more
+            # than two sheets
+            return [
+                (KVPSpreadsheet(output_zip.open(file)), batch_name)
+                for file in self.zip_manifests[batch_name].spreadsheets
+            ]
+        except zipfile.BadZipFile as e:
+            self._extraction_failed(batch_name, f"{zip_file_path}: {e}")
+            return []
+
+    def _read_spreadsheets(self, zip_file_path: str, batch_name: str) -> List[bytes]:
+        """Like _extract_from_zip, but returns the Batch Spreadsheets as bytes so
+        they can be parsed in another process"""
+        output_zip = self._open_zip(zip_file_path, batch_name)
+        if not output_zip:
+            return []
+        try:
+            return [
+                output_zip.read(file)
+                for file in self.zip_manifests[batch_name].spreadsheets
+            ]
+        except zipfile.BadZipFile as e:
+            self._extraction_failed(batch_name, f"{zip_file_path}: {e}")
+            return []
+
+    def _open_zip(self, zip_file_path: str, batch_name: str) -> zipfile.ZipFile | None:
+        """Opens the zip of a batch, reads its manifest and opens its Searchable PDFs
+        into kvp_per_file. None if the zip could not be read, see
+        extraction_failures"""
+        self.kvp_per_file[batch_name] = Job(batch_name, zip_file_path)
         try:
             """Checks contents of zipfile and filters excel files"""
             print(zip_file_path)
-            output_zip = self._extraction_strat.get_zip_output(zip_file_path)
+            with metrics.context(job=batch_name), metrics.span("zip_open"):
+                output_zip = self._extraction_strat.get_zip_output(zip_file_path)
+                manifest = ZipManifest.from_zip(output_zip) if output_zip else None
             print(output_zip)
             if not output_zip:
-                return excel_datas
-            zip_list = output_zip.namelist()
-
-            """Convert excel files found in zip file and converts into pd.ExcelFile"""
-            excel_files = [
-                file for file in zip_list if re.search(self.excel_regex, str(file))
-            ]
-
-            # Used pd.ExcelFile since there are always more than two sheets
-            for file in excel_files:
-                f = output_zip.open(file)
-                # Get only the Batch Spreadsheet excel
-                # if re.match(r".*Batch KVP Spreadsheet\.xlsx", f.name):
-                if re.match(BATCH_SPREADSHEET_NAME, f.name):
-                    _excel = pd.ExcelFile(f)
-                    excel_datas.append((_excel, batch_name))
-
-            """Extracts pdf files that are searchable pdfs"""
-            searchable_pdf_files = [
-                file
-                for file in zip_list
-                if re.search(self.searchable_pdf_regex, str(file))
-            ]
-
-            for file in searchable_pdf_files:
-                # _filename = re.sub(".*Searchable PDF/", "", file)
-                _filename = re.sub(SUB_SEARCHABLE_REGEX, "", file)
-                _filename = file.split("/")[-1]
-                # filename = _filename.removesuffix(" - Searchable PDF.pdf")
-                filename = _filename.removesuffix(SUFFIX_REMOVE_SEARCHABLE)
-                self.kvp_per_file[batch_name][filename] = {}
-                f = output_zip.open(file, "r")
-                self.kvp_per_file[batch_name][filename]["PDF File"] = f
+                self._extraction_failed(batch_name, f"{zip_file_path} not found")
+                return None
+            self.zip_paths[batch_name] = zip_file_path
+            self.zip_manifests[batch_name] = manifest
+            self.orphan_pdfs[batch_name] = list(manifest.searchable_pdfs)
+
+            """Opens the searchable pdfs"""
+            documents = self.kvp_per_file[batch_name].documents
+            for filename, file in manifest.searchable_pdfs.items():
+                documents[filename] = Document(filename, output_zip.open(file, "r"))
             """
             # Hopefully walang "output" string sa mga batch names??
             # Can be improved
@@ -363,12 +485,19 @@ class DirectoryParser:
             print(processed_path)
             # shutil.move(file_path, processed_path)
             """
-            return excel_datas
+            return output_zip
         except zipfile.BadZipFile as e:
-            print(bcolors.FAIL + f"{zip_file_path}: {e}" + bcolors.ENDC)
-            return excel_datas
+            self._extraction_failed(batch_name, f"{zip_file_path}: {e}")
+            return None
+
+    def _extraction_failed(self, batch_name: str, error: str):
+        print(bcolors.FAIL + error + bcolors.ENDC)
+        self.zip_paths.pop(batch_name, None)
+        # None of a zip is uploaded unless all of it could be read
+        self.kvp_per_file[batch_name].documents.clear()
+        self.extraction_failures[batch_name] = error
 
-    def _parse_dataframe(self, excel: pd.ExcelFile, job):
+    def _parse_dataframe(self, excel: KVPSpreadsheet, job):
         """Takes in an excel file in the "KVP Excel File" Folder and turns the key value pairings
         into a python object and stores it in the kvp_per_file attribute"""
 
@@ -377,92 +506,228 @@ class DirectoryParser:
         if len(sheet_names) < 2:
             return
 
-        ## Baka di na kailangan to since may filename na sa bawat page
-        summary_df = excel.parse(sheet_names[0])
-        filename_template_pairings = {}
-        if isinstance(summary_df, pd.DataFrame):
-            df_records = summary_df[summary_df.columns[0:3]].to_dict("records")
-            for record in df_records:
-                # Columns needed from summary sheet to connect kvp to pdf file
-                sum_doc_type = record["Document Type"]
-                sum_page = record["Page number"]
-                sum_file_name = record["File name"]
-                if sum_doc_type not in filename_template_pairings:
-                    filename_template_pairings[sum_doc_type] = {}
-
-                filename_template_pairings[sum_doc_type][sum_page] = sum_file_name
-
-        for sheet_name in sheet_names[1:]:
-            df = excel.parse(sheet_name)
-            if isinstance(df, pd.DataFrame):
-                if df.empty:
-                    continue
+        # Rows are joined to the Searchable PDFs by their File name column
+        with metrics.context(job=job), metrics.span("xlsx_parse"):
+            grouped = group_by_filename(excel.kvp_records())
+        self._join_records(job, grouped)
+
+    def _join_records(self, job: str, grouped: Dict[str, List]):
+        """Adds the KVP rows of a Batch Spreadsheet, grouped by File name, to the
+        documents of the batch"""
+        join = self.zip_manifests[job].join(grouped)
+        documents = self.kvp_per_file[job].documents
+        for filename, records in join.rows.items():
+            document = documents[filename]
+            if document.kvp:
+                document.kvp.extend(records)
+            else:
+                document.kvp = records
+
+        unmatched_rows = self.unmatched_rows.setdefault(job, {})
+        for filename, records in join.unmatched_rows.items():
+            unmatched_rows.setdefault(filename, []).extend(records)
+        self.orphan_pdfs[job] = [
+            filename
+            for filename in self.orphan_pdfs.get(job, join.orphan_pdfs)
+            if filename not in join.rows
+        ]
+        if join.unmatched_rows:
+            print(
+                bcolors.WARNING
+                + f"{job}: KVP rows of {len(join.unmatched_rows)} files not in the zip"
+                + bcolors.ENDC
+            )
+
+    def _process_in_workers(self, zip_files: List[Tuple[str, str]]) -> Iterator[str]:
+        """Like _process_in_threads, but the Batch Spreadsheets are parsed in a pool
+        of processes. Every zip is only fetched and opened once, in this process,
+        which keeps its Searchable PDFs open. The workers get the spreadsheet bytes
+        and send back the KVP rows grouped by File name"""
+        window = max(self.extraction_strat.parallel_downloads, self.workers)
+
+        def finish(batch_name, future) -> str:
+            for parsed in future.result():
+                grouped = parsed.result()
+                if grouped is not None:
+                    self._join_records(batch_name, grouped)
+            return batch_name
+
+        with ThreadPoolExecutor(max_workers=window) as executor, ProcessPoolExecutor(
+            max_workers=self.workers
+        ) as parsers:
+
+            def fetch(zip_file, batch_name) -> List[Future]:
+                return [
+                    parsers.submit(_group_spreadsheet, data)
+                    for data in self._read_spreadsheets(zip_file, batch_name)
+                ]
+
+            in_flight = deque()
+            for zip_file, batch_name in zip_files:
+                future = executor.submit(fetch, zip_file, batch_name)
+                in_flight.append((batch_name, future))
+                if len(in_flight) >= window:
+                    yield finish(*in_flight.popleft())
+            while in_flight:
+                yield finish(*in_flight.popleft())
+
+    def _process_in_threads(self, zip_files: List[Tuple[str, str]]) -> Iterator[str]:
+        """Extracts and parses the zips in walk order, yielding each batch name once
+        its kvp_per_file entry is complete. Remote strategies download several zips
+        at once over their connection pool, but never more than parallel_downloads
+        ahead of the batch being yielded"""
+        window = max(self.extraction_strat.parallel_downloads, 1)
+
+        def finish(batch_name, future) -> str:
+            for excel, job in future.result():
+                self._parse_dataframe(excel, job)
+            return batch_name
+
+        with ThreadPoolExecutor(max_workers=window) as executor:
+            in_flight = deque()
+            for zip_file, batch_name in zip_files:
+                future = executor.submit(self._extract_from_zip, zip_file, batch_name)
+                in_flight.append((batch_name, future))
+                if len(in_flight) >= window:
+                    yield finish(*in_flight.popleft())
+            while in_flight:
+                yield finish(*in_flight.popleft())
+
+    def _zip_entries(self, output_dir: str) -> List[WalkEntry]:
+        """Zip files below output_dir. With an index, unchanged directories are not
+        listed again and zips that were already processed are left out"""
+        if not self.index:
+            return self.extraction_strat.get_zip_entries(output_dir)
+
+        zip_files, listed_dirs = self.extraction_strat.scan_zip_entries(
+            output_dir,
+            cached=lambda entry: self.index.cached_files(self.contract, entry),
+        )
+        self.index.record_walk(self.contract, zip_files, listed_dirs)
+        return self.index.pending(self.contract, zip_files)
+
+    def queue_tasks(self, batch_name: str) -> List[Dict]:
+        """Upload tasks of a batch for UploadQueue, naming each PDF by its zip and
+        member instead of holding the open file"""
+        job = self.kvp_per_file[batch_name]
+        return [
+            {
+                "job": batch_name,
+                "filename": document.filename,
+                "zip_path": job.zip_path,
+                "member": document.pdf_file.name,
+                "kvp": document.kvp,
+            }
+            # Failed files are not zip members and are left out
+            for document in job.documents.values()
+        ]
 
-                """Slices the DF, chooses only columns for template and page"""
-                # _template_df = df.iloc[:, :2]
-                _template_df = df.iloc[:, :3]
-
-                """Slices the DF, chooses only columns for key value pairing"""
-                # _kvp_df = df.iloc[:, 5::2]
-                _kvp_df = df.iloc[:, 6::2]
-                kvp_df = pd.concat([_template_df, _kvp_df], axis=1)
-                kvp_records = kvp_df.to_dict("records")
-
-                for kvp_record in kvp_records:
-                    """
-                    template = kvp_record["Template"]
-                    page = kvp_record["Page"]
-                    filename = filename_template_pairings[template][page]
-                    """
-                    filename = kvp_record["File name"]
-                    if filename in self.kvp_per_file[job]:
-                        """
-                        self.kvp_per_file[filename]["KVP"] = kvp_record
-                        """
-                        if "KVP" not in self.kvp_per_file[job][filename]:
-                            self.kvp_per_file[job][filename]["KVP"] = []
-                        self.kvp_per_file[job][filename]["KVP"].extend([kvp_record])
+    def enqueue(self, queue: "UploadQueue") -> Dict[str, int]:
+        """Walks the output folders like iter_batches and adds the upload tasks of
+        each batch to queue as soon as it is parsed. A batch's entry is removed from
+        kvp_per_file once it is queued, so only the batches in flight are held.
+        With an index only new or changed zips are extracted, so their tasks
+        replace any queued before
 
-    @timerdecorator
-    def process_dir(self) -> Dict:
-        """Main Process for this class. Starts the process for parsing the ouput zip folders
-        and converts into ??? for uploading to filecloud"""
-        print(
-            bcolors.OKCYAN + f"Walking through FTP Server. Please Wait" + bcolors.ENDC,
+        Returns
+        -------
+            Dict[str, int]
+                Batch name -> number of tasks added or reset, for every batch that
+                was extracted
+        """
+        added = {}
+        for batch_name in self.iter_batches():
+            if batch_name in self.zip_paths:
+                added[batch_name] = queue.enqueue(
+                    self.queue_tasks(batch_name), reset=self.index is not None
+                )
+            self.zip_manifests.pop(batch_name, None)
+            self.kvp_per_file.pop(batch_name, None)
+        return added
+
+    def join_report(self) -> Dict[str, Dict]:
+        """Batches whose KVP rows and Searchable PDFs did not all match up, with the
+        number of unmatched rows per File name and the orphan PDF filenames"""
+        report = {}
+        # Every extracted batch has an orphan_pdfs entry
+        for batch_name, orphan_pdfs in self.orphan_pdfs.items():
+            unmatched_rows = self.unmatched_rows.get(batch_name, {})
+            if unmatched_rows or orphan_pdfs:
+                report[batch_name] = {
+                    "unmatched_rows": {
+                        filename: len(records)
+                        for filename, records in unmatched_rows.items()
+                    },
+                    "orphan_pdfs": orphan_pdfs,
+                }
+        return report
+
+    def mark_processed(self, batch_name: str):
+        """Records in the index that the zip of batch_name was fully uploaded"""
+        if self.index and batch_name in self.zip_entries:
+            self.index.mark_processed(self.contract, self.zip_entries[batch_name])
+
+    def _add_zip_entries(self, zip_entries: List[WalkEntry]) -> List[Tuple[str, str]]:
+        """Zip path and batch name of every entry, remembering the entries so the
+        zips can be marked processed"""
+        zip_files = []
+        for zip_entry in zip_entries:
+            batch_name = os.path.split(zip_entry.path)[1].removesuffix(".zip")
+            self.zip_entries[batch_name] = zip_entry
+            zip_files.append((zip_entry.path, batch_name))
+        return zip_files
+
+    def _find_zip_files(self) -> List[Tuple[str, str]] | None:
+        """Zip path and batch name of every zip in the output folders of the
+        contract, None if there are no output folders"""
+        foldername = self.contract if self.contract else ""
+        output_dirs = self.extraction_strat._get_output_folders(
+            folder=foldername,
+            source_dir=self.src_path,
         )
-        excel_files = []
+        if not output_dirs:
+            return None
+
+        zip_files = []
+        for dir in output_dirs:
+            for zip_file, batch_name in self._add_zip_entries(self._zip_entries(dir)):
+                print(zip_file)
+                zip_files.append((zip_file, batch_name))
+                """
+                failed_dirs = self.extraction_strat._get_failed(
+                    folder=foldername,
+                    job=batch_name,
+                )
+                """
+
+        return zip_files
 
+    def iter_batches(self, zip_entries: List[WalkEntry] | None = None) -> Iterator[str]:
+        """Walks the output folders and extracts and parses their zips one by one,
+        yielding each batch name as soon as its kvp_per_file entry is complete.
+        Given zip_entries, e.g. found by a RemoteWatcher, only those zips are
+        processed and nothing is walked"""
         try:
-            foldername = self.contract if self.contract else ""
-            output_dirs = self.extraction_strat._get_output_folders(
-                folder=foldername,
-                source_dir=self.src_path,
-            )
-            if output_dirs:
-                for dir in output_dirs:
-                    for zip_file in self.extraction_strat.get_zip_files(dir):
-                        print(zip_file)
-                        batch_name = os.path.split(zip_file)[1].removesuffix(".zip")
-                        excel_files.extend(self._extract_from_zip(zip_file, batch_name))
-                        """
-                        failed_dirs = self.extraction_strat._get_failed(
-                            folder=foldername,
-                            job=batch_name,
-                        )
-                        """
+            if zip_entries is not None:
+                zip_files = self._add_zip_entries(zip_entries)
             else:
+                print(
+                    bcolors.OKCYAN
+                    + f"Walking through FTP Server. Please Wait"
+                    + bcolors.ENDC,
+                )
+                zip_files = self._find_zip_files()
+            if zip_files is None:
                 # Change to Exception??
                 print(bcolors.FAIL + f"{self.src_path} is Empty" + bcolors.ENDC)
-                return self.kvp_per_file
-
-            if excel_files:
-                for excel, job in excel_files:
-                    self._parse_dataframe(excel, job)
+                return
 
-            return self.kvp_per_file
+            if self.workers > 1:
+                yield from self._process_in_workers(zip_files)
+            else:
+                yield from self._process_in_threads(zip_files)
         except IsADirectoryError as e:
             print(bcolors.FAIL + f"{e}" + bcolors.ENDC)
-            return self.kvp_per_file
         except FileNotFoundError as e:
             print(bcolors.FAIL + f"{e}" + bcolors.ENDC)
             print(
@@ -470,7 +735,27 @@ class DirectoryParser:
                 + f"Please check paths and contract name if it exists"
                 + bcolors.ENDC
             )
-            return self.kvp_per_file
+
+    def iter_records(
+        self, zip_entries: List[WalkEntry] | None = None
+    ) -> Iterator[Dict]:
+        """Streaming version of process_dir. Yields the upload tasks of a job (see
+        upload_pipeline.tasks_from_kvp) as soon as the job is parsed, while the
+        next zips are still being fetched. A job's entry is removed from
+        kvp_per_file once it is yielded, so only the jobs in flight are held. See
+        iter_batches for zip_entries"""
+        for batch_name in self.iter_batches(zip_entries):
+            self.zip_manifests.pop(batch_name, None)
+            yield from tasks_from_kvp({batch_name: self.kvp_per_file.pop(batch_name)})
+
+    @timerdecorator
+    def process_dir(self) -> Dict:
+        """Main Process for this class. Starts the process for parsing the ouput zip folders
+        and converts into ??? for uploading to filecloud"""
+        for _ in self.iter_batches():
+            pass
+
+        return self.kvp_per_file
 
     @timerdecorator
     def process_job(self) -> Dict | None:
@@ -486,7 +771,7 @@ class DirectoryParser:
             """
             failed_stuff = self.extraction_strat._get_failed(self.contract, self.job)
             print(failed_stuff)
-            self.kvp_per_file[self.job]["FAILED"] = failed_stuff
+            self.kvp_per_file[self.job].failed = failed_stuff
             """
             return self.kvp_per_file
         except IsADirectoryError as e:
@@ -498,3 +783,12 @@ class DirectoryParser:
                 + f"Please check paths and contract name if it exists"
                 + bcolors.ENDC
             )
+
+
+def _group_spreadsheet(data: bytes) -> Dict[str, List] | None:
+    """Worker process side of DirectoryParser._process_in_workers. KVP rows of a Batch
+    Spreadsheet grouped by File name, None for the summary file"""
+    excel = KVPSpreadsheet(io.BytesIO(data))
+    if len(excel.sheet_names) < 2:
+        return None
+    return group_by_filename(excel.kvp_records())
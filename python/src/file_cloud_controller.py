@@ -1,13 +1,21 @@
+import io
+import threading
 import zipfile
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
-from http import client
-from typing import Dict, List
-from xml.dom.minidom import parseString
+from typing import Callable, Dict, List, Tuple
 from xml.etree import ElementTree
 
 import requests
-from pandas.io import json
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 
+from .folder_cache import FolderCache
+from .metadata_cache import MetadataSetCache
+from .metrics import metrics
+from .request_layer import RequestLayer
+from .session_cache import SessionCache
+from .upload_offset_cache import UploadOffsetCache
 from .utils import bcolors, time, timerdecorator
 
 
@@ -19,13 +27,439 @@ class MetadataSets(Enum):
     TEST = "64c75ff4a051780403092b9c"
 
 
-class FileCloudController:
-    def __init__(self, server_url, user, passwd):
+class VerifyMode(Enum):
+    """When saved metadata is read back with getmetadatavalues and compared"""
+
+    OFF = "off"
+    SAMPLED = "sampled"
+    ALWAYS = "always"
+
+
+class MergePolicy(Enum):
+    """How the KVP rows of a file that map to the same metadata set are merged
+    into the one set of values saved for it"""
+
+    # Values of later rows replace earlier ones, which is what saving the set once
+    # per row ended up with
+    LAST = "last"
+    # Values of the first row are kept
+    FIRST = "first"
+    # Per attribute, the first row with a value that is not empty wins
+    FIRST_NON_EMPTY = "first_non_empty"
+    # Per attribute, the distinct values that are not empty, joined with "; "
+    JOIN = "join"
+
+
+def _empty(value) -> bool:
+    return value is None or value == ""
+
+
+def merge_rows(rows: List[Dict], policy: MergePolicy) -> Dict:
+    """Merges KVP rows of one metadata set into one dict, see MergePolicy. Columns
+    are kept in the order they first appear in"""
+    if policy == MergePolicy.FIRST:
+        rows = rows[::-1]
+    merged = {}
+    joined: Dict[str, List] = {}
+    for row in rows:
+        for key, value in row.items():
+            if policy == MergePolicy.JOIN:
+                values = joined.setdefault(key, [])
+                if not _empty(value) and value not in values:
+                    values.append(value)
+            elif policy == MergePolicy.FIRST_NON_EMPTY:
+                if _empty(merged.get(key)):
+                    merged[key] = value
+            else:
+                merged[key] = value
+    if policy == MergePolicy.JOIN:
+        for key, values in joined.items():
+            if len(values) > 1:
+                merged[key] = "; ".join(str(value) for value in values)
+            else:
+                merged[key] = values[0] if values else None
+
+    return merged
+
+
+def group_metadata_sets(
+    kvp: List[Dict], policy: MergePolicy = MergePolicy.LAST
+) -> Dict[str, Dict]:
+    """Metadata set name -> the merged KVP rows of a file for that set, in the
+    order the sets first appear in. Every set is saved once with these values
+    instead of once per row"""
+    grouped: Dict[str, List[Dict]] = {}
+    for row in kvp:
+        grouped.setdefault(FileCloudBase._metadata_set_name(row), []).append(row)
+
+    return {
+        name: rows[0] if len(rows) == 1 else merge_rows(rows, policy)
+        for name, rows in grouped.items()
+    }
+
+
+def text_succeeded(text: str) -> bool:
+    """Checks the <result> of the text of a FileCloud XML response"""
+    try:
+        result = ElementTree.fromstring(text).find(".//result")
+    except ElementTree.ParseError:
+        return False
+    return result is not None and result.text is not None and int(result.text) > 0
+
+
+def response_succeeded(response: requests.Response) -> bool:
+    """Checks the <result> of a FileCloud XML response"""
+    return text_succeeded(response.text)
+
+
+class FileCloudBase:
+    """State and request parameters shared by the FileCloud clients. Subclasses
+    provide the transport"""
+
+    def __init__(
+        self,
+        server_url,
+        user,
+        passwd,
+        metadata_cache: MetadataSetCache | None = None,
+        folder_cache: FolderCache | None = None,
+        session_cache: SessionCache | None = None,
+        offset_cache: UploadOffsetCache | None = None,
+        verify_mode: VerifyMode = VerifyMode.OFF,
+        verify_sample_rate: float = 0.05,
+        merge_policy: MergePolicy = MergePolicy.LAST,
+        chunk_size: int | None = None,
+        rate_limit: float | None = None,
+        burst: int = 10,
+        max_retries: int = 3,
+    ):
         self.server_url = server_url
         self.user = user
         self.passwd = passwd
+        # Metadata set name -> setid and attribute ids, shared by all uploads
+        self.metadata_cache = metadata_cache if metadata_cache else MetadataSetCache()
+        # FileCloud folders createfolder already went through for
+        self.folder_cache = folder_cache if folder_cache else FolderCache()
+        # Cookies of logged in sessions, see ensure_login
+        self.session_cache = session_cache if session_cache else SessionCache()
+        # Read-back checks run in the background so uploads never wait on them
+        self.verify_mode = verify_mode
+        self.verify_sample_rate = verify_sample_rate
+        # Rows of a file that map to the same metadata set are merged with this
+        # and the set is saved once
+        self.merge_policy = merge_policy
+        # Files larger than chunk_size are sent in pieces. Offsets reached by failed
+        # chunked uploads are kept so the next attempt resumes from there
+        self.chunk_size = chunk_size
+        self.offset_cache = offset_cache if offset_cache else UploadOffsetCache()
+        # Rate limiting, retries and per endpoint counters of every request
+        self.request_layer = RequestLayer(
+            rate_limit=rate_limit, burst=burst, max_retries=max_retries
+        )
+
+    def request_stats(self) -> Dict[str, Dict]:
+        """Calls, errors, retries, relogins and latency per endpoint"""
+        return self.request_layer.report()
+
+    def _stale_offset(self, key: str, filename: str):
+        """Drops a stored offset FileCloud does not have the bytes for, because the
+        partial file was removed or replaced, or its last chunk went through"""
+        print(
+            bcolors.WARNING
+            + f"FileCloud does not hold the partial upload of {filename}, "
+            + "uploading it from the start"
+            + bcolors.ENDC
+        )
+        self.offset_cache.discard(key)
+
+    def _metadata_params(self, path: str, kvp: Dict, metadata: Dict) -> Dict:
+        params = {}
+        params["fullpath"] = path
+        params["setid"] = metadata["setid"]
+        params["attributes_total"] = metadata["total"]
+
+        for key, value in list(metadata.items())[2:]:
+            params[f"{key}_attributeid"] = value["id"]
+            # Empty spreadsheet cells are None, which requests would leave out
+            _value = kvp[value["name"]]
+            params[f"{key}_value"] = "" if _value is None else _value
+
+        return params
+
+    def _create_upload_api_params(
+        self,
+        path: str,
+        filename,
+        offset: int = 0,
+        complete: bool | None = None,
+    ) -> Dict:
+        params = {
+            "appname": "explorer",
+            "path": path,
+            "offset": offset,
+        }
+        if complete is not None:
+            params["complete"] = int(complete)
+        return params
+
+    def _set_metadata_params(self, fullpath, setid):
+        params = {"fullpath": fullpath, "setid": setid}
+        return params
+
+    def _create_folder_params(self, path, name):
+        params = {"name": name, "path": path}
+        return params
+
+    @property
+    def skriba_path(self) -> str:
+        return f"/{self.user}/Skriba"
+
+    @staticmethod
+    def folder_name(file_data, is_failed: bool = False) -> str:
+        """Name of the Skriba folder a file is uploaded to: the batch folder it was
+        found in, or Failed"""
+        if is_failed:
+            return "Failed"
+        return file_data.name.split("/")[-2]
+
+    def _should_verify(self, fullpath: str) -> bool:
+        if self.verify_mode == VerifyMode.ALWAYS:
+            return True
+        if self.verify_mode == VerifyMode.SAMPLED:
+            # Sampling on a hash of the path picks the same files on every run
+            sample = zlib.crc32(fullpath.encode()) / 0xFFFFFFFF
+            return sample < self.verify_sample_rate
+        return False
+
+    def _create_metadata_data(self, metadata_name, kvp: Dict) -> Dict:
+        """Form data of /admin/addmetadataset for a set with the keys of kvp"""
+        data = {
+            "name": metadata_name,
+            "description": "KVP thingy for thingy",
+            "type": "3",
+            "disabled": "false",
+            "allowallpaths": "true",
+            "attributes_total": len(kvp),
+            "user0_name": self.user,
+            "user0_read": "true",
+            "user0_write": "true",
+            "users_total": "1",
+            "groups_total": "0",
+            "paths_total": "0",
+        }
+        for index, key in enumerate(kvp.keys()):
+            data[f"attribute{index}_name"] = key
+            data[f"attribute{index}_description"] = ""
+            data[f"attribute{index}_type"] = "1"
+            data[f"attribute{index}_required"] = "false"
+            data[f"attribute{index}_disabled"] = "false"
+            data[f"attribute{index}_defaultvalue"] = ""
+            data[f"attribute{index}_predefinedvalues_total"] = "0"
+
+        return data
+
+    @staticmethod
+    def _metadata_set_name(kvp: Dict) -> str:
+        return f"{kvp['Template']} ({kvp['Page']})"
+
+    @staticmethod
+    def _parse_available_metadata(text: str, metadata_set: str) -> Dict:
+        """Parses the ids of metadata_set out of a getavailablemetadatasets
+        response, see _get_available_metadata"""
+        metadata_attributes = {}
+        _attributes = []
+
+        # Loops through available metadata to find needed metadata set
+        for i in ElementTree.fromstring(text).findall(".//metadataset"):
+            if (i.find(".//name").text) == metadata_set:
+                metadata_attributes["setid"] = i.find(".//id").text
+                _attributes.extend(i.findall(".//*"))
+
+        if not _attributes:
+            return metadata_attributes
+
+        attributes = [
+            attribute
+            for attribute in _attributes
+            if attribute.tag.__contains__("attribute")
+        ]
+        metadata_attributes["total"] = attributes[-1].text
+        for index, (id, name) in enumerate(zip(attributes[:-1:7], attributes[1:-1:7])):
+            metadata_attributes[id.tag.split("_")[0]] = {
+                "id": id.text,
+                "name": name.text,
+            }
+
+        return metadata_attributes
+
+    @staticmethod
+    def _has_set(text: str, setid: str) -> bool:
+        """Whether a getmetadatavalues response lists the set setid"""
+        return any(
+            element.text == setid for element in ElementTree.fromstring(text).iter()
+        )
+
+    @staticmethod
+    def _parse_file_size(text: str) -> int | None:
+        """Size of the file in a fileinfo response, None if there is no such file"""
+        try:
+            size = ElementTree.fromstring(text).find(".//size")
+        except ElementTree.ParseError:
+            return None
+        if size is None or not (size.text or "").isdigit():
+            return None
+        return int(size.text)
+
+    @staticmethod
+    def _missing_values(data: Dict, text: str) -> List[str]:
+        """Attribute values of saveattributevalues data that are not found in a
+        getmetadatavalues response"""
+        saved_values = {
+            element.text or "" for element in ElementTree.fromstring(text).iter()
+        }
+        return [
+            key
+            for key, value in data.items()
+            if key.endswith("_value") and str(value) not in saved_values
+        ]
+
+
+class FileCloudController(FileCloudBase):
+    def __init__(self, server_url, user, passwd, **kwargs):
+        super().__init__(server_url, user, passwd, **kwargs)
         self.session = requests.session()
         self.admin_session = requests.session()
+        self._adapter: HTTPAdapter | None = None
+        self._pool_size = 0
+        self.configure_pool(DEFAULT_POOLSIZE)
+        self._verifier: ThreadPoolExecutor | None = None
+        self._verifications: List[Future] = []
+        # Logins per session key, so threads whose requests expired together log
+        # in once between them
+        self._login_lock = threading.RLock()
+        self._login_generations: Dict[str, int] = {}
+
+    def close(self):
+        """Closes the connections of both sessions"""
+        if self._verifier is not None:
+            self._verifier.shutdown(wait=True)
+            self._verifier = None
+        self.session.close()
+        self.admin_session.close()
+        self._adapter.close()
+
+    def _post(
+        self,
+        session: requests.Session,
+        endpoint: str,
+        relogin: bool = True,
+        **kwargs,
+    ) -> requests.Response:
+        """Posts to an endpoint through the request layer. Requests made with an
+        expired session log the session in again"""
+        return self.request_layer.post(
+            session,
+            self.server_url + endpoint,
+            endpoint,
+            relogin=self._relogin(session) if relogin else None,
+            **kwargs,
+        )
+
+    def _post_checked(
+        self,
+        session: requests.Session,
+        endpoint: str,
+        succeeded: Callable[[requests.Response], bool],
+        applied: Callable[[], bool],
+        **kwargs,
+    ) -> Tuple[bool, requests.Response | None]:
+        """Posts a request that is not idempotent, see RequestLayer.post_checked"""
+        return self.request_layer.post_checked(
+            session,
+            self.server_url + endpoint,
+            endpoint,
+            succeeded,
+            applied,
+            relogin=self._relogin(session),
+            **kwargs,
+        )
+
+    def _relogin(self, session: requests.Session) -> Callable[[], None]:
+        """Function logging session in again once a request about to be sent with
+        it finds it expired. If another thread logged in since, its session is
+        reused instead of logging in again"""
+        login = self.admin_login if session is self.admin_session else self.login
+        key = self._session_key(session)
+        generation = self._login_generations.get(key, 0)
+
+        def relogin():
+            nonlocal generation
+            with self._login_lock:
+                if self._login_generations.get(key, 0) == generation:
+                    login()
+                generation = self._login_generations.get(key, 0)
+
+        return relogin
+
+    def configure_pool(self, size: int):
+        """Makes the HTTP connection pool big enough for `size` threads to share the
+        sessions without discarding connections. Both sessions use the same pool,
+        so core and admin requests reuse each other's connections while keeping
+        their own cookies. A pool that is already big enough is kept, with its
+        open connections"""
+        if size <= self._pool_size:
+            return
+        previous = self._adapter
+        self._adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        self._pool_size = size
+        for session in (self.session, self.admin_session):
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+        if previous is not None:
+            previous.close()
+
+    def _session_key(self, session: requests.Session) -> str:
+        kind = "admin" if session is self.admin_session else "core"
+        return SessionCache.key(kind, self.user, self.server_url)
+
+    def _logged_in(self, session: requests.Session):
+        print(bcolors.OKCYAN + f"Login Succeeded!" + bcolors.ENDC)
+        key = self._session_key(session)
+        self.session_cache.store(key, session)
+        with self._login_lock:
+            self._login_generations[key] = self._login_generations.get(key, 0) + 1
+
+    def _session_valid(self, session: requests.Session) -> bool:
+        """Whether the server still accepts the cookies of session, checked with a
+        cheap read of the user"""
+        if session is self.admin_session:
+            endpoint, params = "/admin/getuser", {"username": self.user}
+        else:
+            endpoint, params = "/core/getfilelist", {"path": f"/{self.user}"}
+        response = self._post(session, endpoint, relogin=False, params=params)
+        return not self.request_layer.session_expired(
+            response.status_code, response.text
+        )
+
+    def ensure_login(self):
+        """Logs in both sessions, reusing the cookies in session_cache instead where
+        they have not expired. Restored cookies are checked with one cheap request,
+        since the server may have ended the session before they expire"""
+        for session, login in (
+            (self.session, self.login),
+            (self.admin_session, self.admin_login),
+        ):
+            key = self._session_key(session)
+            if self.session_cache.restore(key, session):
+                if self._session_valid(session):
+                    print(
+                        bcolors.OKCYAN
+                        + f"Reusing FileCloud session ({key.split()[0]})"
+                        + bcolors.ENDC
+                    )
+                    continue
+                self.session_cache.invalidate(key)
+            login()
 
     # Should I return session or just add session to self
     def admin_login(self):
@@ -36,15 +470,17 @@ class FileCloudController:
         login_endpoint = "/admin/adminlogin"
         credentials = {"adminuser": self.user, "adminpassword": self.passwd}
         headers = {"Accept": "application/json"}
-        login_call = self.admin_session.post(
-            self.server_url + login_endpoint,
+        login_call = self._post(
+            self.admin_session,
+            login_endpoint,
+            relogin=False,
             data=credentials,
             headers=headers,
         )
         try:
             login_call = login_call.json()
             if login_call["command"][0]["result"] == 1:
-                print(bcolors.OKCYAN + f"Login Succeeded!" + bcolors.ENDC)
+                self._logged_in(self.admin_session)
             else:
                 print(bcolors.FAIL + f"Login Failed" + bcolors.ENDC, end=" ")
                 raise ValueError(login_call["command"][0]["message"])
@@ -52,7 +488,7 @@ class FileCloudController:
             result = ElementTree.fromstring(login_call.text).find(".//result")
 
             if int(result.text) > 0:
-                print(bcolors.OKCYAN + f"Login Succeeded!" + bcolors.ENDC)
+                self._logged_in(self.admin_session)
             else:
                 print(bcolors.FAIL + f"Login Failed" + bcolors.ENDC)
 
@@ -67,8 +503,10 @@ class FileCloudController:
             "Accept": "application/json",
             "User-agent": "Mozilla/5.0",
         }
-        login_call = self.session.post(
-            self.server_url + login_endpoint,
+        login_call = self._post(
+            self.session,
+            login_endpoint,
+            relogin=False,
             data=credentials,
             headers=headers,
             allow_redirects=True,
@@ -87,7 +525,7 @@ class FileCloudController:
             login_call = login_call.json()
 
             if login_call["command"][0]["result"] == 1:
-                print(bcolors.OKCYAN + f"Login Succeeded!" + bcolors.ENDC)
+                self._logged_in(self.session)
             else:
                 print(bcolors.FAIL + f"Login Failed" + bcolors.ENDC, end=" ")
                 raise ValueError(login_call["command"][0]["message"])
@@ -95,43 +533,53 @@ class FileCloudController:
             result = ElementTree.fromstring(login_call.text).find(".//result")
 
             if int(result.text) > 0:
-                print(bcolors.OKCYAN + f"Login Succeeded!" + bcolors.ENDC)
+                self._logged_in(self.session)
             else:
                 print(bcolors.FAIL + f"Login Failed" + bcolors.ENDC)
 
-    def _metadata_params(self, path: str, kvp: Dict, metadata: Dict) -> Dict:
-        params = {}
-        params["fullpath"] = path
-        params["setid"] = metadata["setid"]
-        params["attributes_total"] = metadata["total"]
+    def ensure_folder(self, folder_name: str) -> str:
+        """Creates a Skriba folder unless it is already known to exist. Does not
+        overwrite existing folders
 
-        for key, value in list(metadata.items())[2:]:
-            params[f"{key}_attributeid"] = value["id"]
-            params[f"{key}_value"] = kvp[value["name"]]
+        Returns
+        -------
+            str
+                Filecloud path of the folder
+        """
+        filecloud_path = f"{self.skriba_path}/{folder_name}"
+        if filecloud_path in self.folder_cache:
+            return filecloud_path
 
-        return params
+        create_folder_endpoint = "/core/createfolder"
+        create_folder_response = self._post(
+            self.session,
+            create_folder_endpoint,
+            params=self._create_folder_params(
+                self.skriba_path,
+                folder_name,
+            ),
+        )
+        print(create_folder_response.text)
 
-    def _create_upload_api_params(self, path: str, filename) -> Dict:
-        params = {
-            "appname": "explorer",
-            "path": path,
-            "offset": 0,
-        }
-        return params
+        # FileCloud answers with an error result when the folder already exists, so
+        # any answer from the server means the folder is there
+        if create_folder_response.ok:
+            self.folder_cache.add(filecloud_path)
 
-    def _set_metadata_params(self, fullpath, setid):
-        params = {"fullpath": fullpath, "setid": setid}
-        return params
+        return filecloud_path
 
-    def _create_folder_params(self, path, name):
-        params = {"name": name, "path": path}
-        return params
+    def prepare_folders(self, folder_names) -> List[str]:
+        """Creates every folder of a job up front so uploads do not have to"""
+        return [
+            self.ensure_folder(folder_name)
+            for folder_name in dict.fromkeys(folder_names)
+        ]
 
     def list_dirs(self):
         get_file_endpoint = "/core/getfilelist"
-        upload_call = self.session.post(
-            self.server_url + get_file_endpoint,
-            cookies=self.cookies,
+        upload_call = self._post(
+            self.session,
+            get_file_endpoint,
         )
 
         for child in ElementTree.fromstring(upload_call.text).iter("path"):
@@ -158,8 +606,9 @@ class FileCloudController:
         """
         metadata_attributes = {}
         metadata_endpoint = f"/core/getdefaultmetadatavalues?setid={setid}"
-        response = self.session.post(
-            self.server_url + metadata_endpoint,
+        response = self._post(
+            self.session,
+            metadata_endpoint,
         )
         # Gets all the child node of <metadatasetvalue>
         _attributes = ElementTree.fromstring(response.text).findall(
@@ -186,40 +635,24 @@ class FileCloudController:
 
     def _create_metadata(
         self,
+        path,
         metadata_name,
         kvp: Dict,
-    ):
+    ) -> bool:
+        """Creates a metadata set with the keys of kvp. A failed attempt is only
+        sent again once the set is not found among the sets available to path"""
         metadatalist_endpoint = "/admin/addmetadataset"
-        data = {
-            "name": metadata_name,
-            "description": "KVP thingy for thingy",
-            "type": "3",
-            "disabled": "false",
-            "allowallpaths": "true",
-            "attributes_total": len(kvp),
-            "user0_name": self.user,
-            "user0_read": "true",
-            "user0_write": "true",
-            "users_total": "1",
-            "groups_total": "0",
-            "paths_total": "0",
-        }
-        for index, key in enumerate(kvp.keys()):
-            data[f"attribute{index}_name"] = key
-            data[f"attribute{index}_description"] = ""
-            data[f"attribute{index}_type"] = "1"
-            data[f"attribute{index}_required"] = "false"
-            data[f"attribute{index}_disabled"] = "false"
-            data[f"attribute{index}_defaultvalue"] = ""
-            data[f"attribute{index}_predefinedvalues_total"] = "0"
-
-        params = "&".join([f"{key}={value}" for (key, value) in data.items()])
-        params = dict_to_params(data)
-        response = self.admin_session.post(
-            self.server_url + metadatalist_endpoint,
+        data = self._create_metadata_data(metadata_name, kvp)
+        created, response = self._post_checked(
+            self.admin_session,
+            metadatalist_endpoint,
+            succeeded=response_succeeded,
+            applied=lambda: bool(self._get_available_metadata(path, metadata_name)),
             data=data,
         )
-        return response
+        if response is not None:
+            print(response.text)
+        return created
 
     def _get_available_metadata(self, path, metadata_set) -> Dict:
         """
@@ -243,36 +676,94 @@ class FileCloudController:
                 these are needed to save the custom metadata to the file
 
         """
-        metadata_attributes = {}
-
         metadata_endpoint = f"/core/getavailablemetadatasets?fullpath={path}"
-        response = self.session.post(f"{self.server_url}{metadata_endpoint}")
-        _attributes = []
+        response = self._post(self.session, metadata_endpoint)
+        return self._parse_available_metadata(response.text, metadata_set)
 
-        # Loops through available metadata to find needed metadata set
-        for i in ElementTree.fromstring(response.text).findall(".//metadataset"):
-            if (i.find(".//name").text) == metadata_set:
-                metadata_attributes["setid"] = i.find(".//id").text
-                _attributes.extend(i.findall(".//*"))
+    def _get_metadata_set(self, path: str, metadata_set_name: str, kvp: Dict) -> Dict:
+        """Gets the ids of a metadata set from the cache, or from FileCloud, creating
+        the set first if it does not exist yet"""
 
-        if not _attributes:
-            return metadata_attributes
+        def load():
+            available_metadata = self._get_available_metadata(path, metadata_set_name)
+            if not available_metadata:
+                self._create_metadata(path, metadata_set_name, kvp)
+                available_metadata = self._get_available_metadata(
+                    path, metadata_set_name
+                )
+            return available_metadata
 
-        attributes = [
-            attribute
-            for attribute in _attributes
-            if attribute.tag.__contains__("attribute")
-        ]
-        metadata_attributes["total"] = attributes[-1].text
-        for index, (id, name) in enumerate(zip(attributes[:-1:7], attributes[1:-1:7])):
-            metadata_attributes[id.tag.split("_")[0]] = {
-                "id": id.text,
-                "name": name.text,
-            }
+        return self.metadata_cache.get_or_load(metadata_set_name, load)
 
-        return metadata_attributes
+    def _verify_metadata(self, metadata_set_name: str, data: Dict) -> Dict:
+        """Reads the metadata of a file back and lists the attribute values that
+        are not found in the response"""
+        result = {
+            "fullpath": data["fullpath"],
+            "set": metadata_set_name,
+            "verified": False,
+            "missing": [],
+            "error": None,
+        }
+        try:
+            result["missing"] = self._missing_values(
+                data, self._read_metadata_values(data["fullpath"])
+            )
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            return result
 
-    def _add_metadata(self, path: str, filename: str, kvp):
+        result["verified"] = not result["missing"]
+        return result
+
+    def _read_metadata_values(self, fullpath: str) -> str:
+        """Text of the getmetadatavalues response of a file"""
+        metadata_endpoint = "/core/getmetadatavalues"
+        getmetadata_response = self._post(
+            self.session,
+            metadata_endpoint,
+            data={"fullpath": fullpath},
+        )
+        return getmetadata_response.text
+
+    def _remote_size(self, fullpath: str) -> int | None:
+        """Size of a file in FileCloud, None if it is not there"""
+        fileinfo_endpoint = "/core/fileinfo"
+        fileinfo_response = self._post(
+            self.session, fileinfo_endpoint, params={"file": fullpath}
+        )
+        return self._parse_file_size(fileinfo_response.text)
+
+    def _uploaded(self, fullpath: str, file_data, start: int) -> bool:
+        """Whether FileCloud has fullpath with as many bytes as file_data has from
+        start on, i.e. an upload of it went through"""
+        size = self._remote_size(fullpath)
+        if size is None:
+            return False
+        try:
+            position = file_data.tell()
+            end = file_data.seek(0, io.SEEK_END)
+            file_data.seek(position)
+        except (AttributeError, OSError, ValueError):
+            return False
+        return size == end - start
+
+    def _schedule_verification(self, metadata_set_name: str, data: Dict):
+        if not self._should_verify(data["fullpath"]):
+            return
+        if self._verifier is None:
+            self._verifier = ThreadPoolExecutor(max_workers=2)
+        self._verifications.append(
+            self._verifier.submit(self._verify_metadata, metadata_set_name, data)
+        )
+
+    def verification_results(self) -> List[Dict]:
+        """Waits for the scheduled read-back checks and returns their results"""
+        results = [future.result() for future in self._verifications]
+        self._verifications = []
+        return results
+
+    def _add_metadata(self, path: str, filename: str, kvp) -> Dict:
         """
         Adds Metadata to file specified in parameters. First gets the metadata ids
         then adds the metadata
@@ -285,44 +776,165 @@ class FileCloudController:
                 filename
             kvp
                 Skriba KVP extracted from zipfile
+
+        Returns
+        -------
+            Dict
+                fullpath, set name, whether the set was applied, the number of
+                attempts and the responses of a failed last attempt
         """
+        result = {
+            "fullpath": path + "/" + filename,
+            "set": None,
+            "applied": False,
+            "attempts": 0,
+            "responses": None,
+        }
 
         # Gets available metadata set based on KVP
-        metadata_set_name = f"{kvp['Template']} ({kvp['Page']})"
-        available_metadata = self._get_available_metadata(path, metadata_set_name)
-        if not available_metadata:
-            metadata_creation = self._create_metadata(metadata_set_name, kvp)
-            print(metadata_creation.text)
-            available_metadata = self._get_available_metadata(path, metadata_set_name)
+        metadata_set_name = self._metadata_set_name(kvp)
+        result["set"] = metadata_set_name
+        for attempt in range(2):
+            result["attempts"] = attempt + 1
+            available_metadata = self._get_metadata_set(path, metadata_set_name, kvp)
 
-        data = self._metadata_params(
-            path + "/" + filename,
-            kvp,
-            # self._get_metadata_defaults(metadata_id),
-            available_metadata,
-        )
-        addset_endpoint = "/core/addsettofileobject"
+            data = self._metadata_params(
+                path + "/" + filename,
+                kvp,
+                # self._get_metadata_defaults(metadata_id),
+                available_metadata,
+            )
+            addset_endpoint = "/core/addsettofileobject"
 
-        _addset_params = self._set_metadata_params(data["fullpath"], data["setid"])
-        addset_params = dict_to_params(_addset_params)
-        addset_response = self.session.post(
-            self.server_url + addset_endpoint + f"?{addset_params}"
-        )
+            _addset_params = self._set_metadata_params(data["fullpath"], data["setid"])
+            addset_params = dict_to_params(_addset_params)
+            # Neither request is sent again before the metadata of the file is read
+            # back to see if the failed attempt went through
+            addset_applied, addset_response = self._post_checked(
+                self.session,
+                addset_endpoint + f"?{addset_params}",
+                succeeded=response_succeeded,
+                applied=lambda: self._has_set(
+                    self._read_metadata_values(data["fullpath"]), data["setid"]
+                ),
+            )
 
-        print(parseString(addset_response.text).toprettyxml())
-        metadata_endpoint = "/core/saveattributevalues"
-        saveattribute_response = self.session.post(
-            self.server_url + metadata_endpoint,
-            data=data,
-        )
+            metadata_endpoint = "/core/saveattributevalues"
+            saveattribute_applied, saveattribute_response = self._post_checked(
+                self.session,
+                metadata_endpoint,
+                succeeded=response_succeeded,
+                applied=lambda: not self._missing_values(
+                    data, self._read_metadata_values(data["fullpath"])
+                ),
+                data=data,
+            )
 
-        print(parseString(saveattribute_response.text).toprettyxml())
-        metadata_endpoint = "/core/getmetadatavalues"
-        getmetadata_response = self.session.post(
-            self.server_url + metadata_endpoint,
-            data=data,
-        )
-        print(parseString(getmetadata_response.text).toprettyxml())
+            if addset_applied and saveattribute_applied:
+                result["applied"] = True
+                self._schedule_verification(metadata_set_name, data)
+                return result
+
+            result["responses"] = [
+                response.text if response is not None else None
+                for response in (addset_response, saveattribute_response)
+            ]
+
+            # The cached ids may be stale, e.g. the set was recreated on the server.
+            # Drop them and look the set up again once
+            print(
+                bcolors.WARNING
+                + f"Metadata set {metadata_set_name} was rejected, refreshing"
+                + bcolors.ENDC
+            )
+            self.metadata_cache.invalidate(metadata_set_name)
+
+        return result
+
+    def _upload_chunked(self, path: str, filename: str, file_data) -> bool:
+        """
+        Uploads a file in chunks of chunk_size using the offset and complete
+        parameters of /core/upload. Chunks are read from file_data one at a time,
+        with one chunk of look ahead to know which chunk completes the file. A
+        chunk names its offset, so the request layer sends a failed one again like
+        an idempotent request. The chunk that completes the file is only sent again
+        once FileCloud is found not to have the whole file. If a chunk still fails
+        the offset reached is stored in offset_cache so the next upload of the same
+        file skips what FileCloud already has. A stored offset is only resumed from
+        while FileCloud reports exactly that many bytes of the file, otherwise the
+        file is uploaded from the start
+
+        Parameters
+        ----------
+            path
+                Filecloud folder to upload to
+            filename
+                name of the file in Filecloud
+            file_data
+                readable file object, seekable if an upload is to be resumed
+
+        Returns
+        -------
+            bool
+                True if every chunk was accepted
+        """
+        upload_endpoint = "/core/upload"
+        key = f"{path}/{filename}"
+        offset = self.offset_cache.get(key)
+        if offset and self._remote_size(key) != offset:
+            self._stale_offset(key, filename)
+            offset = 0
+        if offset:
+            print(
+                bcolors.OKCYAN
+                + f"Resuming upload of {filename} from byte {offset}"
+                + bcolors.ENDC
+            )
+            file_data.seek(offset)
+
+        chunk = file_data.read(self.chunk_size)
+        while True:
+            next_chunk = file_data.read(self.chunk_size)
+            complete = not next_chunk
+            params = self._create_upload_api_params(path, filename, offset, complete)
+            try:
+                if complete:
+                    done, upload_call = self._post_checked(
+                        self.session,
+                        upload_endpoint,
+                        succeeded=lambda response: response.text == "OK",
+                        applied=lambda: self._remote_size(key) == offset + len(chunk),
+                        params=params,
+                        files={"file": (filename, chunk)},
+                    )
+                else:
+                    upload_call = self._post(
+                        self.session,
+                        upload_endpoint,
+                        idempotent=True,
+                        params=params,
+                        files={"file": (filename, chunk)},
+                    )
+                    done = upload_call.text == "OK"
+                error = None if done else upload_call.text
+            except requests.RequestException as e:
+                error = f"{type(e).__name__}: {e}"
+            if error is not None:
+                print(
+                    bcolors.WARNING
+                    + f"Chunk at byte {offset} of {filename} failed: {error}"
+                    + bcolors.ENDC
+                )
+                self.offset_cache.put(key, offset)
+                return False
+
+            offset += len(chunk)
+            if complete:
+                break
+            chunk = next_chunk
+
+        self.offset_cache.discard(key)
+        return True
 
     @timerdecorator
     def upload_file(
@@ -331,7 +943,7 @@ class FileCloudController:
         file_data: zipfile.ZipExtFile,
         kvp: List[Dict] | None,
         is_failed: bool = False,
-    ):
+    ) -> bool:
         """
         Upload file to Filecloud and add metadata based on KVP
 
@@ -346,49 +958,45 @@ class FileCloudController:
             kvp
                 Dict containing KVP information extracted from zipfile
 
+        Returns
+        -------
+            bool
+                True if Filecloud accepted the upload
+
         """
         # Determine where file will be uploaded
-        folder_name = ""
-        skriba_path = f"/{self.user}/Skriba"
+        folder_name = self.folder_name(file_data, is_failed)
 
-        if type(file_data) == zipfile.ZipExtFile:
-            pass
-        if is_failed:
-            folder_name = "Failed"
-        else:
-            folder_name = file_data.name.split("/")[-2]
-            file_data.name = filename
+        # Creates Folder, unless it was created before
+        filecloud_path = self.ensure_folder(folder_name)
 
-        file_to_upload = {
-            "file": file_data,
-        }
+        # The member is inflated while it is sent, its reads are timed on their own
+        file_data = metrics.reader(file_data, "zip_inflate")
 
-        # Creates Folder. Does not overwrite existing folder
-        create_folder_endpoint = "/core/createfolder"
-        create_folder_response = self.session.post(
-            self.server_url + create_folder_endpoint,
-            params=self._create_folder_params(
-                skriba_path,
-                folder_name,
-            ),
-            cookies=self.cookies,
-        )
-        if folder_name == "Failed":
-            pass
-
-        print(create_folder_response.text)
+        if self.chunk_size:
+            uploaded = self._upload_chunked(filecloud_path, filename, file_data)
+        else:
+            # The file is sent under filename, its own name is the zip member path
+            file_to_upload = {
+                "file": (filename, file_data),
+            }
+            upload_api_params = self._create_upload_api_params(filecloud_path, filename)
 
-        filecloud_path = f"{skriba_path}/{folder_name}"
-        upload_api_params = self._create_upload_api_params(filecloud_path, filename)
+            upload_endpoint = "/core/upload"
+            fullpath = f"{filecloud_path}/{filename}"
+            start = file_data.tell()
+            uploaded, upload_call = self._post_checked(
+                self.session,
+                upload_endpoint,
+                succeeded=lambda response: response.text == "OK",
+                applied=lambda: self._uploaded(fullpath, file_data, start),
+                params=upload_api_params,
+                files=file_to_upload,
+            )
+            if not uploaded and upload_call is not None:
+                print(upload_call.text)
 
-        upload_endpoint = "/core/upload"
-        upload_call = self.session.post(
-            self.server_url + upload_endpoint,
-            params=upload_api_params,
-            files=file_to_upload,
-            cookies=self.cookies,
-        )
-        if (upload_call.text) == "OK":
+        if uploaded:
             print(
                 bcolors.OKGREEN
                 + f"Successfuly uploaded {filename} to Filecloud at {filecloud_path}"
@@ -396,14 +1004,24 @@ class FileCloudController:
             )
             if kvp:
                 print(bcolors.OKCYAN + "Adding Metadata" + bcolors.ENDC)
-                for _kvp in kvp:
-                    self._add_metadata(filecloud_path, filename, _kvp)
+                metadata_sets = group_metadata_sets(kvp, self.merge_policy)
+                for _kvp in metadata_sets.values():
+                    metadata_result = self._add_metadata(filecloud_path, filename, _kvp)
+                    if not metadata_result["applied"]:
+                        print(
+                            bcolors.FAIL
+                            + f"Could not add {metadata_result['set']} to {filename}"
+                            + bcolors.ENDC
+                        )
             else:
                 print(bcolors.WARNING + "No KVP found attached to file" + bcolors.ENDC)
+            return True
         else:
             print(
                 bcolors.FAIL
                 + f"Something went wrong with uploading {filename}"
                 + bcolors.ENDC
             )
-            print(upload_call.text)
+            # The folder may have been removed on the server since it was created
+            self.folder_cache.discard(filecloud_path)
+            return False
@@ -0,0 +1,38 @@
+from typing import Set
+
+from .json_store import JSONStore
+
+
+class FolderCache:
+    """Set of FileCloud folder paths known to exist.
+
+    Folders are only ever created by the uploader and never removed by it, so once
+    createfolder went through for a path it does not need to be sent again for the
+    rest of the session. With a path the set is kept in a JSON file between runs.
+
+    Parameters
+    ----------
+        path
+            JSON file the known folders are loaded from and saved to
+    """
+
+    def __init__(self, path: str | None = None):
+        self._store = JSONStore(path)
+        self._folders: Set[str] = set(self._store.load([]))
+        self._lock = self._store.lock
+
+    def __contains__(self, folder: str) -> bool:
+        with self._lock:
+            return folder in self._folders
+
+    def add(self, folder: str):
+        with self._lock:
+            if folder not in self._folders:
+                self._folders.add(folder)
+                self._store.save(sorted(self._folders))
+
+    def discard(self, folder: str):
+        with self._lock:
+            if folder in self._folders:
+                self._folders.discard(folder)
+                self._store.save(sorted(self._folders))
@@ -0,0 +1,206 @@
+import ftplib
+import queue
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, TypeVar
+
+from .utils import bcolors
+
+T = TypeVar("T")
+
+# Errors after which a connection can no longer be trusted and is replaced
+RECONNECT_ERRORS = (ftplib.error_temp, ftplib.error_reply, EOFError, OSError)
+
+
+# Needed to connect to new FTP server
+class MyFTP_TLS(ftplib.FTP_TLS):
+    """Explicit FTPS, with shared TLS session"""
+
+    # TLS session of another control connection to resume when securing this one
+    tls_session: ssl.SSLSession | None = None
+
+    def auth(self):
+        resp = self.voidcmd("AUTH TLS")
+        self.sock = self.context.wrap_socket(
+            self.sock, server_hostname=self.host, session=self.tls_session
+        )
+        self.file = self.sock.makefile(mode="r", encoding=self.encoding)
+        return resp
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(
+                conn, server_hostname=self.host, session=self.sock.session
+            )  # this is the fix
+        return conn, size
+
+
+class FTPConnectionPool:
+    """Pool of logged in FTP(S) connections shared by threads.
+
+    Connections are created lazily up to `size`. FTPS connections share one SSL
+    context and resume the TLS session of the first connection, so only the first
+    login pays for a full handshake. A connection that was idle for longer than
+    `health_check_after` is checked with NOOP before it is handed out, and one idle
+    for longer than `idle_timeout` is assumed to be dropped by the server and
+    replaced.
+
+    Parameters
+    ----------
+        server
+            FTP server host
+        user
+            FTP username
+        passwd
+            FTP password
+        size
+            Maximum number of open connections
+        idle_timeout
+            Seconds after which an idle connection is replaced without checking
+        health_check_after
+            Seconds after which an idle connection is checked with NOOP
+    """
+
+    def __init__(
+        self,
+        server: str,
+        user: str,
+        passwd: str,
+        size: int = 4,
+        port: int = 21,
+        idle_timeout: float = 240.0,
+        health_check_after: float = 15.0,
+    ):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.server = server
+        self.user = user
+        self.passwd = passwd
+        self.size = size
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._use_tls = True
+        # Same unverified context ftplib.FTP_TLS uses by default, but shared by
+        # all connections so their TLS sessions can be resumed
+        self._context = ssl.create_default_context()
+        self._context.check_hostname = False
+        self._context.verify_mode = ssl.CERT_NONE
+        self._tls_session: ssl.SSLSession | None = None
+
+    def _connect(self) -> ftplib.FTP:
+        """Logs in a new connection. Falls back to plain FTP when the server refuses
+        TLS, and remembers that for the next connections"""
+        if self._use_tls:
+            try:
+                ftp = MyFTP_TLS(context=self._context)
+                ftp.tls_session = self._tls_session
+                # ftp.set_debuglevel(2)
+                ftp.connect(self.server, port=self.port)
+                ftp.login(user=self.user, passwd=self.passwd)
+                ftp.prot_p()
+                ftp.cwd("~")
+                ftp.encoding = "utf-8"
+                with self._lock:
+                    if self._tls_session is None:
+                        self._tls_session = ftp.sock.session
+                return ftp
+            except ftplib.error_perm:
+                self._use_tls = False
+
+        ftp = ftplib.FTP()
+        # ftp.set_debuglevel(2)
+        ftp.connect(self.server, port=self.port)
+        ftp.login(user=self.user, passwd=self.passwd)
+        ftp.cwd("~")
+        ftp.encoding = "utf-8"
+        return ftp
+
+    @staticmethod
+    def _close(ftp: ftplib.FTP):
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+    def _healthy(self, ftp: ftplib.FTP, idle_for: float) -> bool:
+        if idle_for > self.idle_timeout:
+            return False
+        if idle_for > self.health_check_after:
+            try:
+                ftp.voidcmd("NOOP")
+            except RECONNECT_ERRORS + (ftplib.error_perm,):
+                return False
+        return True
+
+    def acquire(self) -> ftplib.FTP:
+        """Takes a healthy connection out of the pool, opening a new one if needed.
+        Blocks while `size` connections are in use"""
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    ftp, returned_at = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._healthy(ftp, time.monotonic() - returned_at):
+                    return ftp
+                self._close(ftp)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, ftp: ftplib.FTP, discard: bool = False):
+        """Returns a connection to the pool. Discarded connections are closed"""
+        if discard:
+            self._close(ftp)
+        else:
+            self._idle.put((ftp, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Borrows a connection for the duration of the with block. The connection
+        is discarded if the block fails with a connection level error"""
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except RECONNECT_ERRORS:
+            self.release(ftp, discard=True)
+            raise
+        except BaseException:
+            self.release(ftp)
+            raise
+        else:
+            self.release(ftp)
+
+    def run(self, func: Callable[[ftplib.FTP], T], retries: int = 1) -> T:
+        """Calls func with a pooled connection. On error_temp, a dropped connection or
+        a timeout the call is retried on a fresh connection up to `retries` times"""
+        for attempt in range(retries + 1):
+            try:
+                with self.connection() as ftp:
+                    return func(ftp)
+            except RECONNECT_ERRORS as e:
+                if attempt == retries:
+                    raise
+                print(
+                    bcolors.WARNING
+                    + f"FTP connection error ({e}), reconnecting"
+                    + bcolors.ENDC
+                )
+
+    def close(self):
+        while True:
+            try:
+                ftp, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(ftp)
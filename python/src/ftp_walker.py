@@ -0,0 +1,295 @@
+import calendar
+import ftplib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, NamedTuple, Tuple
+
+from .config import OUTPUT_REGEX, SKIP_REGEX
+from .ftp_pool import FTPConnectionPool
+from .metrics import metrics
+
+MLSD_FACTS = ["type", "size", "modify"]
+# Replies of servers that do not implement MLSD
+UNSUPPORTED_CODES = ("500", "501", "502", "504")
+
+MONTHS = {
+    month: index
+    for index, month in enumerate(
+        "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split(), start=1
+    )
+}
+
+
+class WalkEntry(NamedTuple):
+    """Entry found while walking the FTP server or a local directory
+
+    path
+        Full path of the entry, as NLST would have returned it
+    name
+        Last component of path
+    type
+        "dir" or "file"
+    size
+        Size in bytes, None if the server did not report it
+    modify
+        Modification time as YYYYMMDDHHMMSS (UTC for MLSD), None if unknown
+    """
+
+    path: str
+    name: str
+    type: str
+    size: int | None
+    modify: str | None
+
+    @property
+    def is_dir(self) -> bool:
+        return self.type == "dir"
+
+
+def _join(folder: str, name: str) -> str:
+    return f"{folder.rstrip('/')}/{name}" if folder else name
+
+
+def parse_mlsd(folder: str, listing: Iterable) -> List[WalkEntry]:
+    entries = []
+    for name, facts in listing:
+        _type = facts.get("type", "").lower()
+        if _type not in ("dir", "file"):
+            # cdir, pdir and OS specific types such as symlinks
+            continue
+        size = facts.get("size")
+        modify = facts.get("modify")
+        entries.append(
+            WalkEntry(
+                path=_join(folder, name),
+                name=name,
+                type=_type,
+                size=int(size) if size and size.isdigit() else None,
+                modify=modify[:14] if modify else None,
+            )
+        )
+
+    return entries
+
+
+def _unix_modify(month: str, day: str, year_or_time: str) -> str | None:
+    if month not in MONTHS or not day.isdigit():
+        return None
+    if ":" in year_or_time:
+        # Files of the last six months show the time instead of the year, a date
+        # that would be in the future is from the previous year
+        year = time.gmtime().tm_year
+        hour, minute = year_or_time.split(":")
+        modified = calendar.timegm(
+            (year, MONTHS[month], int(day), int(hour), int(minute), 0)
+        )
+        if modified > time.time() + 24 * 60 * 60:
+            year -= 1
+    else:
+        year, hour, minute = year_or_time, "00", "00"
+    return (
+        f"{int(year):04}{MONTHS[month]:02}{int(day):02}"
+        f"{int(hour):02}{int(minute):02}00"
+    )
+
+
+def _dos_modify(date: str, _time: str) -> str | None:
+    match = re.match(r"(\d{2})-(\d{2})-(\d{2,4})", date)
+    time_match = re.match(r"(\d{1,2}):(\d{2})(AM|PM)?", _time, re.IGNORECASE)
+    if not match or not time_match:
+        return None
+    month, day, year = match.groups()
+    year = int(year) + 2000 if len(year) == 2 else int(year)
+    hour, minute, meridiem = time_match.groups()
+    hour = int(hour) % 12 + (12 if meridiem and meridiem.upper() == "PM" else 0)
+    return f"{year:04}{int(month):02}{int(day):02}{hour:02}{minute}00"
+
+
+def parse_list(folder: str, lines: Iterable[str]) -> List[WalkEntry]:
+    """Parses Unix style (ls -l) and DOS style (IIS) LIST output"""
+    entries = []
+    for line in lines:
+        if not line or line.startswith("total "):
+            continue
+
+        if line[0] in "-dl" and len(line.split(None, 8)) == 9:
+            perms, _, _, _, size, month, day, year_or_time, name = line.split(None, 8)
+            if perms[0] == "l" or name in (".", ".."):
+                continue
+            entries.append(
+                WalkEntry(
+                    path=_join(folder, name),
+                    name=name,
+                    type="dir" if perms[0] == "d" else "file",
+                    size=int(size) if size.isdigit() else None,
+                    modify=_unix_modify(month, day, year_or_time),
+                )
+            )
+            continue
+
+        parts = line.split(None, 3)
+        if len(parts) == 4 and re.match(r"\d{2}-\d{2}-\d{2,4}$", parts[0]):
+            date, _time, size, name = parts
+            is_dir = size.upper() == "<DIR>"
+            entries.append(
+                WalkEntry(
+                    path=_join(folder, name),
+                    name=name,
+                    type="dir" if is_dir else "file",
+                    size=None if is_dir or not size.isdigit() else int(size),
+                    modify=_dos_modify(date, _time),
+                )
+            )
+
+    return entries
+
+
+class FTPWalker:
+    """Walks the FTP server with one listing command per directory.
+
+    Listings use MLSD, which returns the type, size and modify time of every entry,
+    so directories never have to be guessed from their names and files never need a
+    listing of their own. Servers without MLSD fall back to parsing LIST output.
+    Directories of the same depth are listed concurrently over the connection pool.
+
+    Parameters
+    ----------
+        pool
+            Connection pool used for the listings
+        skip_regex
+            Patterns of paths that are not descended into while looking for Output
+            folders. The contents of the Output folders are never skipped
+        max_workers
+            Number of directories listed at the same time
+    """
+
+    def __init__(
+        self,
+        pool: FTPConnectionPool,
+        skip_regex: List[str] | None = None,
+        max_workers: int | None = None,
+    ):
+        self.pool = pool
+        skip_regex = SKIP_REGEX if skip_regex is None else skip_regex
+        self.skip_regex = [re.compile(regex) for regex in skip_regex]
+        self.output_regex = re.compile(OUTPUT_REGEX)
+        self.max_workers = max_workers if max_workers else pool.size
+        self.use_mlsd = True
+
+    def _skip(self, path: str) -> bool:
+        return any(regex.search(path) for regex in self.skip_regex)
+
+    def _listdir(self, ftp: ftplib.FTP, folder: str) -> List[WalkEntry]:
+        if self.use_mlsd:
+            try:
+                return parse_mlsd(folder, ftp.mlsd(folder, facts=MLSD_FACTS))
+            except ftplib.error_perm as e:
+                if not str(e).startswith(UNSUPPORTED_CODES):
+                    raise
+                self.use_mlsd = False
+
+        lines = []
+        ftp.retrlines(f"LIST {folder}" if folder else "LIST", lines.append)
+        return parse_list(folder, lines)
+
+    def listdir(self, folder: str, skip: bool = False) -> List[WalkEntry]:
+        """Lists one directory. With skip, paths matching skip_regex are left out"""
+        with metrics.span("ftp_list"):
+            entries = self.pool.run(lambda ftp: self._listdir(ftp, folder))
+        if not skip:
+            return entries
+        return [entry for entry in entries if not self._skip(entry.path)]
+
+    def _map(self, func: Callable, folders: List[str]) -> List:
+        if len(folders) < 2:
+            return [func(folder) for folder in folders]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(func, folders))
+
+    def find_output_dirs(self, folder: str) -> List[str]:
+        """Looks for Output folders breadth first and returns their paths. A folder
+        that contains an Output folder is not searched any further"""
+        frontier = [folder]
+        output_dirs = []
+        while frontier:
+            next_frontier = []
+            listings = self._map(lambda path: self.listdir(path, skip=True), frontier)
+            for entries in listings:
+                dirs = [entry for entry in entries if entry.is_dir]
+                outputs = [
+                    entry for entry in dirs if self.output_regex.search(entry.path)
+                ]
+                if outputs:
+                    output_dirs.append(outputs[0].path)
+                else:
+                    next_frontier.extend(entry.path for entry in dirs)
+            frontier = next_frontier
+
+        return output_dirs
+
+    def find_output_folders(self, folder: str) -> List[WalkEntry]:
+        """Contents of the Output folders found by find_output_dirs"""
+        output_entries = []
+        for entries in self._map(self.listdir, self.find_output_dirs(folder)):
+            output_entries.extend(entries)
+
+        return output_entries
+
+    def walk(
+        self,
+        folder: str,
+        predicate: Callable[[WalkEntry], bool] | None = None,
+        cached: Callable[[WalkEntry], List[WalkEntry] | None] | None = None,
+        root: WalkEntry | None = None,
+    ) -> Tuple[List[WalkEntry], List[WalkEntry]]:
+        """Returns every file below folder, level by level, that matches predicate
+
+        Parameters
+        ----------
+            cached
+                Called with every directory entry before it is listed. If it returns
+                a list, those files are used for the directory and everything below
+                it instead of listing it
+            root
+                Entry of folder itself, so folder can be served from cached too
+
+        Returns
+        -------
+            Tuple[List[WalkEntry], List[WalkEntry]]
+                matching files, and the directories that were actually listed
+        """
+        files = []
+        listed = []
+        if cached and root:
+            _files = cached(root)
+            if _files is not None:
+                return _files, listed
+
+        frontier = [root if root else WalkEntry(folder, folder, "dir", None, None)]
+        while frontier:
+            next_frontier = []
+            listings = self._map(self.listdir, [entry.path for entry in frontier])
+            for folder_entry, entries in zip(frontier, listings):
+                listed.append(folder_entry)
+                for entry in entries:
+                    if not entry.is_dir:
+                        if predicate is None or predicate(entry):
+                            files.append(entry)
+                        continue
+                    _files = cached(entry) if cached else None
+                    if _files is None:
+                        next_frontier.append(entry)
+                    else:
+                        files.extend(_files)
+            frontier = next_frontier
+
+        return files, listed
+
+    def walk_files(
+        self,
+        folder: str,
+        predicate: Callable[[WalkEntry], bool] | None = None,
+    ) -> List[WalkEntry]:
+        """Returns every file below folder, level by level, that matches predicate"""
+        return self.walk(folder, predicate)[0]
@@ -0,0 +1,52 @@
+import json
+import os
+import threading
+
+
+class JSONStore:
+    """JSON file a cache is kept in between runs.
+
+    The file is rewritten as a whole on every save, through a temporary file that
+    replaces it, so readers never see a partial write. A missing or unreadable file
+    loads as empty. Without a path nothing is read or written. The lock guards the
+    file and is shared with the cache using the store, which holds it around its
+    own state and every save.
+
+    Parameters
+    ----------
+        path
+            JSON file, None to keep the cache in memory only
+        mode
+            Permissions of a newly written file, before the umask
+    """
+
+    def __init__(self, path: str | None = None, mode: int = 0o666):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+
+    def load(self, default=None):
+        """Contents of the file, default if there is none or it cannot be parsed"""
+        if not self.path:
+            return default
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return default
+
+    def save(self, data):
+        """Writes data atomically. Called with the lock held"""
+        if not self.path:
+            return
+        # Processes sharing the file each write their own temporary file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.mode)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
@@ -0,0 +1,224 @@
+import datetime
+import io
+import posixpath
+import re
+import zipfile
+from typing import Dict, Iterator, List, Tuple
+from xml.etree import ElementTree
+
+from .records import KVPRow, KVPSheet
+
+NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# Columns of the Batch KVP Spreadsheet template sheets. The first three hold the
+# template, page and file name, the key value pairs start at the seventh column
+# and alternate with columns that are not needed
+TEMPLATE_COLUMNS = slice(0, 3)
+KVP_COLUMNS = slice(6, None, 2)
+
+# Built-in number formats that display dates
+DATE_FORMAT_IDS = set(range(14, 23)) | {45, 46, 47}
+DATE_FORMAT_REGEX = re.compile(r"[dmyhs]", re.IGNORECASE)
+EXCEL_EPOCH = datetime.datetime(1899, 12, 30)
+
+DIGITS = "0123456789"
+
+
+def _column_index(ref: str) -> int:
+    index = 0
+    for char in ref:
+        index = index * 26 + ord(char) - 64
+    return index - 1
+
+
+def _text(element: ElementTree.Element | None) -> str:
+    """Text of a <si> or <is> element, joining rich text runs"""
+    if element is None:
+        return ""
+    return "".join(t.text or "" for t in element.iter(f"{NS}t"))
+
+
+def _headers(row: List, width: int) -> List[str]:
+    """Column names the way pandas names them: blank headers become "Unnamed: n"
+    and repeated ones get a ".n" suffix"""
+    headers = []
+    seen: Dict[str, int] = {}
+    for index in range(width):
+        value = row[index] if index < len(row) else None
+        name = f"Unnamed: {index}" if value is None else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        headers.append(name)
+
+    return headers
+
+
+class KVPSpreadsheet:
+    """Streaming reader for the Batch KVP Spreadsheet.xlsx produced by Skriba.
+
+    Replaces pd.ExcelFile for this one layout. Only the compressed xlsx is held in
+    memory. Sheet XML is parsed incrementally straight from it without building
+    DataFrames, one row at a time, and key value records are yielded sheet by sheet.
+    Empty cells are returned as None.
+
+    Parameters
+    ----------
+        fileobj
+            Binary file object of the xlsx, e.g. the ZipExtFile of the spreadsheet
+            inside the job zip
+    """
+
+    def __init__(self, fileobj):
+        data = fileobj.read()
+        self.name = getattr(fileobj, "name", "")
+        self._xlsx = zipfile.ZipFile(io.BytesIO(data))
+        self._shared_strings = self._read_shared_strings()
+        self._date_styles = self._read_date_styles()
+        self._sheets = self._read_sheets()
+
+    @property
+    def sheet_names(self) -> List[str]:
+        return [name for name, _ in self._sheets]
+
+    def _read_sheets(self) -> List[Tuple[str, str]]:
+        """Sheet names in workbook order with the path of their XML part"""
+        rels = ElementTree.fromstring(self._xlsx.read("xl/_rels/workbook.xml.rels"))
+        targets = {}
+        for rel in rels.iter(f"{PKG_REL_NS}Relationship"):
+            target = rel.get("Target")
+            if target.startswith("/"):
+                target = target.lstrip("/")
+            else:
+                target = posixpath.normpath(posixpath.join("xl", target))
+            targets[rel.get("Id")] = target
+
+        workbook = ElementTree.fromstring(self._xlsx.read("xl/workbook.xml"))
+        return [
+            (sheet.get("name"), targets[sheet.get(f"{REL_NS}id")])
+            for sheet in workbook.iter(f"{NS}sheet")
+        ]
+
+    def _read_shared_strings(self) -> List[str]:
+        try:
+            stream = self._xlsx.open("xl/sharedStrings.xml")
+        except KeyError:
+            return []
+        return [_text(element) for element in ElementTree.parse(stream).getroot()]
+
+    def _read_date_styles(self) -> set:
+        """Indexes of the cell styles whose number format is a date"""
+        try:
+            styles = ElementTree.fromstring(self._xlsx.read("xl/styles.xml"))
+        except KeyError:
+            return set()
+        date_formats = set(DATE_FORMAT_IDS)
+        for num_fmt in styles.iter(f"{NS}numFmt"):
+            # Strip quoted literals and colors before looking for date tokens
+            code = re.sub(r'"[^"]*"|\[[^\]]*\]', "", num_fmt.get("formatCode", ""))
+            if DATE_FORMAT_REGEX.search(code):
+                date_formats.add(int(num_fmt.get("numFmtId")))
+
+        cell_xfs = styles.find(f"{NS}cellXfs")
+        if cell_xfs is None:
+            return set()
+        return {
+            index
+            for index, xf in enumerate(cell_xfs.findall(f"{NS}xf"))
+            if int(xf.get("numFmtId", 0)) in date_formats
+        }
+
+    def _value(self, _type: str | None, style: str | None, value: str | None):
+        if value is None:
+            return None
+        if _type == "s":
+            return self._shared_strings[int(value)]
+        if _type in ("str", "e"):
+            return value
+        if _type == "b":
+            return value == "1"
+
+        number = float(value)
+        if style and int(style) in self._date_styles:
+            return EXCEL_EPOCH + datetime.timedelta(days=number)
+        return int(number) if number.is_integer() else number
+
+    def rows(self, sheet_name: str) -> Iterator[List]:
+        """Yields the rows of a sheet as lists of cell values. Rows the sheet skips are
+        yielded as empty lists so row positions are kept
+
+        The sheet XML is decompressed and parsed as it is read, and the cells of
+        every <row> are cleared once it is yielded, so only one row of cells is held
+        at a time"""
+        path = dict(self._sheets)[sheet_name]
+        next_row = 1
+        with self._xlsx.open(path) as stream:
+            for _, element in ElementTree.iterparse(stream):
+                if element.tag != f"{NS}row":
+                    continue
+                row_number = int(element.get("r", next_row))
+                for _ in range(next_row, row_number):
+                    yield []
+                next_row = row_number + 1
+                yield self._row_values(element)
+                element.clear()
+
+    def _row_values(self, element: ElementTree.Element) -> List:
+        """Cell values of a <row>, None for the cells it skips"""
+        values: List = []
+        for cell in element.iterfind(f"{NS}c"):
+            ref = cell.get("r")
+            index = _column_index(ref.rstrip(DIGITS)) if ref else len(values)
+            if index > len(values):
+                values.extend([None] * (index - len(values)))
+            _type = cell.get("t")
+            if _type == "inlineStr":
+                value = _text(cell.find(f"{NS}is"))
+            else:
+                value = self._value(_type, cell.get("s"), cell.findtext(f"{NS}v"))
+            values.append(value)
+        while values and values[-1] is None:
+            values.pop()
+
+        return values
+
+    def records(self, sheet_name: str) -> List[KVPRow]:
+        """Rows of a sheet keyed by the header row, keeping only the template and key
+        value pair columns. Rows without any value are left out
+
+        The rows are kept until the sheet is read, since the columns are those of
+        its widest row. A sheet holds the rows of one batch, and group_by_filename
+        keeps every record of the batch anyway"""
+        rows = list(self.rows(sheet_name))
+        while rows and not rows[-1]:
+            rows.pop()
+        if len(rows) < 2:
+            return []
+
+        width = max(len(row) for row in rows)
+        headers = _headers(rows[0], width)
+        indexes = list(range(width))
+        columns = indexes[TEMPLATE_COLUMNS] + indexes[KVP_COLUMNS]
+
+        sheet = KVPSheet(sheet_name, [headers[index] for index in columns])
+        records = []
+        for row in rows[1:]:
+            if not row:
+                continue
+            if len(row) < width:
+                row = row + [None] * (width - len(row))
+            records.append(KVPRow(sheet, tuple([row[index] for index in columns])))
+
+        return records
+
+    def kvp_records(self) -> Iterator[Tuple[str, List[KVPRow]]]:
+        """Yields (sheet name, records) for every template sheet. The first sheet is
+        the summary sheet and is skipped"""
+        for sheet_name in self.sheet_names[1:]:
+            records = self.records(sheet_name)
+            if records:
+                yield sheet_name, records
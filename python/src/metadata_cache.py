@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict
+
+from .json_store import JSONStore
+
+
+class MetadataSetCache:
+    """Cache from metadata set name to the setid and attribute ids FileCloud assigned.
+
+    Entries expire after `ttl` seconds and the least recently used entries are
+    evicted past `max_size`. get_or_load runs at most one loader per set name at a
+    time, so concurrent uploads needing a missing set create it only once. With a
+    path the cache is kept in a JSON file between runs.
+
+    Parameters
+    ----------
+        max_size
+            Maximum number of metadata sets kept
+        ttl
+            Seconds an entry stays valid
+        path
+            JSON file the cache is loaded from and saved to
+    """
+
+    def __init__(
+        self,
+        max_size: int = 256,
+        ttl: float = 3600.0,
+        path: str | None = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._store = JSONStore(path)
+        self._entries: OrderedDict[str, Dict] = OrderedDict()
+        self._lock = self._store.lock
+        self._loading: Dict[str, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        now = time.time()
+        for name, entry in self._store.load({}).items():
+            if now - entry["stored_at"] < self.ttl:
+                self._entries[name] = entry
+
+    def get(self, name: str) -> Dict | None:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            if time.time() - entry["stored_at"] >= self.ttl:
+                del self._entries[name]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return entry["value"]
+
+    def put(self, name: str, value: Dict):
+        with self._lock:
+            self._entries[name] = {"value": value, "stored_at": time.time()}
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._store.save(self._entries)
+
+    def invalidate(self, name: str):
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                self._store.save(self._entries)
+
+    def get_or_load(self, name: str, loader: Callable[[], Dict]) -> Dict:
+        """Returns the cached set or calls loader to fetch or create it. Callers asking
+        for the same name wait for the first loader instead of running their own.
+        Empty results are not cached"""
+        value = self.get(name)
+        if value is not None:
+            return value
+
+        with self._lock:
+            name_lock = self._loading.setdefault(name, threading.Lock())
+        with name_lock:
+            value = self.get(name)
+            if value is None:
+                value = loader()
+                if value:
+                    self.put(name, value)
+        with self._lock:
+            if self._loading.get(name) is name_lock and not name_lock.locked():
+                del self._loading[name]
+
+        return value
@@ -0,0 +1,351 @@
+import bisect
+import contextvars
+import io
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets, +Inf is implied
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# Job code, file name etc. of the work the current thread or task is doing
+_context: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar(
+    "metrics_context", default={}
+)
+
+
+def _key(labels: Dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _prometheus_labels(key: Tuple[Tuple[str, str], ...], **extra) -> str:
+    pairs = list(key) + [(name, str(value)) for name, value in extra.items()]
+    if not pairs:
+        return ""
+    escaped = (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, value in pairs
+    )
+    return (
+        "{"
+        + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped))
+        + "}"
+    )
+
+
+class Histogram:
+    """Bucketed observations of one metric and label set"""
+
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """(upper bound, observations at or below it) of every bucket"""
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        total = 0
+        cumulative = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def as_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": dict(self.cumulative()),
+        }
+
+
+class Span:
+    """Times a stage between __enter__ and __exit__, see Metrics.span"""
+
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: Dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics._finish(self, time.perf_counter() - self.start, exc_type)
+
+
+class _NoopSpan:
+    """Handed out by a disabled Metrics, so a span costs one attribute check"""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class TimedReader(io.IOBase):
+    """Wraps a file object and observes every read and seek of it in
+    stage_seconds{stage=...}, see Metrics.reader"""
+
+    def __init__(self, metrics: "Metrics", file, stage: str):
+        self.metrics = metrics
+        self.file = file
+        self.stage = stage
+
+    @property
+    def name(self) -> str:
+        return self.file.name
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self.file.seekable()
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        tic = time.perf_counter()
+        data = self.file.read(size)
+        self.metrics.observe(
+            "stage_seconds", time.perf_counter() - tic, stage=self.stage
+        )
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # Seeking a compressed member inflates everything up to the new position
+        tic = time.perf_counter()
+        position = self.file.seek(offset, whence)
+        self.metrics.observe(
+            "stage_seconds", time.perf_counter() - tic, stage=self.stage
+        )
+        return position
+
+
+class Metrics:
+    """Counters, histograms and spans of a run, exported as Prometheus text or as a
+    JSON report.
+
+    Labels should only take a few values (stage, endpoint, function), they make up
+    the series of the counters and histograms. Details of a single piece of work
+    like the job code or file name are set with `context` and only kept on the
+    spans recorded while it is active. A disabled instance records nothing and its
+    spans are a shared no-op object.
+
+    Stages timed by this package:
+        ftp_list        listing of one FTP directory
+        ftp_retr        RETR of a whole zip, or of one block in ZipMode.RANGE
+        zip_open        fetching a job zip and reading its member list
+        xlsx_parse      reading the KVP rows of one Batch Spreadsheet
+        upload          upload of one file with its metadata
+        zip_inflate     one read or seek of a Searchable PDF in its zip while it
+                        is uploaded, see reader. Not kept as spans
+    and every FileCloud request is observed in http_request_seconds.
+
+    Parameters
+    ----------
+        enabled
+            Whether anything is recorded
+        max_spans
+            Number of most recent spans kept for the report
+        buckets
+            Upper bounds in seconds of the histogram buckets
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        max_spans: int = 10000,
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.enabled = enabled
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Tuple, float]] = {}
+        self._histograms: Dict[str, Dict[Tuple, Histogram]] = {}
+        self._spans: deque = deque(maxlen=max_spans)
+        self._dropped_spans = 0
+        self._started = time.time()
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._spans.clear()
+            self._dropped_spans = 0
+            self._started = time.time()
+            self._origin = time.perf_counter()
+
+    def count(self, name: str, value: float = 1, **labels):
+        """Adds value to the counter name, e.g. ftp_retr_bytes_total"""
+        if not self.enabled:
+            return
+        key = _key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Adds an observation to the histogram name, e.g. http_request_seconds"""
+        if not self.enabled:
+            return
+        key = _key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(self.buckets)
+            series[key].observe(value)
+
+    def span(self, stage: str, **labels) -> Span | _NoopSpan:
+        """Context manager timing one stage into stage_seconds{stage=...}. Spans
+        that raise are also counted in stage_errors_total"""
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, stage, labels)
+
+    def reader(self, file, stage: str) -> TimedReader:
+        """Wraps file so every read and seek of it is timed into
+        stage_seconds{stage=...}, for reads that are interleaved with other work,
+        e.g. a zip member inflated while it is being sent. Reads are too many to be
+        kept as spans. A disabled instance returns file itself"""
+        if not self.enabled:
+            return file
+        return TimedReader(self, file, stage)
+
+    def _finish(self, span: Span, seconds: float, exc_type):
+        labels = {"stage": span.name, **span.labels}
+        self.observe("stage_seconds", seconds, **labels)
+        if exc_type is not None:
+            self.count("stage_errors_total", **labels)
+        record = {
+            "stage": span.name,
+            "start": round(span.start - self._origin, 6),
+            "seconds": round(seconds, 6),
+            "labels": span.labels,
+            "context": _context.get(),
+            "error": exc_type.__name__ if exc_type else None,
+        }
+        with self._lock:
+            if len(self._spans) == self._spans.maxlen:
+                self._dropped_spans += 1
+            self._spans.append(record)
+
+    @contextmanager
+    def context(self, **context) -> Iterator[Dict[str, str]]:
+        """Attaches context, e.g. job and filename, to the spans recorded in this
+        thread or task until the block exits. Nested contexts are merged"""
+        if not self.enabled:
+            yield {}
+            return
+        merged = {**_context.get(), **{k: str(v) for k, v in context.items()}}
+        token = _context.set(merged)
+        try:
+            yield merged
+        finally:
+            _context.reset(token)
+
+    def report(self) -> Dict:
+        """Everything recorded, as plain dicts for a JSON run report"""
+        with self._lock:
+            return {
+                "started": self._started,
+                "seconds": time.perf_counter() - self._origin,
+                "counters": {
+                    name: [
+                        {"labels": dict(key), "value": value}
+                        for key, value in series.items()
+                    ]
+                    for name, series in self._counters.items()
+                },
+                "histograms": {
+                    name: [
+                        {"labels": dict(key), **histogram.as_dict()}
+                        for key, histogram in series.items()
+                    ]
+                    for name, series in self._histograms.items()
+                },
+                "spans": list(self._spans),
+                "dropped_spans": self._dropped_spans,
+            }
+
+    def prometheus(self) -> str:
+        """Counters and histograms in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_prometheus_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    for bound, count in histogram.cumulative():
+                        labels = _prometheus_labels(key, le=bound)
+                        lines.append(f"{name}_bucket{labels} {count}")
+                    labels = _prometheus_labels(key)
+                    lines.append(f"{name}_sum{labels} {histogram.sum}")
+                    lines.append(f"{name}_count{labels} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Writes the Prometheus text if path ends with .prom, the JSON report
+        otherwise"""
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.report(), f, indent=2, default=str)
+
+
+# Shared by the whole package, enabled by app.py --metrics
+metrics = Metrics()
@@ -0,0 +1,116 @@
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+
+class KVPSheet:
+    """Column names of one template sheet, stored once and shared by its rows
+
+    Parameters
+    ----------
+        name
+            Sheet name
+        columns
+            Names of the template and key value pair columns, in sheet order
+    """
+
+    __slots__ = ("name", "columns", "index")
+
+    def __init__(self, name: str, columns: Sequence[str]):
+        self.name = name
+        self.columns: Tuple[str, ...] = tuple(columns)
+        self.index: Dict[str, int] = {
+            column: position for position, column in enumerate(self.columns)
+        }
+
+    def __repr__(self) -> str:
+        return f"KVPSheet({self.name!r}, {len(self.columns)} columns)"
+
+
+class KVPRow(Mapping):
+    """One row of a template sheet. Reads like the dict of column name to value it
+    replaces, but only holds a tuple of values and a reference to its sheet
+
+    Parameters
+    ----------
+        sheet
+            Sheet the row belongs to
+        values
+            Cell values, in the order of sheet.columns
+    """
+
+    __slots__ = ("sheet", "values")
+
+    def __init__(self, sheet: KVPSheet, values: Tuple):
+        self.sheet = sheet
+        self.values = values
+
+    def __getitem__(self, column: str):
+        return self.values[self.sheet.index[column]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.sheet.columns)
+
+    def __len__(self) -> int:
+        return len(self.sheet.columns)
+
+    def __repr__(self) -> str:
+        return f"KVPRow({dict(self)!r})"
+
+
+class Document:
+    """A Searchable PDF of a job and its KVP rows
+
+    Parameters
+    ----------
+        filename
+            Name the PDF is uploaded as, see zip_manifest.searchable_filename
+        pdf_file
+            File object of the PDF, or its member name while sent between
+            processes
+        kvp
+            KVP rows of the PDF, None if the spreadsheet had none
+    """
+
+    __slots__ = ("filename", "pdf_file", "kvp")
+
+    def __init__(self, filename: str, pdf_file, kvp: List[KVPRow] | None = None):
+        self.filename = filename
+        self.pdf_file = pdf_file
+        self.kvp = kvp
+
+    def __repr__(self) -> str:
+        rows = len(self.kvp) if self.kvp else 0
+        return f"Document({self.filename!r}, {rows} KVP rows)"
+
+
+class Job:
+    """Everything extracted from one job zip
+
+    Parameters
+    ----------
+        name
+            Batch name, the zip name without .zip
+        zip_path
+            Path of the zip, as given to the extraction strategy
+        documents
+            Filename -> Document, in zip order
+        failed
+            File objects of the failed and invalid files of the job
+    """
+
+    __slots__ = ("name", "zip_path", "documents", "failed")
+
+    def __init__(
+        self,
+        name: str,
+        zip_path: str = "",
+        documents: Dict[str, Document] | None = None,
+        failed: List | None = None,
+    ):
+        self.name = name
+        self.zip_path = zip_path
+        self.documents = documents if documents is not None else {}
+        self.failed = failed if failed is not None else []
+
+    def __repr__(self) -> str:
+        return f"Job({self.name!r}, {len(self.documents)} documents)"
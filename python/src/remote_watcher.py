@@ -0,0 +1,190 @@
+import time
+from typing import Dict, Iterator, List, Set, Tuple
+
+from .directory_index import DirectoryIndex
+from .directory_parser import RemoteExtraction
+from .ftp_walker import WalkEntry
+from .utils import bcolors
+
+
+def _signature(entry: WalkEntry | None) -> Tuple[int | None, str | None] | None:
+    return (entry.size, entry.modify) if entry else None
+
+
+class RemoteWatcher:
+    """Polls the Output folders of a contract on the FTP server for new job zips.
+
+    The Output folders are found with the same breadth first search as
+    RemoteExtraction._get_output_folders and searched for again every
+    rediscover_every polls. A poll lists every Output folder with MLSD (or LIST)
+    and only descends into folders whose modify time changed, using a
+    DirectoryIndex as the snapshot of the previous poll. Folders holding a zip that
+    is still being written are always listed, since writing to a file does not
+    change the modify time of its folder.
+
+    The zips found are diffed against the previous poll. A zip is complete once
+    its size and modify time are the same in two polls in a row, and it is handed
+    out once per size and modify time. With a persistent index, zips already
+    marked processed there are not handed out again.
+
+    A zip that is released because it could not be read or uploaded is handed out
+    again after min_interval, doubling with every failure. After max_attempts
+    failures it is only handed out again once its size or modify time changes.
+
+    The polling interval drops to min_interval whenever a poll sees a change and
+    grows by backoff after each poll that sees none, up to max_interval.
+
+    Parameters
+    ----------
+        extraction_strat
+            Remote strategy whose FTP connections are used for the listings
+        contract
+            Folder the Output folders are searched in
+        index
+            Index shared with DirectoryParser, an in-memory one when None
+        min_interval
+            Seconds between polls while zips are arriving
+        max_interval
+            Upper bound of the seconds between polls
+        backoff
+            Factor the interval grows by after a poll without changes
+        rediscover_every
+            Polls after which the Output folders are searched for again
+        max_attempts
+            Times a zip is handed out before it is given up on until it changes
+    """
+
+    def __init__(
+        self,
+        extraction_strat: RemoteExtraction,
+        contract: str = "",
+        index: DirectoryIndex | None = None,
+        min_interval: float = 5.0,
+        max_interval: float = 300.0,
+        backoff: float = 2.0,
+        rediscover_every: int = 20,
+        max_attempts: int = 5,
+    ):
+        self.walker = extraction_strat.walker
+        self.contract = contract
+        self.index = index if index else DirectoryIndex(":memory:")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.rediscover_every = max(rediscover_every, 1)
+        self.max_attempts = max_attempts
+        self.interval = min_interval
+        self.polls = 0
+        # Directories listed by the last poll, to see how cheap polls are
+        self.listed = 0
+
+        self._output_dirs: List[str] | None = None
+        self._snapshot: Dict[str, WalkEntry] = {}
+        # Zips whose size or modify time changed in the last poll
+        self._unsettled: Set[str] = set()
+        # Path -> signature the zip was handed out with
+        self._emitted: Dict[str, Tuple] = {}
+        # Path -> signature and number of failures of a released zip
+        self._failures: Dict[str, Tuple[Tuple, int]] = {}
+        # Path -> time.monotonic() a released zip is handed out again at
+        self._retry_at: Dict[str, float] = {}
+
+    def _cached(self, dir_entry: WalkEntry) -> List[WalkEntry] | None:
+        prefix = dir_entry.path.rstrip("/") + "/"
+        if any(path.startswith(prefix) for path in self._unsettled):
+            return None
+        return self.index.cached_files(self.contract, dir_entry)
+
+    def _scan(self) -> List[WalkEntry]:
+        if self._output_dirs is None or self.polls % self.rediscover_every == 0:
+            self._output_dirs = self.walker.find_output_dirs(self.contract)
+
+        zip_files = []
+        self.listed = 0
+        for output_dir in self._output_dirs:
+            _zip_files, listed_dirs = self.walker.walk(
+                output_dir,
+                predicate=lambda entry: entry.name.endswith("zip"),
+                cached=self._cached,
+            )
+            self.index.record_walk(self.contract, _zip_files, listed_dirs)
+            zip_files.extend(_zip_files)
+            self.listed += len(listed_dirs)
+
+        return zip_files
+
+    def poll(self) -> List[WalkEntry]:
+        """Lists the Output folders once and returns the zips that completed since
+        the last poll"""
+        snapshot = {entry.path: entry for entry in self._scan()}
+        self.polls += 1
+
+        settled = []
+        unsettled = set()
+        for path, entry in snapshot.items():
+            if _signature(self._snapshot.get(path)) == _signature(entry):
+                settled.append(entry)
+            else:
+                unsettled.add(path)
+        removed = self._snapshot.keys() - snapshot.keys()
+        for path in removed:
+            self._emitted.pop(path, None)
+            self._failures.pop(path, None)
+            self._retry_at.pop(path, None)
+
+        if unsettled or removed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        self._snapshot = snapshot
+        self._unsettled = unsettled
+
+        now = time.monotonic()
+        ready = [
+            entry
+            for entry in self.index.pending(self.contract, settled)
+            if self._emitted.get(entry.path) != _signature(entry)
+            and self._retry_at.get(entry.path, 0) <= now
+        ]
+        for entry in ready:
+            self._emitted[entry.path] = _signature(entry)
+
+        return ready
+
+    def release(self, entry: WalkEntry):
+        """Lets a zip that was handed out be handed out again, e.g. because reading
+        or uploading it failed, after a delay that doubles with every failure. Once
+        it failed max_attempts times it stays out until it changes"""
+        signature, failures = self._failures.get(entry.path, (None, 0))
+        if signature != _signature(entry):
+            failures = 0
+        failures += 1
+        self._failures[entry.path] = (_signature(entry), failures)
+        if failures >= self.max_attempts:
+            print(
+                bcolors.FAIL
+                + f"Giving up on {entry.path} after {failures} attempts "
+                + "until it changes"
+                + bcolors.ENDC
+            )
+            self._retry_at.pop(entry.path, None)
+            return
+        self._emitted.pop(entry.path, None)
+        self._retry_at[entry.path] = time.monotonic() + self.min_interval * 2 ** (
+            failures - 1
+        )
+
+    def watch(self) -> Iterator[List[WalkEntry]]:
+        """Polls forever, yielding the zips of every poll that found complete ones"""
+        while True:
+            ready = self.poll()
+            print(
+                bcolors.OKCYAN
+                + f"Poll {self.polls}: {len(self._snapshot)} zips, "
+                + f"{self.listed} folders listed, {len(ready)} ready, "
+                + f"next in {self.interval:0.1f}s"
+                + bcolors.ENDC
+            )
+            if ready:
+                yield ready
+            time.sleep(self.interval)
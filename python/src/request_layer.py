@@ -0,0 +1,370 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+import requests
+
+from .metrics import metrics
+from .utils import bcolors
+
+# Statuses FileCloud or a proxy in front of it answer with while overloaded
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# Statuses, and texts of FileCloud XML replies, of requests made with an expired
+# session
+RELOGIN_STATUSES = {401, 403}
+RELOGIN_MESSAGES = ("not logged in", "session expired", "invalid session")
+# Endpoints a request can be sent again to without changing the outcome: logins,
+# reads, and createfolder, which leaves an existing folder alone. Requests to any
+# other endpoint are only sent again through RequestLayer.post_checked
+IDEMPOTENT_ENDPOINTS = {
+    "/core/loginguest",
+    "/admin/adminlogin",
+    "/admin/getuser",
+    "/core/createfolder",
+    "/core/getfilelist",
+    "/core/fileinfo",
+    "/core/getavailablemetadatasets",
+    "/core/getdefaultmetadatavalues",
+    "/core/getmetadatavalues",
+}
+
+
+class TokenBucket:
+    """Thread-safe token bucket. Allows `rate` requests per second on average and
+    bursts of up to `burst` requests
+
+    Parameters
+    ----------
+        rate
+            Tokens added per second
+        burst
+            Maximum number of tokens held
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns the seconds to wait before using it. Tokens may
+        be taken ahead of time, which is what keeps waiting callers in order"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class EndpointStats:
+    """Latency and error counters of one endpoint"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.relogins = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, error: bool):
+        with self._lock:
+            self.calls += 1
+            self.errors += error
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "retries": self.retries,
+                "relogins": self.relogins,
+                "seconds": self.seconds,
+                "mean_seconds": self.seconds / self.calls if self.calls else 0.0,
+                "max_seconds": self.max_seconds,
+            }
+
+
+def stats_endpoint(endpoint: str) -> str:
+    """Endpoint without its query string, the key requests are counted under"""
+    return endpoint.split("?")[0]
+
+
+def _rewind_points(kwargs: Dict) -> Dict | None:
+    """Positions of the file objects in a files= argument, so they can be sent
+    again. None if one of them cannot be rewound"""
+    points = {}
+    for value in (kwargs.get("files") or {}).values():
+        stream = value[1] if isinstance(value, tuple) else value
+        if isinstance(stream, (bytes, str)):
+            continue
+        try:
+            if not stream.seekable():
+                return None
+            points[id(stream)] = (stream, stream.tell())
+        except (AttributeError, OSError, ValueError):
+            return None
+    return points
+
+
+def _rewind(points: Dict | None):
+    for stream, position in (points or {}).values():
+        stream.seek(position)
+
+
+class RequestLayer:
+    """Sends the FileCloud requests of a controller.
+
+    Every request takes a token from the rate limiter first. Connection errors
+    and retryable statuses of idempotent requests are retried with exponential
+    backoff and full jitter, honouring Retry-After. Other requests may have gone
+    through even though they failed, see post_checked. A request made with an
+    expired session logs in again once and is resent, since the server rejected
+    it. File objects being uploaded are rewound before a retry, and requests whose
+    files cannot be rewound are not retried. Latency and errors are counted per
+    endpoint.
+
+    Parameters
+    ----------
+        rate_limit
+            Requests per second, None for no limit
+        burst
+            Requests allowed at once above rate_limit
+        max_retries
+            Retries of a failed request
+        backoff
+            Delay in seconds before the first retry, doubled on each retry
+        max_backoff
+            Upper bound of a single delay
+    """
+
+    def __init__(
+        self,
+        rate_limit: float | None = None,
+        burst: int = 10,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ):
+        self.bucket = TokenBucket(rate_limit, burst) if rate_limit else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._stats: Dict[str, EndpointStats] = {}
+        self._lock = threading.Lock()
+
+    def stats(self, endpoint: str) -> EndpointStats:
+        endpoint = stats_endpoint(endpoint)
+        with self._lock:
+            if endpoint not in self._stats:
+                self._stats[endpoint] = EndpointStats()
+            return self._stats[endpoint]
+
+    @staticmethod
+    def observe(endpoint: str, seconds: float, status):
+        """Records one attempt in the shared Metrics. status is the HTTP status or
+        the name of the error that kept it from getting a response"""
+        endpoint = stats_endpoint(endpoint)
+        metrics.observe("http_request_seconds", seconds, endpoint=endpoint)
+        metrics.count("http_requests_total", endpoint=endpoint, status=status)
+
+    @staticmethod
+    def observe_retry(endpoint: str):
+        metrics.count("http_retries_total", endpoint=stats_endpoint(endpoint))
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+    def report(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                endpoint: stats.as_dict() for endpoint, stats in self._stats.items()
+            }
+
+    def delay(self, attempt: int, retry_after: str | None = None) -> float:
+        """Seconds to wait before retry number attempt (0 based)"""
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    @staticmethod
+    def idempotent(endpoint: str) -> bool:
+        return stats_endpoint(endpoint) in IDEMPOTENT_ENDPOINTS
+
+    @staticmethod
+    def session_expired(status: int, text: str) -> bool:
+        if status in RELOGIN_STATUSES:
+            return True
+        # Only short XML error replies are checked, not file listings
+        return len(text) < 1024 and any(
+            message in text.lower() for message in RELOGIN_MESSAGES
+        )
+
+    def post(
+        self,
+        session: requests.Session,
+        url: str,
+        endpoint: str,
+        relogin: Callable[[], None] | None = None,
+        idempotent: bool | None = None,
+        **kwargs,
+    ) -> requests.Response:
+        """Posts to url, see the class description. The response of the last
+        attempt is returned, and the error of the last attempt raised if it did not
+        get a response. idempotent overrides IDEMPOTENT_ENDPOINTS for this request"""
+        stats = self.stats(endpoint)
+        if idempotent is None:
+            idempotent = self.idempotent(endpoint)
+        rewind_points = _rewind_points(kwargs)
+        max_retries = (
+            self.max_retries if idempotent and rewind_points is not None else 0
+        )
+        relogged = relogin is None
+
+        attempt = 0
+        while True:
+            if self.bucket:
+                self.bucket.acquire()
+            tic = time.perf_counter()
+            try:
+                response = session.post(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                stats.record(time.perf_counter() - tic, error=True)
+                self.observe(endpoint, time.perf_counter() - tic, type(e).__name__)
+                if attempt >= max_retries:
+                    raise
+                reason, retry_after = type(e).__name__, None
+            else:
+                stats.record(time.perf_counter() - tic, error=not response.ok)
+                self.observe(endpoint, time.perf_counter() - tic, response.status_code)
+                if not relogged and self.session_expired(
+                    response.status_code, response.text
+                ):
+                    # Resent right away, this does not count as a retry
+                    relogged = True
+                    stats.count("relogins")
+                    print(
+                        bcolors.WARNING
+                        + f"Session expired on {endpoint}, logging in again"
+                        + bcolors.ENDC
+                    )
+                    relogin()
+                    if rewind_points is None:
+                        return response
+                    _rewind(rewind_points)
+                    continue
+                if (
+                    response.status_code not in RETRYABLE_STATUSES
+                    or attempt >= max_retries
+                ):
+                    return response
+                reason = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After")
+
+            attempt += 1
+            time.sleep(self.count_retry(endpoint, attempt, reason, retry_after))
+            _rewind(rewind_points)
+
+    def post_checked(
+        self,
+        session: requests.Session,
+        url: str,
+        endpoint: str,
+        succeeded: Callable[[requests.Response], bool],
+        applied: Callable[[], bool],
+        relogin: Callable[[], None] | None = None,
+        **kwargs,
+    ) -> Tuple[bool, requests.Response | None]:
+        """Posts a request that is not idempotent, e.g. one that creates something.
+        An attempt that fails with a connection error or a retryable status may
+        still have gone through, so applied is asked whether the server has its
+        effect before the request is sent again
+
+        Parameters
+        ----------
+            succeeded
+                Whether a response means the request took effect
+            applied
+                Checks the server for the effect of the request
+
+        Returns
+        -------
+            Tuple[bool, requests.Response | None]
+                Whether the request took effect, and the response of the last
+                attempt or None if it got none. The error of the last attempt is
+                raised if it got no response and did not take effect
+        """
+        rewind_points = _rewind_points(kwargs)
+        max_retries = self.max_retries if rewind_points is not None else 0
+
+        attempt = 0
+        while True:
+            try:
+                response = self.post(
+                    session, url, endpoint, relogin=relogin, idempotent=False, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, error = None, e
+                reason, retry_after = type(e).__name__, None
+            else:
+                if succeeded(response):
+                    return True, response
+                if response.status_code not in RETRYABLE_STATUSES:
+                    return False, response
+                error = None
+                reason = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After")
+
+            if applied():
+                print(
+                    bcolors.WARNING
+                    + f"{endpoint} failed ({reason}) but went through"
+                    + bcolors.ENDC
+                )
+                return True, response
+            if attempt >= max_retries:
+                if error is not None:
+                    raise error
+                return False, response
+
+            attempt += 1
+            time.sleep(self.count_retry(endpoint, attempt, reason, retry_after))
+            _rewind(rewind_points)
+
+    def count_retry(
+        self, endpoint: str, attempt: int, reason: str, retry_after: str | None = None
+    ) -> float:
+        """Counts retry number attempt (1 based) of a request to endpoint and
+        returns the seconds to wait before sending it"""
+        delay = self.delay(attempt - 1, retry_after)
+        self.stats(endpoint).count("retries")
+        self.observe_retry(endpoint)
+        print(
+            bcolors.WARNING
+            + f"{endpoint} failed ({reason}), retry {attempt} in {delay:0.2f}s"
+            + bcolors.ENDC
+        )
+        return delay
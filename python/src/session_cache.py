@@ -0,0 +1,113 @@
+import time
+from typing import Dict, List
+
+import requests
+
+from .json_store import JSONStore
+
+
+class SessionCache:
+    """Cache of the cookies of logged in FileCloud sessions, so a new run or
+    lambda invocation can skip the login round trips.
+
+    Entries are keyed by session kind (core or admin), user and server. An entry
+    expires after `ttl` seconds or when one of its cookies expires, whichever comes
+    first. A session can still be ended by the server earlier than that; the
+    request layer then logs in again and the new cookies replace the entry. With a
+    path the cache is kept in a JSON file, readable by the owner only, which
+    several processes may share: an entry missing in memory is looked up in the
+    file again before logging in.
+
+    Parameters
+    ----------
+        ttl
+            Seconds cookies are reused before logging in again
+        path
+            JSON file the cache is loaded from and saved to
+    """
+
+    def __init__(self, ttl: float = 1800.0, path: str | None = None):
+        self.ttl = ttl
+        # Cookies are credentials, the file is readable by the owner only
+        self._store = JSONStore(path, mode=0o600)
+        self._entries: Dict[str, Dict] = {}
+        self._lock = self._store.lock
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    @staticmethod
+    def key(kind: str, user: str, server_url: str) -> str:
+        return f"{kind} {user}@{server_url}"
+
+    def _valid(self, entry: Dict) -> bool:
+        now = time.time()
+        if now - entry["stored_at"] >= self.ttl:
+            return False
+        return all(
+            cookie["expires"] is None or cookie["expires"] > now
+            for cookie in entry["cookies"]
+        )
+
+    def _load(self):
+        """Reads the entries of the file that are still valid. Called with the lock
+        held, or from __init__"""
+        for key, entry in self._store.load({}).items():
+            if self._valid(entry):
+                self._entries[key] = entry
+
+    def get(self, key: str) -> List[Dict] | None:
+        """Cookies stored under key, None if there are none or they expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None or not self._valid(entry)) and self._store.path:
+                self._load()
+                entry = self._entries.get(key)
+            if entry is None or not self._valid(entry):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["cookies"]
+
+    def put(self, key: str, cookies: List[Dict]):
+        with self._lock:
+            self._entries[key] = {"cookies": cookies, "stored_at": time.time()}
+            self._store.save(self._entries)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._store.save(self._entries)
+
+    def store(self, key: str, session: requests.Session):
+        """Stores the cookies of a session that just logged in"""
+        self.put(
+            key,
+            [
+                {
+                    "name": cookie.name,
+                    "value": cookie.value,
+                    "domain": cookie.domain,
+                    "path": cookie.path,
+                    "expires": cookie.expires,
+                }
+                for cookie in session.cookies
+            ],
+        )
+
+    def restore(self, key: str, session: requests.Session) -> bool:
+        """Puts the cookies stored under key into session. False if there are none
+        and the session has to log in"""
+        cookies = self.get(key)
+        if not cookies:
+            return False
+        for cookie in cookies:
+            session.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie["domain"],
+                path=cookie["path"],
+                expires=cookie["expires"],
+            )
+        return True
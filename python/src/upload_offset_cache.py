@@ -0,0 +1,46 @@
+import time
+from typing import Dict
+
+from .json_store import JSONStore
+
+
+class UploadOffsetCache:
+    """Offsets reached by chunked uploads that failed, so the next upload of the same
+    file, in this run or a later one, resumes from there instead of from the start.
+
+    Entries are keyed by the FileCloud path of the file. An offset older than `ttl`
+    is ignored and the file is uploaded from the start, since the server may have
+    dropped the partial upload by then. With a path the offsets are kept in a JSON
+    file between runs.
+
+    Parameters
+    ----------
+        ttl
+            Seconds an offset is resumed from
+        path
+            JSON file the offsets are loaded from and saved to
+    """
+
+    def __init__(self, ttl: float = 3600.0, path: str | None = None):
+        self.ttl = ttl
+        self._store = JSONStore(path)
+        self._offsets: Dict[str, Dict] = self._store.load({})
+        self._lock = self._store.lock
+
+    def get(self, key: str) -> int:
+        """Offset to resume the upload of key from, 0 to start over"""
+        with self._lock:
+            entry = self._offsets.get(key)
+            if entry is None or time.time() - entry["stored_at"] >= self.ttl:
+                return 0
+            return entry["offset"]
+
+    def put(self, key: str, offset: int):
+        with self._lock:
+            self._offsets[key] = {"offset": offset, "stored_at": time.time()}
+            self._store.save(self._offsets)
+
+    def discard(self, key: str):
+        with self._lock:
+            if self._offsets.pop(key, None) is not None:
+                self._store.save(self._offsets)
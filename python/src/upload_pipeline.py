@@ -0,0 +1,343 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List
+
+from .file_cloud_controller import FileCloudController
+from .metrics import metrics
+from .records import Job
+from .utils import bcolors, timerdecorator
+
+if TYPE_CHECKING:
+    from .upload_queue import UploadQueue
+
+
+def tasks_from_kvp(kvp_per_file: Dict[str, Job]) -> Iterator[Dict]:
+    """Flattens the kvp_per_file dict returned by DirectoryParser.process_dir or
+    DirectoryParser.process_job into upload tasks
+
+    Parameters
+    ----------
+        kvp_per_file
+            Batch name -> Job, see records.Job
+
+    Returns
+    -------
+        Iterator[Dict]
+            job, filename, file_data, kvp and is_failed of every file to upload
+    """
+    for job, record in kvp_per_file.items():
+        for document in record.documents.values():
+            yield {
+                "job": job,
+                "filename": document.filename,
+                "file_data": document.pdf_file,
+                "kvp": document.kvp,
+                "is_failed": False,
+            }
+        for file in record.failed:
+            yield {
+                "job": job,
+                "filename": f"({job}) {file.name}",
+                "file_data": file,
+                "kvp": None,
+                "is_failed": True,
+            }
+
+
+def upload_stats(results: List[Dict], elapsed: float, workers: int) -> Dict:
+    """Aggregate counts, bytes and throughput of upload results"""
+    uploaded = [result for result in results if result["uploaded"]]
+    total_bytes = sum(result["bytes"] for result in uploaded)
+    return {
+        "workers": workers,
+        "total": len(results),
+        "uploaded": len(uploaded),
+        "failed": len(results) - len(uploaded),
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "files_per_second": len(uploaded) / elapsed if elapsed else 0.0,
+        "bytes_per_second": total_bytes / elapsed if elapsed else 0.0,
+    }
+
+
+class UploadPipeline:
+    """Uploads files to Filecloud using a bounded pool of worker threads.
+
+    Every upload_file call spends most of its time waiting on Filecloud round-trips,
+    so running several of them at once is what keeps a batch from being bound by
+    network latency.
+    """
+
+    def __init__(self, fc_service: FileCloudController, max_workers: int = 4):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        self.fc_service = fc_service
+        self.max_workers = max_workers
+        self.fc_service.configure_pool(max_workers)
+
+    def _folder_name(self, task: Dict) -> str:
+        return self.fc_service.folder_name(task["file_data"], task["is_failed"])
+
+    def prepare_folders(self, tasks: Iterable[Dict]):
+        """Creates the Filecloud folders of every task before any upload starts.
+        Folders that are already known to exist cost nothing"""
+        self.fc_service.prepare_folders(self._folder_name(task) for task in tasks)
+
+    def upload(self, task: Dict) -> Dict:
+        """Uploads the file of one task, see tasks_from_kvp. Errors are caught and
+        reported in the result dict, see run"""
+        result = {
+            "job": task["job"],
+            "filename": task["filename"],
+            "uploaded": False,
+            "bytes": 0,
+            "seconds": 0.0,
+            "error": None,
+        }
+        tic = time.perf_counter()
+        try:
+            with metrics.context(
+                job=task["job"], filename=task["filename"]
+            ), metrics.span("upload"):
+                result["uploaded"] = bool(
+                    self.fc_service.upload_file(
+                        task["filename"],
+                        task["file_data"],
+                        task["kvp"],
+                        is_failed=task["is_failed"],
+                    )
+                )
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["seconds"] = time.perf_counter() - tic
+        try:
+            result["bytes"] = task["file_data"].tell()
+        except (AttributeError, OSError, ValueError):
+            pass
+        metrics.count("upload_bytes_total", result["bytes"])
+
+        return result
+
+    @timerdecorator
+    def run(self, tasks: Iterable[Dict]) -> Dict:
+        """Uploads every task and waits for all of them to finish. At most twice the
+        worker count is kept in flight so a lazy iterable of tasks is never
+        drained ahead of the uploads
+
+        Parameters
+        ----------
+            tasks
+                Upload tasks, see tasks_from_kvp
+
+        Returns
+        -------
+            Dict
+                results:    per-file result dicts, in the order uploads finished
+                stats:      aggregate counts, bytes and throughput
+        """
+        results: List[Dict] = []
+        max_in_flight = self.max_workers * 2
+        tic = time.perf_counter()
+
+        def collect(done):
+            results.extend(future.result() for future in done)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = set()
+            for task in tasks:
+                # Folders of lazily produced tasks are created as they show up,
+                # before the first upload into them is submitted
+                self.prepare_folders([task])
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(executor.submit(self.upload, task))
+
+            done, _ = wait(in_flight)
+            collect(done)
+
+        elapsed = time.perf_counter() - tic
+        return {"results": results, "stats": self._stats(results, elapsed)}
+
+    def run_kvp(self, kvp_per_file: Dict[str, Job]) -> Dict:
+        """Convenience wrapper for the dict returned by process_dir/process_job.
+        The folders of all jobs are created before the uploads start"""
+        tasks = list(tasks_from_kvp(kvp_per_file))
+        self.prepare_folders(tasks)
+        return self.run(tasks)
+
+    def _stats(self, results: List[Dict], elapsed: float) -> Dict:
+        return upload_stats(results, elapsed, self.max_workers)
+
+
+class QueueConsumer:
+    """Uploads the tasks of an UploadQueue with a pool of worker threads.
+
+    Each worker leases one task at a time, opens its PDF from the zip through the
+    extraction strategy and uploads it like UploadPipeline does, then acks or nacks
+    the task. Opened zips are shared by the workers and the most recent ones are
+    kept open, since tasks of the same zip are queued next to each other. Tasks
+    still leased by the workers when a run ends, e.g. because it was stopped, are
+    returned to the queue instead of waiting for their lease to expire.
+
+    Parameters
+    ----------
+        queue
+            Queue to consume
+        fc_service
+            FileCloudController to upload with
+        extraction_strat
+            ExtractionStrategy that opens the zips named by the tasks
+        max_workers
+            Number of uploads running at once
+        open_zips
+            Number of zips kept open
+    """
+
+    def __init__(
+        self,
+        queue: "UploadQueue",
+        fc_service: FileCloudController,
+        extraction_strat,
+        max_workers: int = 4,
+        open_zips: int = 4,
+    ):
+        self.queue = queue
+        self.pipeline = UploadPipeline(fc_service, max_workers=max_workers)
+        self.extraction_strat = extraction_strat
+        self.max_workers = max_workers
+        self.open_zips = open_zips
+        # Zip path -> Future of the opened zip, most recently used last
+        self._zips: OrderedDict = OrderedDict()
+        self._zips_lock = threading.Lock()
+        self._leased = set()
+        self._leased_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _zip(self, zip_path: str):
+        with self._zips_lock:
+            future = self._zips.get(zip_path)
+            fetch = future is None
+            if fetch:
+                future = self._zips[zip_path] = Future()
+                while len(self._zips) > self.open_zips:
+                    self._zips.popitem(last=False)
+            else:
+                self._zips.move_to_end(zip_path)
+
+        # The first worker to ask for a zip fetches it, the others wait for it
+        # without holding up workers that need other zips
+        if fetch:
+            try:
+                output_zip = self.extraction_strat.get_zip_output(zip_path)
+                if output_zip is None:
+                    raise FileNotFoundError(zip_path)
+            except Exception as e:
+                with self._zips_lock:
+                    if self._zips.get(zip_path) is future:
+                        del self._zips[zip_path]
+                future.set_exception(e)
+            else:
+                future.set_result(output_zip)
+        return future.result()
+
+    def _process(self, task: Dict) -> Dict:
+        try:
+            file_data = self._zip(task["zip_path"]).open(task["member"], "r")
+        except Exception as e:
+            result = {
+                "job": task["job"],
+                "filename": task["filename"],
+                "uploaded": False,
+                "bytes": 0,
+                "seconds": 0.0,
+                "error": f"{type(e).__name__}: {e}",
+            }
+        else:
+            result = self.pipeline.upload(
+                {
+                    "job": task["job"],
+                    "filename": task["filename"],
+                    "file_data": file_data,
+                    "kvp": task["kvp"],
+                    "is_failed": False,
+                }
+            )
+
+        if result["uploaded"]:
+            self.queue.ack(task["id"])
+        else:
+            error = result["error"] or "upload rejected"
+            print(
+                bcolors.WARNING
+                + f"{task['filename']} failed (attempt {task['attempts']}): {error}"
+                + bcolors.ENDC
+            )
+            self.queue.nack(task["id"], error)
+        with self._leased_lock:
+            self._leased.discard(task["id"])
+        return result
+
+    def _work(self, results: List[Dict], wait: bool, producing: threading.Event | None):
+        while not self._stopped.is_set():
+            tasks = self.queue.lease()
+            if not tasks:
+                done = producing is None or producing.is_set()
+                if done and (not wait or not self.queue.unfinished()):
+                    return
+                # Tasks may still be queued, retries and other workers' leases are
+                # not due yet
+                self._stopped.wait(1)
+                continue
+            with self._leased_lock:
+                self._leased.add(tasks[0]["id"])
+            results.append(self._process(tasks[0]))
+
+    def stop(self):
+        """Makes a run return once its workers finished the uploads they started"""
+        self._stopped.set()
+
+    @timerdecorator
+    def run(self, wait: bool = False, producing: threading.Event | None = None) -> Dict:
+        """Works until no task is due. With wait, also waits for tasks that are
+        scheduled for a retry or leased to a worker that may die, until every task
+        is done or dead
+
+        Parameters
+        ----------
+            wait
+                Wait for tasks that are not due yet
+            producing
+                Event set once no more tasks will be queued, the run does not end
+                before it is set. For uploading while the tasks are being queued
+
+        Returns
+        -------
+            Dict
+                results:    per-file result dicts, in the order uploads finished
+                stats:      aggregate counts, bytes and throughput
+        """
+        results: List[Dict] = []
+        tic = time.perf_counter()
+        self._stopped.clear()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                workers = [
+                    executor.submit(self._work, results, wait, producing)
+                    for _ in range(self.max_workers)
+                ]
+                for worker in workers:
+                    worker.result()
+        finally:
+            with self._leased_lock:
+                leased, self._leased = list(self._leased), set()
+            if leased:
+                self.queue.release(leased)
+
+        elapsed = time.perf_counter() - tic
+        return {
+            "results": results,
+            "stats": upload_stats(results, elapsed, self.max_workers),
+        }
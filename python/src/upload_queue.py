@@ -0,0 +1,237 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+from enum import Enum
+from typing import Dict, Iterable, List
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    zip_path TEXT NOT NULL,
+    member TEXT NOT NULL,
+    kvp TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_until REAL,
+    error TEXT,
+    updated_at REAL,
+    UNIQUE (zip_path, member)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, available_at);
+CREATE INDEX IF NOT EXISTS tasks_zip ON tasks (zip_path, status);
+"""
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+DEAD = "dead"
+
+
+def _json_default(value):
+    # KVP rows are stored as objects. Date cells become text, which is how they are
+    # sent to FileCloud
+    if isinstance(value, Mapping):
+        return dict(value)
+    return str(value)
+
+
+class QueueRole(Enum):
+    """What a run of app.py does with the upload queue"""
+
+    ALL = "all"
+    PRODUCE = "produce"
+    CONSUME = "consume"
+
+
+class UploadQueue:
+    """Durable queue of upload tasks, kept in SQLite.
+
+    A task names a Searchable PDF by the zip it is in and its member name, and
+    carries the KVP records of the file, so it can be uploaded by any process that
+    can open the zip. Tasks are leased to a worker and only leave the queue once
+    acknowledged. A lease that is not acknowledged in time, e.g. because the
+    worker died, expires and the task is handed out again. Failed tasks are
+    retried with a growing delay until max_attempts is reached.
+
+    Parameters
+    ----------
+        db_path
+            Path of the SQLite database file
+        lease_seconds
+            Seconds a worker has to ack or nack a leased task
+        max_attempts
+            Attempts after which a task is marked dead
+        retry_delay
+            Seconds before a failed task is retried, doubled on each attempt
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        lease_seconds: float = 600.0,
+        max_attempts: int = 5,
+        retry_delay: float = 30.0,
+    ):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def enqueue(self, tasks: Iterable[Dict], reset: bool = False) -> int:
+        """Adds tasks with job, filename, zip_path, member and kvp keys. Tasks that
+        are already queued, including finished ones, are left as they are unless
+        reset is set, e.g. because their zip changed since they were queued
+
+        Returns
+        -------
+            int
+                Number of tasks added or reset
+        """
+        rows = [
+            (
+                task["job"],
+                task["filename"],
+                task["zip_path"],
+                task["member"],
+                json.dumps(task["kvp"], default=_json_default) if task["kvp"] else None,
+                time.time(),
+            )
+            for task in tasks
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self._conn.total_changes
+                self._conn.executemany(
+                    "INSERT INTO tasks "
+                    "(job, filename, zip_path, member, kvp, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?) "
+                    + (
+                        "ON CONFLICT (zip_path, member) DO UPDATE SET "
+                        "job = excluded.job, filename = excluded.filename, "
+                        "kvp = excluded.kvp, status = 'pending', attempts = 0, "
+                        "available_at = 0, lease_until = NULL, error = NULL, "
+                        "updated_at = excluded.updated_at"
+                        if reset
+                        else "ON CONFLICT (zip_path, member) DO NOTHING"
+                    ),
+                    rows,
+                )
+                added = self._conn.total_changes - before
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return added
+
+    def lease(self, limit: int = 1) -> List[Dict]:
+        """Hands out up to limit tasks that are due, including tasks whose lease
+        expired"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, job, filename, zip_path, member, kvp, attempts "
+                    "FROM tasks WHERE (status = ? AND available_at <= ?) "
+                    "OR (status = ? AND lease_until < ?) "
+                    "ORDER BY id LIMIT ?",
+                    (PENDING, now, LEASED, now, limit),
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE tasks SET status = ?, attempts = attempts + 1, "
+                    "lease_until = ?, updated_at = ? WHERE id = ?",
+                    [(LEASED, now + self.lease_seconds, now, row[0]) for row in rows],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return [
+            {
+                "id": task_id,
+                "job": job,
+                "filename": filename,
+                "zip_path": zip_path,
+                "member": member,
+                "kvp": json.loads(kvp) if kvp is not None else None,
+                "attempts": attempts + 1,
+            }
+            for task_id, job, filename, zip_path, member, kvp, attempts in rows
+        ]
+
+    def ack(self, task_id: int):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tasks SET status = ?, lease_until = NULL, error = NULL, "
+                "updated_at = ? WHERE id = ?",
+                (DONE, time.time(), task_id),
+            )
+
+    def nack(self, task_id: int, error: str | None = None):
+        """Returns a failed task to the queue, or marks it dead once it used up its
+        attempts"""
+        now = time.time()
+        with self._lock:
+            (attempts,) = self._conn.execute(
+                "SELECT attempts FROM tasks WHERE id = ?", (task_id,)
+            ).fetchone()
+            status = DEAD if attempts >= self.max_attempts else PENDING
+            self._conn.execute(
+                "UPDATE tasks SET status = ?, available_at = ?, lease_until = NULL, "
+                "error = ?, updated_at = ? WHERE id = ?",
+                (
+                    status,
+                    now + self.retry_delay * 2 ** (attempts - 1),
+                    error,
+                    now,
+                    task_id,
+                ),
+            )
+
+    def release(self, task_ids: Iterable[int]):
+        """Returns leased tasks that were not worked on to the queue right away,
+        without counting the attempt"""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE tasks SET status = ?, attempts = attempts - 1, "
+                "lease_until = NULL, updated_at = ? WHERE id = ? AND status = ?",
+                [(PENDING, time.time(), task_id, LEASED) for task_id in task_ids],
+            )
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                self._conn.execute(
+                    "SELECT status, COUNT(*) FROM tasks GROUP BY status"
+                ).fetchall()
+            )
+
+    def unfinished(self) -> int:
+        """Tasks that are pending or leased, whether due or not"""
+        with self._lock:
+            (count,) = self._conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)",
+                (PENDING, LEASED),
+            ).fetchone()
+        return count
+
+    def close(self):
+        self._conn.close()
@@ -2,18 +2,34 @@ import time
 from enum import Enum
 from functools import wraps
 
+from .metrics import metrics
+
+# Whether timerdecorator prints every call, see show_timings
+_show_timings = False
+
+
+def show_timings(enabled: bool = True):
+    """Makes timerdecorator print how long every call took"""
+    global _show_timings
+    _show_timings = enabled
+
 
 def timerdecorator(func):
+    """Records how long every call of func took in function_seconds{function=...}
+    of the shared Metrics, and prints it once show_timings was called"""
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         tic = time.perf_counter()
         value = func(*args, **kwargs)
         toc = time.perf_counter()
-        print(
-            bcolors.OKGREEN
-            + f"{func.__name__} took {toc-tic:0.4f} seconds to execute"
-            + bcolors.ENDC,
-        )
+        metrics.observe("function_seconds", toc - tic, function=func.__name__)
+        if _show_timings:
+            print(
+                bcolors.OKGREEN
+                + f"{func.__name__} took {toc-tic:0.4f} seconds to execute"
+                + bcolors.ENDC,
+            )
         return value
 
     return wrapper
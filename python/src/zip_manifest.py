@@ -0,0 +1,113 @@
+import re
+import zipfile
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from .config import BATCH_SPREADSHEET_NAME, SUFFIX_REMOVE_SEARCHABLE
+from .records import KVPRow
+
+EXCEL_PATTERN = re.compile(r"^.+\/.+\.xlsx$")
+BATCH_SPREADSHEET_PATTERN = re.compile(BATCH_SPREADSHEET_NAME)
+SEARCHABLE_PDF_PATTERN = re.compile(r"Searchable PDF")
+
+
+def searchable_filename(member: str) -> str:
+    """Name a Searchable PDF is uploaded and matched to its KVP records by"""
+    return member.rpartition("/")[2].removesuffix(SUFFIX_REMOVE_SEARCHABLE)
+
+
+def group_by_filename(
+    kvp_records: Iterable[Tuple[str, List[KVPRow]]],
+) -> Dict[str, List[KVPRow]]:
+    """Groups the KVP records of every sheet by their File name in one pass, keeping
+    sheet and row order within each file
+
+    Parameters
+    ----------
+        kvp_records
+            (sheet name, records) pairs, see KVPSpreadsheet.kvp_records
+    """
+    grouped: Dict[str, List[KVPRow]] = {}
+    for _, records in kvp_records:
+        for record in records:
+            filename = record["File name"]
+            if filename in grouped:
+                grouped[filename].append(record)
+            else:
+                grouped[filename] = [record]
+
+    return grouped
+
+
+class KVPJoin(NamedTuple):
+    """KVP records joined to the Searchable PDFs of a zip
+
+    rows
+        Filename -> records of every Searchable PDF that has records
+    unmatched_rows
+        Filename -> records whose File name is not a Searchable PDF of the zip
+    orphan_pdfs
+        Filenames of the Searchable PDFs without records, in zip order
+    """
+
+    rows: Dict[str, List[KVPRow]]
+    unmatched_rows: Dict[str, List[KVPRow]]
+    orphan_pdfs: List[str]
+
+
+class ZipManifest(NamedTuple):
+    """Members of a job zip, sorted by what DirectoryParser does with them
+
+    spreadsheets
+        Batch KVP Spreadsheets, in zip order
+    searchable_pdfs
+        Filename (see searchable_filename) -> member name of every Searchable PDF,
+        in zip order. A later member with the same filename replaces the earlier
+    others
+        Every other member, including directory entries
+    """
+
+    spreadsheets: List[str]
+    searchable_pdfs: Dict[str, str]
+    others: List[str]
+
+    @classmethod
+    def from_names(cls, names: Iterable[str]) -> "ZipManifest":
+        """Classifies member names in a single pass"""
+        spreadsheets = []
+        searchable_pdfs = {}
+        others = []
+        for name in names:
+            if name.endswith("/"):
+                others.append(name)
+            elif (
+                name.endswith(".xlsx")
+                and EXCEL_PATTERN.search(name)
+                and BATCH_SPREADSHEET_PATTERN.match(name)
+            ):
+                spreadsheets.append(name)
+            elif SEARCHABLE_PDF_PATTERN.search(name):
+                searchable_pdfs[searchable_filename(name)] = name
+            else:
+                others.append(name)
+
+        return cls(spreadsheets, searchable_pdfs, others)
+
+    @classmethod
+    def from_zip(cls, output_zip: zipfile.ZipFile) -> "ZipManifest":
+        return cls.from_names(output_zip.namelist())
+
+    def join(self, grouped: Dict[str, List[KVPRow]]) -> KVPJoin:
+        """Joins records grouped by group_by_filename to the Searchable PDFs with
+        one dict lookup per file"""
+        rows = {}
+        unmatched_rows = {}
+        for filename, records in grouped.items():
+            if filename in self.searchable_pdfs:
+                rows[filename] = records
+            else:
+                unmatched_rows[filename] = records
+        orphan_pdfs = [
+            filename for filename in self.searchable_pdfs if filename not in rows
+        ]
+
+        return KVPJoin(rows, unmatched_rows, orphan_pdfs)
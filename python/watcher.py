@@ -1,46 +1,244 @@
 # import time module, Observer, FileSystemEventHandler
+import argparse
+import os
+import threading
 import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Tuple
 
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
+from src import DirectoryParser, FileCloudController
+from src.directory_parser import LocalExtraction
+from src.upload_pipeline import UploadPipeline, tasks_from_kvp
+from src.utils import bcolors
+
 
 class OnMyWatch:
+    """Ingest daemon. Watches a directory for job zips and uploads each one as soon
+    as it is completely written.
+
+    Events only mark a zip as pending. A zip is dispatched once no event arrived for
+    it and its size stayed the same for `settle_seconds`, and it reads as a valid
+    zip. A zip that was already dispatched with the same size and modify time is
+    not dispatched again while it is being processed, so the modified events that
+    follow a copy or touch are ignored. Dispatched zips are extracted with
+    DirectoryParser._extract_from_zip and handed to `upload` in a pool of
+    `workers` threads.
+
+    A zip that could not be extracted, or some of whose files failed to upload, is
+    made pending again after `retry_seconds`, doubling with every failure. After
+    `max_attempts` failures it is only dispatched again once it changes.
+
+    Parameters
+    ----------
+        watch_directory
+            Directory watched recursively
+        upload
+            Called with the upload tasks of a zip, see upload_pipeline.tasks_from_kvp.
+            Returns a report with a result per file, see UploadPipeline.run
+        workers
+            Number of zips processed at the same time
+        settle_seconds
+            Seconds a zip must stay unchanged before it is processed
+        poll_interval
+            Seconds between checks of the pending zips
+        retry_seconds
+            Seconds before a zip that failed is processed again
+        max_attempts
+            Times a zip is processed before it is given up on until it changes
+    """
+
     # Set the directory on watch
     watchDirectory = "/home/iggy/pointwest/2023/BPICT/mock_ftps"
 
-    def __init__(self):
+    def __init__(
+        self,
+        watch_directory: str | None = None,
+        upload: Callable[[Iterable[Dict]], Dict] | None = None,
+        workers: int = 2,
+        settle_seconds: float = 2.0,
+        poll_interval: float = 0.5,
+        retry_seconds: float = 30.0,
+        max_attempts: int = 5,
+    ):
+        self.watch_directory = (
+            watch_directory if watch_directory else self.watchDirectory
+        )
+        self.upload = upload
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
         self.observer = Observer()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self._lock = threading.Lock()
+        # path -> (time of the last event, size seen when last checked)
+        self._pending: Dict[str, Tuple[float, int | None]] = {}
+        # path -> (size, modify time) of the zips being processed, and of the ones
+        # given up on
+        self._dispatched: Dict[str, Tuple[int, float]] = {}
+        # path -> failures of the zips that are being retried
+        self._failures: Dict[str, int] = {}
+
+    def notify(self, path: str):
+        """Marks a zip as changed, restarting its settle time"""
+        if not path.endswith(".zip"):
+            return
+        with self._lock:
+            _, size = self._pending.get(path, (0.0, None))
+            self._pending[path] = (time.monotonic(), size)
+
+    def _settled(self) -> list:
+        """Pending zips that stopped changing. Zips that disappeared are dropped"""
+        now = time.monotonic()
+        settled = []
+        with self._lock:
+            for path, (last_event, size) in list(self._pending.items()):
+                if now - last_event < self.settle_seconds:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self._pending[path]
+                    continue
+                if stat.st_size != size:
+                    # Still being written, check again after another settle time
+                    self._pending[path] = (now, stat.st_size)
+                    continue
+
+                del self._pending[path]
+                if self._dispatched.get(path) == (stat.st_size, stat.st_mtime):
+                    continue
+                self._dispatched[path] = (stat.st_size, stat.st_mtime)
+                settled.append(path)
+
+        return settled
+
+    def _ingest(self, path: str) -> bool:
+        """Extracts one zip and uploads its files. False if the zip could not be
+        extracted or a file failed to upload"""
+        if not zipfile.is_zipfile(path):
+            # Dispatched again by the next event for it
+            print(bcolors.FAIL + f"{path} is not a valid zip" + bcolors.ENDC)
+            return True
+
+        batch_name = os.path.basename(path).removesuffix(".zip")
+        file_parser = DirectoryParser(src_path=os.path.dirname(path))
+        file_parser.extraction_strat = LocalExtraction()
+        for excel, job in file_parser._extract_from_zip(path, batch_name):
+            file_parser._parse_dataframe(excel, job)
+        if batch_name in file_parser.extraction_failures:
+            return False
+        kvp = {batch_name: file_parser.kvp_per_file.pop(batch_name)}
+
+        print(bcolors.OKCYAN + f"Uploading {path}" + bcolors.ENDC)
+        if not self.upload:
+            return True
+        upload_report = self.upload(tasks_from_kvp(kvp))
+        return all(result["uploaded"] for result in upload_report["results"])
+
+    def _retry(self, path: str):
+        """Makes a zip that failed pending again after a delay, or gives up on it
+        until it changes"""
+        with self._lock:
+            failures = self._failures.get(path, 0) + 1
+            if failures >= self.max_attempts:
+                self._failures.pop(path, None)
+                print(
+                    bcolors.FAIL
+                    + f"Giving up on {path} after {failures} attempts until it changes"
+                    + bcolors.ENDC
+                )
+                return
+            self._failures[path] = failures
+            size, _ = self._dispatched.pop(path, (None, None))
+            delay = self.retry_seconds * 2 ** (failures - 1)
+            # An event for the zip in the meantime restarts its settle time
+            self._pending.setdefault(
+                path, (time.monotonic() + delay - self.settle_seconds, size)
+            )
+
+    def _dispatch(self, path: str):
+        def done(future):
+            if future.exception():
+                print(
+                    bcolors.FAIL + f"{path} failed: {future.exception()}" + bcolors.ENDC
+                )
+            elif future.result():
+                with self._lock:
+                    self._dispatched.pop(path, None)
+                    self._failures.pop(path, None)
+                return
+            self._retry(path)
+
+        self.executor.submit(self._ingest, path).add_done_callback(done)
 
     def run(self):
-        event_handler = Handler()
-        self.observer.schedule(event_handler, self.watchDirectory, recursive=True)
+        event_handler = Handler(self)
+        self.observer.schedule(event_handler, self.watch_directory, recursive=True)
         self.observer.start()
         try:
             while True:
-                time.sleep(5)
-        except:
+                time.sleep(self.poll_interval)
+                for path in self._settled():
+                    print(bcolors.OKCYAN + f"Dispatching {path}" + bcolors.ENDC)
+                    self._dispatch(path)
+        except KeyboardInterrupt:
             self.observer.stop()
             print("Observer Stopped")
 
         self.observer.join()
+        self.executor.shutdown(wait=True)
 
 
 class Handler(FileSystemEventHandler):
-    @staticmethod
-    def on_any_event(event):
-        print(event)
+    def __init__(self, watch: OnMyWatch):
+        super().__init__()
+        self.watch = watch
+
+    def on_any_event(self, event):
         if event.is_directory:
             return None
 
-        elif event.event_type == "created":
-            # Event is created, you can process it now
-            print("Watchdog received created event - % s." % event.src_path)
-        elif event.event_type == "modified":
-            # Event is modified, you can process it now
-            print("Watchdog received modified event - % s." % event.src_path)
+        elif event.event_type in ("created", "modified"):
+            self.watch.notify(event.src_path)
+        elif event.event_type == "moved":
+            # Files written under a temporary name and renamed when complete
+            self.watch.notify(event.dest_path)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--watch_dir", type=str, default=OnMyWatch.watchDirectory)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--upload_workers", type=int, default=4)
+    parser.add_argument("--settle_seconds", type=float, default=2.0)
+    parser.add_argument("--retry_seconds", type=float, default=30.0)
+    parser.add_argument("--max_attempts", type=int, default=5)
+    parser.add_argument("--server_url", type=str, default="http://40.78.9.249")
+    parser.add_argument("--fc_user", type=str, default="test")
+    parser.add_argument(
+        "--fc_passwd", type=str, default=os.environ.get("FILECLOUD_PASSWD", "")
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    watch = OnMyWatch()
+    opt = parse_opt()
+    fc_service = FileCloudController(opt.server_url, opt.fc_user, opt.fc_passwd)
+    fc_service.ensure_login()
+    pipeline = UploadPipeline(fc_service, max_workers=opt.upload_workers)
+
+    watch = OnMyWatch(
+        opt.watch_dir,
+        upload=pipeline.run,
+        workers=opt.workers,
+        settle_seconds=opt.settle_seconds,
+        retry_seconds=opt.retry_seconds,
+        max_attempts=opt.max_attempts,
+    )
     watch.run()